@@ -4,11 +4,10 @@ import re
 import time
 import string
 import asyncio
-from queue import Queue
 import agentpilot.agent.speech as speech
 # from agentpilot.plugins.memgpt.modules.agent_plugin import MemGPT_AgentPlugin
 from agentpilot.operations import task
-from agentpilot.utils import sql, logs, helpers
+from agentpilot.utils import sql, logs, helpers, retrieval
 # from agentpilot.plugins.openinterpreter.modules.agent_plugin import *
 from agentpilot.utils.apis import llm
 
@@ -25,13 +24,14 @@ class Agent:
         # self.blocks = {}
         # self.active_plugin = None
         # self.actions = None
+        self.action_collection = None  # (source directory, ActionCollection), see the actions property
         self.voice_data = None
         self.config = {}
         self.instance_config = {}
 
         # self.load_agent()
 
-        self.intermediate_task_responses = Queue()
+        self.intermediate_task_responses = asyncio.Queue()
         self.speech_lock = asyncio.Lock()
         # self.listener = Listener(self.speaker.is_speaking, lambda response: self.save_message('assistant', response))
 
@@ -46,6 +46,14 @@ class Agent:
         if wake:
             self.bg_task = self.context.loop.create_task(self.wake())
 
+    @property
+    def actions(self):
+        """The ActionCollection of 'actions.source_directory', built on first use and again if the setting changes"""
+        source_dir = self.config.get('actions.source_directory', '')
+        if self.action_collection is None or self.action_collection[0] != source_dir:
+            self.action_collection = (source_dir, retrieval.ActionCollection(source_dir))
+        return self.action_collection[1]
+
     async def wake(self):
         bg_tasks = [
             self.speaker.download_voices(),
@@ -62,16 +70,16 @@ class Agent:
 
     async def __intermediate_response_thread(self):
         while True:
-            await asyncio.sleep(0.03)
-            if self.speech_lock.locked():
-                continue
-            if self.intermediate_task_responses.empty():
-                continue
-
+            response = await self.intermediate_task_responses.get()
             async with self.speech_lock:
-                response_str = self.format_message(self.intermediate_task_responses.get())
-                self.get_response(extra_prompt=response_str,
-                                  check_for_tasks=False)
+                response_str = self.format_message(response)
+                await asyncio.to_thread(self.get_response,
+                                        extra_prompt=response_str,
+                                        check_for_tasks=False)
+
+    def add_intermediate_response(self, response):
+        """Called by actions, which may be running in a worker thread"""
+        self.context.loop.call_soon_threadsafe(self.intermediate_task_responses.put_nowait, response)
 
     def load_agent(self):
         logging.debug('Agent.load_agent() called')
@@ -143,8 +151,11 @@ class Agent:
         else:
             self.voice_data = None
 
-        if self.speaker is not None: self.speaker.kill()
-        self.speaker = speech.Stream_Speak(self)
+        # Keep the speaker, its queues are the ones wake() is already waiting on
+        if self.speaker is not None:
+            self.speaker.kill()
+        else:
+            self.speaker = speech.Stream_Speak(self)
 
     def system_message(self, msgs_in_system=None, response_instruction='', msgs_in_system_len=0):
         date = time.strftime("%a, %b %d, %Y", time.localtime())
@@ -242,16 +253,28 @@ class Agent:
         """The entry response method for the agent. Called by the context class"""
         logging.debug('Agent.respond() called')
         for key, chunk in self.receive(stream=True):
-            if self.context.stop_requested:
-                self.context.stop_requested = False
+            if not self.emit_chunk(key, chunk):
                 break
-            if key in ('assistant', 'message'):
-                # todo - move this to agent class
-                self.context.main.new_sentence_signal.emit(self.member_id, chunk)
-                print('EMIT: ', self.member_id, chunk)
-            else:
+
+    async def arespond(self):
+        """Awaitable respond(), lets the members of a context stream concurrently on its event loop"""
+        logging.debug('Agent.arespond() called')
+        async for key, chunk in self.aget_response_stream():
+            if not self.emit_chunk(key, chunk):
                 break
 
+    def emit_chunk(self, key, chunk):
+        """Sends a response chunk to the gui, returns False when the response should stop"""
+        if self.context.stop_requested:
+            self.context.stop_requested = False
+            return False
+        if key not in ('assistant', 'message'):
+            return False
+        # todo - move this to agent class
+        self.context.main.new_sentence_signal.emit(self.member_id, chunk)
+        print('EMIT: ', self.member_id, chunk)
+        return True
+
     def receive(self, stream=False):
         return self.get_response_stream() if stream else self.get_response()
 
@@ -261,14 +284,15 @@ class Agent:
             full_response += sentence
         return full_response
 
+    def may_run_task(self, check_for_tasks=True):
+        if not check_for_tasks or not self.config.get('actions.enable_actions', False):
+            return False
+        return self.context.message_history.last_role() == 'user'
+
     def get_response_stream(self, extra_prompt='', msgs_in_system=False, check_for_tasks=True, use_davinci=False):
         """The response method for the agent. This is where Agent Pilot"""
         logging.debug('Agent.get_response_stream() called')
-        messages = self.context.message_history.get(llm_format=True, calling_member_id=self.member_id)
-        last_role = self.context.message_history.last_role()
-
-        check_for_tasks = self.config.get('actions.enable_actions', False) if check_for_tasks else False
-        if check_for_tasks and last_role == 'user':
+        if self.may_run_task(check_for_tasks):
             replace_busy_action_on_new = self.config.get('actions.replace_busy_action_on_new')
             if self.active_task is None or replace_busy_action_on_new:
 
@@ -303,18 +327,7 @@ class Agent:
                         yield sentence
                 return assistant_response
 
-        if extra_prompt != '' and len(messages) > 0:
-            raise NotImplementedError()
-            # messages[-1]['content'] += '\nsystem: ' + extra_prompt
-
-        use_msgs_in_system = messages if msgs_in_system else None
-        system_msg = self.system_message(msgs_in_system=use_msgs_in_system,
-                                         response_instruction=extra_prompt)
-        initial_prompt = ''
-        model_name = self.config.get('context.model', 'gpt-3.5-turbo')
-        model = (model_name, self.context.main.system.models.to_dict()[model_name])  # todo make safer
-
-        kwargs = dict(messages=messages, msgs_in_system=msgs_in_system, system_msg=system_msg, model=model)
+        kwargs = self.get_stream_kwargs(extra_prompt, msgs_in_system)
         stream = self.stream(**kwargs)
 
         response = ''
@@ -333,13 +346,69 @@ class Agent:
             print(f'YIELDED: {str(key)}, {str(chunk)}  - FROM GetResponseStream')
             yield key, chunk
 
+        self.save_response(response, language, code)
+
+    async def aget_response_stream(self, extra_prompt='', msgs_in_system=False, check_for_tasks=True):
+        """Async get_response_stream(). Turns that may run a task are blocking, so they run in a worker thread"""
+        logging.debug('Agent.aget_response_stream() called')
+        if self.may_run_task(check_for_tasks):
+            sync_stream = self.get_response_stream(extra_prompt, msgs_in_system, check_for_tasks)
+            async for key, chunk in helpers.iterate_in_thread(sync_stream):
+                yield key, chunk
+            return
+
+        kwargs = self.get_stream_kwargs(extra_prompt, msgs_in_system)
+        stream = self.astream(**kwargs)
+
+        response = ''
+
+        language, code = None, None
+        async for key, chunk in self.speaker.apush_stream(stream):
+            if key == 'CONFIRM':
+                language, code = chunk
+                break
+            if key == 'PAUSE':
+                break
+
+            if key == 'assistant':
+                response += chunk
+
+            yield key, chunk
+
+        await self.asave_response(response, language, code)
+
+    def get_stream_kwargs(self, extra_prompt='', msgs_in_system=False):
+        messages = self.context.message_history.get(llm_format=True, calling_member_id=self.member_id)
+        if extra_prompt != '' and len(messages) > 0:
+            raise NotImplementedError()
+            # messages[-1]['content'] += '\nsystem: ' + extra_prompt
+
+        use_msgs_in_system = messages if msgs_in_system else None
+        system_msg = self.system_message(msgs_in_system=use_msgs_in_system,
+                                         response_instruction=extra_prompt)
+        model_name = self.config.get('context.model', 'gpt-3.5-turbo')
+        model = (model_name, self.context.main.system.models.to_dict()[model_name])  # todo make safer
+
+        return dict(messages=messages, msgs_in_system=msgs_in_system, system_msg=system_msg, model=model)
+
+    def save_response(self, response, language=None, code=None):
+        initial_prompt = ''
         logs.insert_log('PROMPT', f'{initial_prompt}\n\n--- RESPONSE ---\n\n{response}',
                         print_=False)
 
-        if response != '':
-            self.context.save_message('assistant', response, self.member_id, self.logging_obj)
-        if code:
-            self.context.save_message('code', self.combine_lang_and_code(language, code), self.member_id)
+        with sql.batch():  # the response and its code are saved together or not at all
+            if response != '':
+                self.context.save_message('assistant', response, self.member_id, self.logging_obj)
+            if code:
+                self.context.save_message('code', self.combine_lang_and_code(language, code), self.member_id)
+
+    async def asave_response(self, response, language=None, code=None):
+        """
+        Awaitable save_response(), the other members keep streaming while this one's messages are saved.
+        The whole batch runs on one worker thread, a batch held across an await would stall every
+        blocking write made on the loop meanwhile
+        """
+        await asyncio.to_thread(self.save_response, response, language, code)
 
     def stream(self, messages, msgs_in_system=False, system_msg='', model=None):
         """The raw stream method for the agent. Override this for full"""
@@ -355,6 +424,26 @@ class Agent:
             text = delta.get('content', '')
             yield 'assistant', text
 
+    async def astream(self, messages, msgs_in_system=False, system_msg='', model=None):
+        """Async stream(). Agents that only override stream() keep working, it is iterated in a worker thread"""
+        logging.debug('Agent.astream() called')
+        if type(self).stream is not Agent.stream:
+            sync_stream = self.stream(messages, msgs_in_system=msgs_in_system, system_msg=system_msg, model=model)
+            async for key, chunk in helpers.iterate_in_thread(sync_stream):
+                yield key, chunk
+            return
+
+        stream = await llm.aget_chat_response(messages if not msgs_in_system else [],
+                                              system_msg,
+                                              model_obj=model)
+        self.logging_obj = getattr(stream, 'logging_obj', None)
+        async for resp in stream:
+            delta = resp.choices[0].get('delta', {})
+            if not delta:
+                continue
+            text = delta.get('content', '')
+            yield 'assistant', text
+
     def update_instance_config(self, field, value):
         self.instance_config[field] = value
         sql.execute(f"""UPDATE contexts_members SET agent_config = json_set(agent_config, '$."instance.{field}"', ?) WHERE id = ?""",
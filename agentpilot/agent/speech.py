@@ -2,43 +2,148 @@ import asyncio
 import os
 import re
 import signal
-import subprocess
 import threading
 import time
 import uuid
-from queue import Queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from agentpilot.utils import config
+from agentpilot.utils import config, logs
 from agentpilot.utils.apis import elevenlabs, uberduck, awspolly, fakeyou, tts
-from agentpilot.utils.helpers import replace_times_with_spoken, remove_brackets
+from agentpilot.utils.helpers import replace_times_with_spoken
 
 chunk_chars = ['.', '?', '!', '\n', ': ', ';']  # , ',']
 
 
+# Segments synthesised at once per provider {api_id: max downloads}, fakeyou requests also share its rate limiter
+synthesis_concurrency = {1: 2, 2: 3, 3: 3, 5: 4}
+synthesis_executors = {}  # {api_id: ThreadPoolExecutor}, shared by every agent
+synthesis_executors_lock = threading.Lock()
+
+
+def get_synthesis_executor(api_id):
+    with synthesis_executors_lock:
+        if api_id not in synthesis_executors:
+            synthesis_executors[api_id] = ThreadPoolExecutor(max_workers=synthesis_concurrency.get(api_id, 2),
+                                                             thread_name_prefix=f'tts-{api_id}')
+        return synthesis_executors[api_id]
+
+
+# Compiled once, preproc_text runs on every streamed segment
+BRACKET_PATTERNS = [('[', re.compile(r"\[.*?\]")), ('(', re.compile(r"\(.*?\)")), ('*', re.compile(r"\*.*?\*"))]
+CODE_BLOCK_PATTERN = re.compile(r'```.*?```', flags=re.DOTALL)
+CURRENCY_PATTERN = re.compile(r'\$([\d.]+)\s?(\w+)')
+EMOJI_CHARS = (
+    "\U0001F1E0-\U0001F1FF"  # flags (iOS)
+    "\U0001F300-\U0001F5FF"  # symbols & pictographs
+    "\U0001F600-\U0001F64F"  # emoticons
+    "\U0001F680-\U0001F6FF"  # transport & map symbols
+    "\U0001F700-\U0001F77F"  # alchemical symbols
+    "\U0001F780-\U0001F7FF"  # Geometric Shapes Extended
+    "\U0001F800-\U0001F8FF"  # Supplemental Arrows-C
+    "\U0001F900-\U0001F9FF"  # Supplemental Symbols and Pictographs
+    "\U0001FA00-\U0001FA6F"  # Chess Symbols
+    "\U0001FA70-\U0001FAFF"  # Symbols and Pictographs Extended-A
+    "\U00002702-\U000027B0"  # Dingbats
+    "\U000024C2-\U0001F251"
+)
+EMOJI_PATTERN = re.compile(f'([{EMOJI_CHARS}]+)')
+# Every character a rewrite below starts from, a segment without any only needs stripping
+TRIGGER_PATTERN = re.compile(f'[\\[(*:`$' + EMOJI_CHARS + ']')
+
+
+def preproc_text(text):
+    """
+    Cleans a segment for speech: removes brackets, asterisks and code blocks, speaks times and prices, spaces out emojis.
+    Most segments are plain sentences, so one scan for trigger characters returns those straight away,
+    otherwise only the rewrites that can match are run, in their original order.
+    """
+    if not TRIGGER_PATTERN.search(text):
+        return text.strip()
+
+    for bracket, pattern in BRACKET_PATTERNS:  # remove_brackets(text, '[(*')
+        if bracket in text:
+            text = pattern.sub('', text)
+    text = text.strip()
+
+    if ':' in text:
+        text = replace_times_with_spoken(text)
+
+    # REMOVE CODE BLOCKS FROM TEXT AND THEIR CONTENTS (```...```)
+    if '```' in text:
+        text = CODE_BLOCK_PATTERN.sub('', text)
+
+    if '$' in text:
+        text = CURRENCY_PATTERN.sub(r'\1 \2 dollars', text)
+        # The pounds and euro passes only ever match a '$' the dollars pass left behind
+        for currency in ('pounds', 'euro'):
+            if '$' not in text:
+                break
+            text = CURRENCY_PATTERN.sub(rf'\1 \2 {currency}', text)
+
+    # remove emojies (some still get through)
+    if not text.isascii():
+        text = EMOJI_PATTERN.sub(r' \1 ', text)
+
+    return text.strip()
+
+
+class ReorderBuffer:
+    """Releases items in index order, holding back those that arrive before the items ahead of them"""
+    def __init__(self):
+        self.key = None
+        self.items = {}  # {index: item}
+        self.next_index = 0
+
+    def put(self, key, index, item):
+        """Adds an item and returns the items now ready in order, a new key starts again from index 0"""
+        if key != self.key:
+            self.key = key
+            self.items.clear()
+            self.next_index = 0
+
+        self.items[index] = item
+        ready = []
+        while self.next_index in self.items:
+            ready.append(self.items.pop(self.next_index))
+            self.next_index += 1
+        return ready
+
+
 class Stream_Speak:
+    """
+    Turns a response stream into spoken segments. generate_voices() queues a voice request per segment,
+    download_voices() downloads several at once, up to the provider's limit, and releases them in segment order
+    to speak_voices(), which plays them. Both wait on asyncio queues.
+    Segments already in tts.audio_cache skip the download.
+    Segments from a previous response are dropped by their msg_uuid.
+    """
     def __init__(self, agent):
         self.agent = agent
 
-        self.queued_blocks = Queue()
-        self.voice_uuids = Queue()
-        self.voice_files = Queue()
+        self.voice_uuids = asyncio.Queue()  # (msg_uuid, segment index, (voice uuid, text), audio cache key)
+        self.voice_files = asyncio.Queue()  # (msg_uuid, audio filepath), in segment order
+        self.reorder_buffer = ReorderBuffer()
+        self.download_tasks = set()
+        self.segment_count = 0
 
         self.current_pid = None
         self.current_msg_uuid = None
+        self.msg_uuid = None
+        self.current_block = ''
         self.speaking = False
         self.stream_lock = threading.Lock()
 
+        self.stream_start_time = None  # perf_counter() when the current response started streaming
+        self.first_audio_msg_uuid = None
+        self.first_audio_times = deque(maxlen=100)  # (msg_uuid, secs from stream start to first audio)
+
     def kill(self):
         try:
+            # Queued segments of the killed response are dropped when they come up, as their msg_uuid is stale
             self.current_msg_uuid = ''
             if self.current_pid is not None:
                 os.kill(self.current_pid, signal.SIGTERM)
-
-            # empty the queues
-            while not self.voice_uuids.empty():
-                self.voice_uuids.get()
-            while not self.voice_files.empty():
-                self.voice_files.get()
             self.speaking = False
 
         except OSError:
@@ -46,47 +151,89 @@ class Stream_Speak:
         except Exception as e:
             print('speech.kill ', e)
 
+    def call_on_loop(self, func, *args):
+        """Calls func on the event loop, from the loop itself or from a worker thread streaming a response"""
+        loop = getattr(self.agent.context, 'loop', None)
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if loop is None or running_loop is loop:
+            func(*args)
+        else:
+            loop.call_soon_threadsafe(func, *args)
+
     def push_stream(self, stream):
+        self.start_stream()
+        for key, chunk in stream:
+            outputs, finished = self.push_chunk(key, chunk)
+            yield from outputs
+            if finished:
+                return
+        yield from self.end_stream()
+
+    async def apush_stream(self, stream):
+        """push_stream for an async iterator of (key, chunk)"""
+        self.start_stream()
+        async for key, chunk in stream:
+            outputs, finished = self.push_chunk(key, chunk)
+            for output in outputs:
+                yield output
+            if finished:
+                return
+        for output in self.end_stream():
+            yield output
+
+    def start_stream(self):
         with self.stream_lock:
             self.kill()
-            current_block = ''
+            self.current_block = ''
             self.msg_uuid = str(uuid.uuid4())
+            self.current_msg_uuid = self.msg_uuid
+            self.segment_count = 0
+            self.stream_start_time = time.perf_counter()
 
+    def push_chunk(self, key, chunk):
+        """Returns the (key, chunk) outputs ready to yield, and whether the stream has finished"""
         speak_in_segments = True  # self.agent.config.get('voice.speak_in_segments', True)
+        ignore_keys = ['CONFIRM', 'PAUSE', 'language', 'code', 'output']
 
-        try:
-            ignore_keys = ['CONFIRM', 'PAUSE', 'language', 'code', 'output']
-            for key, chunk in stream:
-                if chunk is None:
-                    return  # todo
-                if chunk == '':
-                    continue
-
-                if key == 'CONFIRM':
-                    yield key, chunk
-                    return
-                if key in ignore_keys:
-                    continue
+        if chunk is None:
+            return [], True  # todo
+        if chunk == '':
+            return [], False
 
-                current_block += chunk
+        if key == 'CONFIRM':
+            return [(key, chunk)], True
+        if key in ignore_keys:
+            return [], False
 
-                if any(c in str(chunk) for c in chunk_chars):  # todo - wtf
+        self.current_block += chunk
 
-                    if speak_in_segments:
-                        spaces_count = len(re.findall(r'\s+', current_block))
-                        if spaces_count > 2:
+        if any(c in str(chunk) for c in chunk_chars):  # todo - wtf
 
-                            self.generate_voices(self.msg_uuid, current_block, '')
-                            yield 'assistant', current_block
-                            current_block = ''
+            if speak_in_segments:
+                spaces_count = len(re.findall(r'\s+', self.current_block))
+                if spaces_count > 2:
 
-            if current_block.strip() != '':
-                self.generate_voices(self.msg_uuid, current_block, '')
+                    current_block, self.current_block = self.current_block, ''
+                    self.generate_voices(self.msg_uuid, current_block, '')
+                    return [('assistant', current_block)], False
+        return [], False
 
-                yield 'assistant', current_block
+    def end_stream(self):
+        if self.current_block.strip() == '':
+            return []
+        current_block, self.current_block = self.current_block, ''
+        self.generate_voices(self.msg_uuid, current_block, '')
+        return [('assistant', current_block)]
 
-        except StopIteration as si:
-            raise si
+    def queue_segment(self, msg_uuid, voice_request, cache_key=None):
+        """Queues a voice request with its position in the response, so playback order survives parallel downloads"""
+        with self.stream_lock:
+            index = self.segment_count
+            self.segment_count += 1
+        self.call_on_loop(self.voice_uuids.put_nowait, (msg_uuid, index, voice_request, cache_key))
 
     def generate_voices(self, msg_uuid, current_block, response=''):
         for i in range(5):
@@ -97,19 +244,13 @@ class Stream_Speak:
 
                 if self.agent.voice_data:
                     api_id = int(self.agent.voice_data[1])
-                    character_uuid = self.agent.voice_data[2]
-                    if api_id == 1:
-                        self.voice_uuids.put((msg_uuid, fakeyou.generate_voice_async(character_uuid, preproc_block)))
-                        time.sleep(3.1)
-                    elif api_id == 2:
-                        self.voice_uuids.put((msg_uuid, uberduck.generate_voice_async(character_uuid, preproc_block)))
-                    elif api_id == 3:
-                        self.voice_uuids.put((msg_uuid, (character_uuid, preproc_block)))
-                    elif api_id == 5:
-                        self.voice_uuids.put((msg_uuid, (character_uuid, preproc_block)))
-                        # self.voice_uuids.put((msg_uuid, polly.generate_voice_async(character_uuid, preproc_block)))  # (character_uuid, preproc_block)))
-                    else:
+                    if api_id not in (1, 2, 3, 5):
                         raise Exception('Invalid API ID')
+                    character_uuid = self.agent.voice_data[2]
+                    cache_key = tts.audio_cache.get_key(api_id, character_uuid, preproc_block)
+                    # The cache lookup and every provider request run on the provider's executor,
+                    # this can be called on the event loop while it streams the response
+                    self.queue_segment(msg_uuid, (character_uuid, preproc_block), cache_key)
 
                 response += current_block
                 return response
@@ -121,126 +262,105 @@ class Stream_Speak:
                 raise e
 
     def preproc_text(self, text):
-        text = remove_brackets(text, '[(*')
-
-        text = replace_times_with_spoken(text)
-
-        # REMOVE CODE BLOCKS FROM TEXT AND THEIR CONTENTS (```...```)
-        text = re.sub(r'```.*?```', '', text, flags=re.DOTALL)
-
-        # for k, v in switch_words.items():
-        #     if k not in text: continue
-        #     text = text.replace(k, v)
-        # if '*' in text:
-        #     ono = 1
-        # # words = text split with a space, where each word only keeps letters and numbers
-        # words = re.findall(r'\w[\w,]*', text)
-        # for k, v in switch_real_words.items():
-        #     if k not in words: continue
-        #     text = ' '.join([v if word == k else word for word in words])
-        # pattern = r"\b\d{1,2}:\d{2}\s?[ap]m\b"
-        # time_matches = re.findall(pattern, text)
-        # for time_match in time_matches:
-        #     has_space = ' ' in time_match
-        #     is_12hr = 'PM' in time_match.upper() and int(time_match.split(':')[0]) < 13
-        #     h_symbol = '%I' if is_12hr else '%H'
-        #     converted_time = time.strptime(time_match, f'{h_symbol}:%M %p' if has_space else f'{h_symbol}:%M%p')  # '%H = 24hr, %I = 12hr'
-        #     spoken_time = time_to_human_spoken(converted_time)  # , include_timeframe=False)
-        #     text = text.replace(time_match, f' {spoken_time} ')
-
-        pattern = r'\$([\d.]+)\s?(\w+)'
-        text = re.sub(pattern, r'\1 \2 dollars', text)
-        pattern = r'\$([\d.]+)\s?(\w+)'
-        text = re.sub(pattern, r'\1 \2 pounds', text)
-        pattern = r'\$([\d.]+)\s?(\w+)'
-        text = re.sub(pattern, r'\1 \2 euro', text)
-
-        # remove emojies (some still get through)
-        EMOJI_PATTERN = re.compile(
-            "(["
-            "\U0001F1E0-\U0001F1FF"  # flags (iOS)
-            "\U0001F300-\U0001F5FF"  # symbols & pictographs
-            "\U0001F600-\U0001F64F"  # emoticons
-            "\U0001F680-\U0001F6FF"  # transport & map symbols
-            "\U0001F700-\U0001F77F"  # alchemical symbols
-            "\U0001F780-\U0001F7FF"  # Geometric Shapes Extended
-            "\U0001F800-\U0001F8FF"  # Supplemental Arrows-C
-            "\U0001F900-\U0001F9FF"  # Supplemental Symbols and Pictographs
-            "\U0001FA00-\U0001FA6F"  # Chess Symbols
-            "\U0001FA70-\U0001FAFF"  # Symbols and Pictographs Extended-A
-            "\U00002702-\U000027B0"  # Dingbats
-            "\U000024C2-\U0001F251" 
-            "]+)"
-        )
-
-        text = re.sub(EMOJI_PATTERN, r' \1 ', text)
-
-        return text.strip()
+        return preproc_text(text)
 
     async def download_voices(self):
         while True:
-            await asyncio.sleep(0.03)
-
-            if not self.agent.voice_data:  # If offline TTS
-                await asyncio.sleep(1)
-                continue
-
-            if self.voice_uuids.empty():
-                continue
-
-            msg_uuid, voice_file_uuid = self.voice_uuids.get()  # timeout=1)
+            msg_uuid, index, voice_request, cache_key = await self.voice_uuids.get()
             if msg_uuid != self.current_msg_uuid:
                 continue
-            if voice_file_uuid is None:
+            if not self.agent.voice_data:  # If offline TTS
                 continue
 
             api_id = int(self.agent.voice_data[1])
-            if api_id == 1:
-                audio_filepath = fakeyou.try_download_voice(voice_file_uuid)
-                time.sleep(3.1)
-            elif api_id == 2:
-                audio_filepath = uberduck.try_download_voice(voice_file_uuid)
-            elif api_id == 3:
-                voice_uuid, text = voice_file_uuid
-                audio_filepath = elevenlabs.try_download_voice(voice_uuid, text)
-            elif api_id == 5:
-                voice_uuid, text = voice_file_uuid
-                audio_filepath = awspolly.try_download_voice(voice_uuid, text)
-            else:
-                raise Exception('Invalid API ID')
-
-            if audio_filepath is not None:
-                self.voice_files.put((msg_uuid, audio_filepath))
+            task = asyncio.ensure_future(self.download_segment(msg_uuid, index, api_id, voice_request, cache_key))
+            self.download_tasks.add(task)
+            task.add_done_callback(self.download_tasks.discard)
+
+    async def download_segment(self, msg_uuid, index, api_id, voice_request, cache_key=None):
+        """Downloads one segment on its provider's executor, then releases it to the reorder buffer"""
+        audio_filepath = None
+        loop = asyncio.get_running_loop()
+        try:
+            audio_filepath = await loop.run_in_executor(get_synthesis_executor(api_id),
+                                                        self.download_voice, api_id, voice_request, cache_key)
+        except Exception as e:
+            print('speech.download_segment ', e)
+
+        self.release_segment(msg_uuid, index, audio_filepath)
+
+    def release_segment(self, msg_uuid, index, audio_filepath):
+        """Passes whatever is next in order to speak_voices()"""
+        if msg_uuid != self.current_msg_uuid:
+            return
+        # A failed segment is released as None, so the segments after it aren't held back forever
+        for filepath in self.reorder_buffer.put(msg_uuid, index, audio_filepath):
+            if filepath is not None:
+                self.voice_files.put_nowait((msg_uuid, filepath))
+
+    def download_voice(self, api_id, voice_request, cache_key=None):
+        """
+        Blocking download of one segment, run in a worker thread. A segment already in the audio cache is played
+        from there, a downloaded file is moved into it
+        """
+        if cache_key is not None:
+            cached_filepath = tts.audio_cache.get(cache_key)
+            if cached_filepath is not None:
+                return cached_filepath
+
+        voice_uuid, text = voice_request
+        if api_id == 1:
+            audio_filepath = fakeyou.synthesise_voice(voice_uuid, text)
+        elif api_id == 2:
+            audio_filepath = uberduck.synthesise_voice(voice_uuid, text)
+        elif api_id == 3:
+            audio_filepath = elevenlabs.try_download_voice(voice_uuid, text)
+        elif api_id == 5:
+            audio_filepath = awspolly.try_download_voice(voice_uuid, text)
+        else:
+            raise Exception('Invalid API ID')
+
+        if audio_filepath is not None and cache_key is not None:
+            audio_filepath = tts.audio_cache.put(cache_key, audio_filepath)
+        return audio_filepath
 
     async def speak_voices(self):
         while True:
-            await asyncio.sleep(0.03)
-
-            if not self.agent.voice_data:  # If offline TTS
-                await asyncio.sleep(0.2)
-                continue
-
-            if self.voice_files.empty():
-                continue
-
-            msg_uuid, voice_file = self.voice_files.get()
+            msg_uuid, voice_file = await self.voice_files.get()
             if msg_uuid != self.current_msg_uuid:
                 continue
             self.speaking = True
+            self.record_first_audio(msg_uuid)
 
             # print(f'PLAY CHUNK ({msg_uuid[-3:]})')
-            if voice_file.endswith('.wav'):
-                process = subprocess.Popen(['aplay', '-q', voice_file])
-            elif voice_file.endswith('.mp3'):
-                process = subprocess.Popen(['mpg123', '-q', voice_file])
-            else:
-                raise Exception('Invalid file extension')
-
-            self.current_pid = process.pid
-            process.communicate()
-            if self.voice_files.empty():
+            await self.play_file(voice_file)
+            if self.voice_files.empty() and not self.download_tasks:
                 self.speaking = False
 
+    async def play_file(self, voice_file):
+        if voice_file.endswith('.wav'):
+            command = ['aplay', '-q', voice_file]
+        elif voice_file.endswith('.mp3'):
+            command = ['mpg123', '-q', voice_file]
+        else:
+            raise Exception('Invalid file extension')
+
+        process = await asyncio.create_subprocess_exec(*command)
+        self.current_pid = process.pid
+        try:
+            await process.wait()
+        finally:
+            self.current_pid = None
+
+    def record_first_audio(self, msg_uuid):
+        """Logs the time from the start of the response stream to its first audio, once per utterance"""
+        if self.stream_start_time is None or msg_uuid == self.first_audio_msg_uuid:
+            return
+        self.first_audio_msg_uuid = msg_uuid
+        secs = time.perf_counter() - self.stream_start_time
+        self.first_audio_times.append((msg_uuid, secs))
+        logs.insert_log('TIME TO FIRST AUDIO', f'{secs * 1000:.0f}ms', print_=False)
+
 
 # def fallback_to_davinci(text):
 #     lower_text = text.lower().replace('-', ' ')
@@ -9,6 +9,18 @@ loop = asyncio.new_event_loop()
 asyncio.set_event_loop(loop)
 
 
+MEMBERS_QUERY = """
+    SELECT
+        cm.id AS member_id,
+        cm.agent_id,
+        cm.agent_config,
+        cm.del
+    FROM contexts_members cm
+    WHERE cm.context_id = ?
+    ORDER BY
+        cm.ordr"""
+
+
 class Context:
     def __init__(self, main, context_id=None, agent_id=None):
         self.main = main
@@ -68,17 +80,7 @@ class Context:
 
     def load_members(self):
         # Fetch the participants associated with the context
-        context_members = sql.get_results("""
-            SELECT 
-                cm.id AS member_id,
-                cm.agent_id,
-                cm.agent_config,
-                cm.del
-            FROM contexts_members cm
-            WHERE cm.context_id = ?
-            ORDER BY 
-                cm.ordr""",
-            params=(self.id,))
+        context_members = sql.get_results(MEMBERS_QUERY, params=(self.id,))
 
         self.members = {}
         self.member_configs = {}
@@ -137,13 +139,19 @@ class Context:
                                        for m_id in member.inputs
                                        if m_id in self.members])
 
-            member.agent.respond()  # respond()  #
+            await member.agent.arespond()
         except asyncio.CancelledError:
             pass  # task was cancelled, so we ignore the exception
         # except Exception as e:
         #     raise e
 
     def save_message(self, role, content, member_id=None, log_obj=None):
+        content = self.prepare_message(role, content, member_id)
+        if content is None:
+            return None
+        return self.message_history.add(role, content, member_id=member_id, log_obj=log_obj)
+
+    def prepare_message(self, role, content, member_id=None):
         if role == 'output':
             content = 'The code executed without any output' if content.strip() == '' else content
 
@@ -154,7 +162,7 @@ class Context:
         if member is not None and role == 'assistant':
             member.last_output = content
 
-        return self.message_history.add(role, content, member_id=member_id, log_obj=log_obj)
+        return content
 
     def deactivate_all_branches_with_msg(self, msg_id):  # todo - get these into a transaction
         print("CALLED deactivate_all_branches_with_msg: ", msg_id)
@@ -1,18 +1,151 @@
+import asyncio
+import bisect
 import json
 import threading
 
 import litellm
-import tiktoken
-from agentpilot.utils import embeddings, sql
+from agentpilot.utils import config, embeddings, sql
+from agentpilot.utils.tokens import count_tokens
+
+
+LEAF_ID_QUERY = """
+    WITH RECURSIVE leaf_contexts AS (
+        SELECT
+            c1.id,
+            c1.parent_id,
+            c1.active
+        FROM contexts c1
+        WHERE c1.id = ?
+        UNION ALL
+        SELECT
+            c2.id,
+            c2.parent_id,
+            c2.active
+        FROM contexts c2
+        JOIN leaf_contexts lc ON lc.id = c2.parent_id
+        WHERE
+            c2.id = (
+                SELECT MAX(c3.id) FROM contexts c3 WHERE c3.parent_id = lc.id AND c3.active = 1
+            )
+    )
+    SELECT id
+    FROM leaf_contexts
+    ORDER BY id DESC
+    LIMIT 1;"""
+
+BRANCHES_QUERY = """
+    WITH RECURSIVE context_chain(id, parent_id, branch_msg_id) AS (
+      SELECT id, parent_id, branch_msg_id
+      FROM contexts
+      WHERE id = ?
+      UNION ALL
+      SELECT c.id, c.parent_id, c.branch_msg_id
+      FROM contexts c
+      JOIN context_chain cc ON c.parent_id = cc.id
+    )
+    SELECT
+        cc.branch_msg_id,
+        group_concat((SELECT MIN(cm.id) FROM contexts_messages cm WHERE cm.context_id = cc.id)) AS context_set
+    FROM context_chain cc
+    WHERE cc.branch_msg_id IS NOT null
+    GROUP BY cc.branch_msg_id;"""
+
+MESSAGES_QUERY = """
+    WITH RECURSIVE context_path(context_id, parent_id, branch_msg_id, prev_branch_msg_id) AS (
+      SELECT id, parent_id, branch_msg_id,
+             null
+      FROM contexts
+      WHERE id = ?
+      UNION ALL
+      SELECT c.id, c.parent_id, c.branch_msg_id, cp.branch_msg_id
+      FROM context_path cp
+      JOIN contexts c ON cp.parent_id = c.id
+    )
+    SELECT m.id, m.role, m.msg, m.member_id, m.embedding_id, m.token_count
+    FROM contexts_messages m
+    JOIN context_path cp ON m.context_id = cp.context_id
+    WHERE m.id > ?
+        AND (cp.prev_branch_msg_id IS NULL OR m.id < cp.prev_branch_msg_id)
+    ORDER BY m.id;"""
+
+# The newest messages on the branch path with an id below the given one, newest first
+MESSAGES_WINDOW_QUERY = """
+    WITH RECURSIVE context_path(context_id, parent_id, branch_msg_id, prev_branch_msg_id) AS (
+      SELECT id, parent_id, branch_msg_id,
+             null
+      FROM contexts
+      WHERE id = ?
+      UNION ALL
+      SELECT c.id, c.parent_id, c.branch_msg_id, cp.branch_msg_id
+      FROM context_path cp
+      JOIN contexts c ON cp.parent_id = c.id
+    )
+    SELECT m.id, m.role, m.msg, m.member_id, m.embedding_id, m.token_count
+    FROM contexts_messages m
+    JOIN context_path cp ON m.context_id = cp.context_id
+    WHERE m.id < ?
+        AND (cp.prev_branch_msg_id IS NULL OR m.id < cp.prev_branch_msg_id)
+    ORDER BY m.id DESC
+    LIMIT ?;"""
+
+MESSAGES_COUNT_QUERY = """
+    WITH RECURSIVE context_path(context_id, parent_id, branch_msg_id, prev_branch_msg_id) AS (
+      SELECT id, parent_id, branch_msg_id,
+             null
+      FROM contexts
+      WHERE id = ?
+      UNION ALL
+      SELECT c.id, c.parent_id, c.branch_msg_id, cp.branch_msg_id
+      FROM context_path cp
+      JOIN contexts c ON cp.parent_id = c.id
+    )
+    SELECT COUNT(*)
+    FROM contexts_messages m
+    JOIN context_path cp ON m.context_id = cp.context_id
+    WHERE m.id < ?
+        AND (cp.prev_branch_msg_id IS NULL OR m.id < cp.prev_branch_msg_id)
+        AND m.role IN ({roles});"""
+
+# The newest messages with one of the given roles and an id in [from_id, before_id), newest first
+MESSAGES_ROLES_WINDOW_QUERY = """
+    WITH RECURSIVE context_path(context_id, parent_id, branch_msg_id, prev_branch_msg_id) AS (
+      SELECT id, parent_id, branch_msg_id,
+             null
+      FROM contexts
+      WHERE id = ?
+      UNION ALL
+      SELECT c.id, c.parent_id, c.branch_msg_id, cp.branch_msg_id
+      FROM context_path cp
+      JOIN contexts c ON cp.parent_id = c.id
+    )
+    SELECT m.id, m.role, m.msg, m.member_id, m.embedding_id, m.token_count
+    FROM contexts_messages m
+    JOIN context_path cp ON m.context_id = cp.context_id
+    WHERE m.id < ?
+        AND m.id >= ?
+        AND (cp.prev_branch_msg_id IS NULL OR m.id < cp.prev_branch_msg_id)
+        AND m.role IN ({roles})
+    ORDER BY m.id DESC
+    LIMIT ?;"""
+
+INSERT_MESSAGE_QUERY = """
+    INSERT INTO contexts_messages (context_id, member_id, role, msg, embedding_id, log, token_count)
+    VALUES (?, ?, ?, ?, ?, ?, ?)"""
+
+LAST_MSG_ID_QUERY = "SELECT seq FROM sqlite_sequence WHERE name = 'contexts_messages'"
+
+MAX_MSG_ID = 2 ** 63 - 1
+
+window_size = config.get_value('system.msg_window_size', 200)  # messages kept resident, older pages load on demand
 
 
 class Message:
-    def __init__(self, msg_id, role, content, member_id=None, embedding_id=None):
+    def __init__(self, msg_id, role, content, member_id=None, embedding_id=None, token_count=None):
         self.id = msg_id
         self.role = role
         self.content = content
         self.member_id = member_id
-        self.token_count = len(tiktoken.encoding_for_model("gpt-3.5-turbo").encode(content))
+        self._token_count = token_count
         # self.unix_time = unix_time or int(time.time())
         self.embedding_id = embedding_id
         # if self.embedding_id and isinstance(self.embedding, str):
@@ -22,6 +155,13 @@ class Message:
             if role == 'user' or role == 'assistant' or role == 'request' or role == 'result':
                 self.embedding_id, self.embedding_data = embeddings.get_embedding(content)
 
+    @property
+    def token_count(self):
+        """Saved with the message by MessageHistory.add(), only rows from before the column existed are counted here"""
+        if self._token_count is None:
+            self._token_count = count_tokens(self.content)
+        return self._token_count
+
 
 class MessageHistory:
     def __init__(self, context):
@@ -30,36 +170,15 @@ class MessageHistory:
         self.context = context
         self.branches = {}  # {branch_msg_id: [child_msg_ids]}
         self.messages = []  # [Message(m['id'], m['role'], m['content']) for m in (messages or [])]
+        self.window_size = window_size
+        self.has_older = False  # whether messages before self.messages[0] exist on the branch path
 
         self.msg_id_buffer = []
         # self.load()
 
     def load(self):
         print("CALLED message_history.load")
-        self.context.leaf_id = sql.get_scalar("""
-            WITH RECURSIVE leaf_contexts AS (
-                SELECT 
-                    c1.id, 
-                    c1.parent_id, 
-                    c1.active 
-                FROM contexts c1 
-                WHERE c1.id = ?
-                UNION ALL
-                SELECT 
-                    c2.id, 
-                    c2.parent_id, 
-                    c2.active 
-                FROM contexts c2 
-                JOIN leaf_contexts lc ON lc.id = c2.parent_id 
-                WHERE 
-                    c2.id = (
-                        SELECT MAX(c3.id) FROM contexts c3 WHERE c3.parent_id = lc.id AND c3.active = 1
-                    )
-            )
-            SELECT id
-            FROM leaf_contexts 
-            ORDER BY id DESC 
-            LIMIT 1;""", (self.context.id,))
+        self.context.leaf_id = sql.get_scalar(LEAF_ID_QUERY, (self.context.id,))
 
         print(f"LEAF ID SET TO {self.context.leaf_id} BY message_history.load")
         self.load_branches()
@@ -68,24 +187,10 @@ class MessageHistory:
 
     def load_branches(self):
         print("CALLED load_branches")
-        root_id = self.context.id
-        result = sql.get_results("""
-            WITH RECURSIVE context_chain(id, parent_id, branch_msg_id) AS (
-              SELECT id, parent_id, branch_msg_id
-              FROM contexts
-              WHERE id = ?
-              UNION ALL
-              SELECT c.id, c.parent_id, c.branch_msg_id
-              FROM contexts c
-              JOIN context_chain cc ON c.parent_id = cc.id
-            )
-            SELECT
-                cc.branch_msg_id,
-                group_concat((SELECT MIN(cm.id) FROM contexts_messages cm WHERE cm.context_id = cc.id)) AS context_set
-            FROM context_chain cc
-            WHERE cc.branch_msg_id IS NOT null
-            GROUP BY cc.branch_msg_id;
-        """, (root_id,), return_type='dict')
+        result = sql.get_results(BRANCHES_QUERY, (self.context.id,), return_type='dict')
+        self.set_branches(result)
+
+    def set_branches(self, result):
         self.branches = {int(k): [int(i) for i in v.split(',')] for k, v in result.items() if v}
 
     # active_leaf_id = '''
@@ -110,38 +215,48 @@ class MessageHistory:
     # '''
 
     def load_messages(self, refresh=False):
-        last_msg_id = self.messages[-1].id if len(self.messages) > 0 and refresh else 0
-
-        msg_log = sql.get_results("""
-            WITH RECURSIVE context_path(context_id, parent_id, branch_msg_id, prev_branch_msg_id) AS (
-              SELECT id, parent_id, branch_msg_id, 
-                     null
-              FROM contexts 
-              WHERE id = ?
-              UNION ALL
-              SELECT c.id, c.parent_id, c.branch_msg_id, cp.branch_msg_id
-              FROM context_path cp
-              JOIN contexts c ON cp.parent_id = c.id
-            )
-            SELECT m.id, m.role, m.msg, m.member_id, m.embedding_id
-            FROM contexts_messages m
-            JOIN context_path cp ON m.context_id = cp.context_id
-            WHERE m.id > ?
-                AND (cp.prev_branch_msg_id IS NULL OR m.id < cp.prev_branch_msg_id)
-            ORDER BY m.id;""", (self.context.leaf_id, last_msg_id,))
-
-        # print(f"FETCHED {len(msg_log)} MESSAGES", )
+        """Loads the newest window of messages, or with refresh only the ones after the last resident message"""
+        if refresh and len(self.messages) > 0:
+            msg_log = sql.get_results(MESSAGES_QUERY, (self.context.leaf_id, self.messages[-1].id,))
+            self.set_messages(self.build_messages(msg_log), refresh)
+        else:
+            msg_log = sql.get_results(MESSAGES_WINDOW_QUERY, (self.context.leaf_id, MAX_MSG_ID, self.window_size + 1))
+            self.set_window(msg_log)
+
+    def set_window(self, msg_log):
+        # msg_log is newest first with one extra row, which only tells us if there are older messages
+        self.has_older = len(msg_log) > self.window_size
+        self.set_messages(self.build_messages(reversed(msg_log[:self.window_size])))
+
+    def load_older(self, page_size=None):
+        """Prepends the page of messages before the oldest resident one, returns the new messages"""
+        if not self.has_older or len(self.messages) == 0:
+            return []
+        page_size = page_size or self.window_size
+        msg_log = sql.get_results(MESSAGES_WINDOW_QUERY, (self.context.leaf_id, self.messages[0].id, page_size + 1))
+        self.has_older = len(msg_log) > page_size
+        older = self.build_messages(reversed(msg_log[:page_size]))
+        self.messages[0:0] = older
+        return older
+
+    def build_messages(self, msg_log):
+        return [Message(msg_id, role, content, member_id, embedding_id, token_count)
+                for msg_id, role, content, member_id, embedding_id, token_count in msg_log]
+
+    def set_messages(self, messages, refresh=False):
+        # print(f"FETCHED {len(messages)} MESSAGES", )
         if refresh:
-            self.messages.extend([Message(msg_id, role, content, member_id, embedding_id)
-                                  for msg_id, role, content, member_id, embedding_id in msg_log])
+            self.messages.extend(messages)
         else:
-            self.messages = [Message(msg_id, role, content, member_id, embedding_id)
-                             for msg_id, role, content, member_id, embedding_id in msg_log]
+            self.messages = messages
 
     def load_msg_id_buffer(self):
         # with self.msg_id_thread_lock:
+        last_msg_id = sql.get_scalar(LAST_MSG_ID_QUERY)
+        self.set_msg_id_buffer(last_msg_id)
+
+    def set_msg_id_buffer(self, last_msg_id):
         self.msg_id_buffer = []
-        last_msg_id = sql.get_scalar("SELECT seq FROM sqlite_sequence WHERE name = 'contexts_messages'")
         last_msg_id = last_msg_id if last_msg_id is not None else 0
         for msg_id in range(last_msg_id + 1, last_msg_id + 100):
             self.msg_id_buffer.append(msg_id)
@@ -155,38 +270,63 @@ class MessageHistory:
     def add(self, role, content, embedding_id=None, member_id=None, log_obj=None):
         print("CALLED message_history.add")
         with self.thread_lock:
-            # max_id = sql.get_scalar("SELECT COALESCE(MAX(id), 0) FROM contexts_messages")
-            next_id = self.get_next_msg_id()
-            new_msg = Message(next_id, role, content, embedding_id=embedding_id, member_id=member_id)
-
             if self.context is None:
                 raise Exception("No context ID set")
 
-            json_str = ''
-            if log_obj is not None:
-                if isinstance(log_obj, litellm.utils.Logging):
-                    log_obj_messages = log_obj.messages
-                    sys_msg = ''
-                    if len(log_obj_messages) > 0 and log_obj_messages[0]['role'] == 'system':
-                        sys_msg = log_obj_messages.pop(0)['content']
-
-                    json_obj = {'system': sys_msg, 'messages': log_obj_messages}
-                    json_str = json.dumps(json_obj)
-                elif isinstance(log_obj, str):
-                    json_str = log_obj
-                else:
-                    raise Exception("log_obj must be a string or litellm.utils.Logging object")
-
-            # sql.execute("INSERT INTO contexts_messages (id, context_id, member_id, role, msg, embedding_id, log) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            #             (new_msg.id, self.context.leaf_id, member_id, role, content, new_msg.embedding_id, json_str))
-            sql.execute \
-                ("INSERT INTO contexts_messages (context_id, member_id, role, msg, embedding_id, log) VALUES (?, ?, ?, ?, ?, ?)",
-                        (self.context.leaf_id, member_id, role, content, new_msg.embedding_id, json_str))
-            # self.messages.append(new_msg)
-            self.load_messages()
+            new_msg = self.new_message(role, content, embedding_id, member_id)
+            json_str = self.log_obj_to_json(log_obj)
+
+            new_msg.id = sql.insert(INSERT_MESSAGE_QUERY, (self.context.leaf_id, member_id, role, content,
+                                                           new_msg.embedding_id, json_str, new_msg.token_count))
+            self.append_message(new_msg)
 
             return new_msg
 
+    async def aadd(self, role, content, embedding_id=None, member_id=None, log_obj=None):
+        """Awaitable version of add(), doesn't block the context's event loop"""
+        if self.context is None:
+            raise Exception("No context ID set")
+
+        # Embedding needs the network, to_thread carries the caller's sql.batch() over to it
+        new_msg = await asyncio.to_thread(self.new_message, role, content, embedding_id, member_id)
+        json_str = self.log_obj_to_json(log_obj)
+        new_msg.id = await sql.ainsert(INSERT_MESSAGE_QUERY, (self.context.leaf_id, member_id, role, content,
+                                                              new_msg.embedding_id, json_str, new_msg.token_count))
+        with self.thread_lock:
+            self.append_message(new_msg)
+
+        return new_msg
+
+    def new_message(self, role, content, embedding_id=None, member_id=None):
+        """A message to be inserted, with its embedding and token count ready to save alongside it"""
+        return Message(None, role, content, member_id=member_id, embedding_id=embedding_id,
+                       token_count=count_tokens(content))
+
+    def append_message(self, msg):
+        """Keeps self.messages ordered by id, the same order load_messages() returns them in"""
+        if len(self.messages) == 0 or self.messages[-1].id < msg.id:
+            self.messages.append(msg)
+        else:
+            # bisect's key= needs python 3.10
+            index = bisect.bisect_left([m.id for m in self.messages], msg.id)
+            self.messages.insert(index, msg)
+
+    def log_obj_to_json(self, log_obj):
+        if log_obj is None:
+            return ''
+        if isinstance(log_obj, litellm.utils.Logging):
+            log_obj_messages = log_obj.messages
+            sys_msg = ''
+            if len(log_obj_messages) > 0 and log_obj_messages[0]['role'] == 'system':
+                sys_msg = log_obj_messages.pop(0)['content']
+
+            json_obj = {'system': sys_msg, 'messages': log_obj_messages}
+            return json.dumps(json_obj)
+        elif isinstance(log_obj, str):
+            return log_obj
+        else:
+            raise Exception("log_obj must be a string or litellm.utils.Logging object")
+
             # def add_padding_to_consecutive_messages(msg_list):
             #     result = []
             #     last_seen_role = None
@@ -235,6 +375,8 @@ class MessageHistory:
         if llm_format:
             incl_roles = ('user', 'assistant', 'output', 'code')
 
+        messages = self.get_prompt_messages(msg_limit, incl_roles, from_msg_id)
+
         pre_formatted_msgs = [
             {
                 'id': msg.id,
@@ -244,7 +386,7 @@ class MessageHistory:
                 'member_id': msg.member_id,
                 'content': f"{assistant_msg_prefix}{msg.content}" if msg.role == 'assistant' and llm_format else msg.content,
                 'embedding_id': msg.embedding_id
-            } for msg in self.messages if msg.id >= from_msg_id and msg.role in incl_roles
+            } for msg in messages
         ]
 
         # merge_multiple_members = member_configs.get(calling_member_id, {}).get('group.merge_multiple_members', True)
@@ -310,17 +452,37 @@ class MessageHistory:
 
         return pre_formatted_msgs
 
+    def get_prompt_messages(self, msg_limit, incl_roles, from_msg_id=0):
+        """
+        Returns the messages from from_msg_id with one of incl_roles, at least the newest msg_limit of them.
+        When the resident window holds fewer, the older ones are read from the database but not added to
+        self.messages, which stays the window the chat page has bubbles for.
+        """
+        from_msg_id = from_msg_id or 0
+        with self.thread_lock:
+            messages = [msg for msg in self.messages if msg.id >= from_msg_id and msg.role in incl_roles]
+            has_older = self.has_older
+            oldest_id = self.messages[0].id if self.messages else None
+
+        missing = msg_limit - len(messages)
+        if missing <= 0 or not has_older or oldest_id <= from_msg_id:
+            return messages
+
+        query = MESSAGES_ROLES_WINDOW_QUERY.format(roles=', '.join('?' * len(incl_roles)))
+        msg_log = sql.get_results(query, (self.context.leaf_id, oldest_id, from_msg_id, *incl_roles, missing))
+        return self.build_messages(reversed(msg_log)) + messages
+
     def count(self, incl_roles=('user', 'assistant')):
-        return len([msg for msg in self.messages if msg.role in incl_roles])
-
-    def pop(self, indx, incl_roles=('user', 'assistant')):
-        seen_cnt = -1
-        for i, msg in enumerate(self.messages):
-            if msg.role not in incl_roles:
-                continue
-            seen_cnt += 1
-            if seen_cnt == indx:
-                return self.messages.pop(i)
+        with self.thread_lock:
+            resident_count = len([msg for msg in self.messages if msg.role in incl_roles])
+            has_older = self.has_older
+            oldest_id = self.messages[0].id if self.messages else None
+        if not has_older:
+            return resident_count
+
+        query = MESSAGES_COUNT_QUERY.format(roles=', '.join('?' * len(incl_roles)))
+        older_count = sql.get_scalar(query, (self.context.leaf_id, oldest_id, *incl_roles))
+        return resident_count + older_count
 
     def get_conversation_str(self, msg_limit=4, incl_roles=('user', 'assistant'), prefix='CONVERSATION:\n'):
         msgs = self.get(msg_limit=msg_limit, incl_roles=incl_roles)
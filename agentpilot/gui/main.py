@@ -6,7 +6,7 @@ from PySide6.QtWidgets import *
 from PySide6.QtCore import Signal, QSize, QTimer, QMimeData, QPoint
 from PySide6.QtGui import QPixmap, QIcon, QFont, QTextCursor, QTextDocument, QFontMetrics, QGuiApplication, Qt, QCursor
 
-from agentpilot.utils.sql_upgrade import upgrade_script, versions
+from agentpilot.utils.sql_upgrade import upgrade_script
 from agentpilot.utils import sql, api, config, resources_rc
 from agentpilot.system.base import SystemManager
 
@@ -377,11 +377,8 @@ class Main(QMainWindow):
                                         QMessageBox.Yes | QMessageBox.No) != QMessageBox.Yes:
                     # exit the app
                     sys.exit(0)
-                # get current db version
-                db_version = upgrade_db
                 # run db upgrade
-                while db_version != versions[-1]:  # while not the latest version
-                    db_version = upgrade_script.upgrade(db_version)
+                upgrade_script.upgrade_to_latest(upgrade_db)
 
         except Exception as e:
             if hasattr(e, 'message'):
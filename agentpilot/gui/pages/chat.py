@@ -48,6 +48,7 @@ class Page_Chat(QWidget):
 
         self.scroll_area.setWidget(self.chat)
         self.scroll_area.setWidgetResizable(True)
+        self.scroll_area.verticalScrollBar().valueChanged.connect(self.on_scroll)
 
         self.layout.addWidget(self.scroll_area)
         # self.layout.addStretch(1)
@@ -547,7 +548,7 @@ class Page_Chat(QWidget):
             prompt = prompt.format(user_msg=user_msg['content'])
 
             try:
-                title = llm.get_scalar(prompt, model_obj=model_obj)
+                title = llm.get_scalar(prompt, model_obj=model_obj, max_tokens=32)
                 title = title.replace('\n', ' ').strip("'").strip('"')
                 self.page_chat.main.title_update_signal.emit(title)
             except Exception as e:
@@ -565,17 +566,18 @@ class Page_Chat(QWidget):
             self.topbar.title_label.setText(title)
         self.topbar.title_edited(title)
 
-    def insert_bubble(self, message=None):
+    def insert_bubble(self, message=None, index=None):
         logging.debug('Inserting bubble')
 
         msg_container = MessageContainer(self, message=message)
 
-        if message.role == 'assistant':
-            member_id = message.member_id
-            if member_id:
-                self.last_member_msgs[member_id] = msg_container
+        if index is None:
+            if message.role == 'assistant':
+                member_id = message.member_id
+                if member_id:
+                    self.last_member_msgs[member_id] = msg_container
 
-        index = len(self.chat_bubbles)
+            index = len(self.chat_bubbles)
         self.chat_bubbles.insert(index, msg_container)
         self.chat_scroll_layout.insertWidget(index, msg_container)
 
@@ -623,6 +625,26 @@ class Page_Chat(QWidget):
             if index <= len(self.context.message_history.messages) - 1:
                 self.context.message_history.messages[:] = self.context.message_history.messages[:index]
 
+    def on_scroll(self, value):
+        scroll_bar = self.scroll_area.verticalScrollBar()
+        if value == scroll_bar.minimum() and scroll_bar.maximum() > 0 and self.context.message_history.has_older:
+            QTimer.singleShot(0, self.load_older_bubbles)
+
+    def load_older_bubbles(self):
+        logging.debug('Loading older bubbles')
+        scroll_bar = self.scroll_area.verticalScrollBar()
+        with self.context.message_history.thread_lock:
+            older_msgs = self.context.message_history.load_older()
+            if not older_msgs:
+                return
+            prev_max = scroll_bar.maximum()
+            for index, msg in enumerate(older_msgs):
+                self.insert_bubble(msg, index=index)
+
+        # keep the message that was at the top in view
+        QApplication.processEvents()
+        scroll_bar.setValue(scroll_bar.value() + scroll_bar.maximum() - prev_max)
+
     def scroll_to_end(self):
         logging.debug('Scrolling to end')
         QApplication.processEvents()  # process GUI events to update content size todo?
@@ -11,6 +11,32 @@ import logging
 from agentpilot.gui.widgets import BaseTableWidget, ContentPage
 
 
+CONTEXTS_QUERY = """
+    SELECT
+        c.id,
+        c.summary,
+        group_concat(a.name, ' + ') as name,
+        '' AS goto_button,
+        '' AS del_button
+    FROM contexts c
+    LEFT JOIN contexts_members cp
+        ON c.id = cp.context_id
+    LEFT JOIN agents a
+        ON cp.agent_id = a.id
+    LEFT JOIN (
+        SELECT
+            context_id,
+            MAX(id) as latest_message_id
+        FROM contexts_messages
+        GROUP BY context_id
+    ) cm ON c.id = cm.context_id
+    WHERE c.parent_id IS NULL
+    GROUP BY c.id
+    ORDER BY
+        COALESCE(cm.latest_message_id, 0) DESC,
+        c.id DESC;"""
+
+
 class Page_Contexts(ContentPage):
     def __init__(self, main):
         super().__init__(main=main, title='Contexts')
@@ -69,31 +95,7 @@ class Page_Contexts(ContentPage):
     def load(self):  # Load Contexts
         logging.debug('Loading contexts page')
         self.table_widget.setRowCount(0)
-        data = sql.get_results("""
-            SELECT
-                c.id,
-                c.summary,
-                group_concat(a.name, ' + ') as name,
-                '' AS goto_button,
-                '' AS del_button
-            FROM contexts c
-            LEFT JOIN contexts_members cp
-                ON c.id = cp.context_id
-            LEFT JOIN agents a
-                ON cp.agent_id = a.id
-            LEFT JOIN (
-                SELECT
-                    context_id,
-                    MAX(id) as latest_message_id
-                FROM contexts_messages
-                GROUP BY context_id
-            ) cm ON c.id = cm.context_id
-            WHERE c.parent_id IS NULL
-            GROUP BY c.id
-            ORDER BY
-                COALESCE(cm.latest_message_id, 0) DESC, 
-                c.id DESC;
-            """)
+        data = sql.get_results(CONTEXTS_QUERY)
         # first_desc = 'CURRENT CONTEXT'
 
         icon_chat = QIcon(':/resources/icon-chat.png')
@@ -5,7 +5,7 @@ from PySide6.QtWidgets import *
 from PySide6.QtCore import QSize
 from PySide6.QtGui import QPixmap, QIcon, QFont, QIntValidator, Qt, QFontDatabase, QDoubleValidator
 
-from agentpilot.utils import sql, api, config, resources_rc
+from agentpilot.utils import sql, api, config, embeddings, resources_rc
 from agentpilot.utils.apis import llm
 from agentpilot.gui.widgets import ContentPage, ModelComboBox, ColorPickerButton, CComboBox, RoleComboBox, BaseTableWidget
 from agentpilot.utils.helpers import block_signals, display_messagebox
@@ -201,6 +201,7 @@ class Page_Settings(ContentPage):
             sql.execute('DELETE FROM contexts_members')
             sql.execute('DELETE FROM contexts')
             sql.execute('DELETE FROM embeddings WHERE id > 1984')
+            embeddings.embedding_cache.clear()
             sql.execute('DELETE FROM logs')
             sql.execute('VACUUM')
             self.parent.update_config('system.dev_mode', False)
@@ -244,7 +245,7 @@ class Page_Settings(ContentPage):
                 for context_id, msg in contexts_first_msgs.items():
                     context_prompt = prompt.format(user_msg=msg)
 
-                    title = llm.get_scalar(context_prompt, model_obj=model_obj)
+                    title = llm.get_scalar(context_prompt, model_obj=model_obj, max_tokens=32)
                     title = title.replace('\n', ' ').strip("'").strip('"')
                     sql.execute('UPDATE contexts SET summary = ? WHERE id = ?', (title, context_id))
 
@@ -1,14 +1,19 @@
 # from termcolor import colored
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 
 from agentpilot.utils.apis import llm
 from agentpilot.utils import helpers, logs, config
 from agentpilot.operations.parameters import *
 
+# Speculative lookback prompts of every action, see BaseAction.get_lookback_responses()
+lookback_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='extract-inputs')
+
 
 class BaseAction:
     def __init__(self, agent, example='', return_ftype=TextFValue):
         self.agent = agent
-        self.add_response = lambda response: self.agent.intermediate_task_responses.put(response)
+        self.add_response = lambda response: self.agent.add_intermediate_response(response)
         self.inputs = ActionInputCollection()
         self.input_predict_count = 0
 
@@ -93,18 +98,61 @@ Based on common sense and popular opinion, populate all action parameters below:
 
         input_lookback_msg_cnt = self.agent.config.get('action_inputs.lookback_msg_count')
         is_msg_increment = self.agent.config.get('action_inputs.lookback_msg_count_increment')
+        is_speculative = self.agent.config.get('action_inputs.speculative_lookback', False)
 
         if self.input_predict_count > 1:
             is_msg_increment = False
 
-        for i in range(0, input_lookback_msg_cnt if is_msg_increment else 1):
-            root_msg_id = self.agent.active_task.root_msg_id if self.agent.active_task else 0
-            msg_limit = i + 1 if is_msg_increment else input_lookback_msg_cnt
-            conversation_str = self.agent.context.message_history.get_conversation_str(msg_limit=msg_limit)
-            react_str = self.agent.context.message_history.get_react_str(msg_limit=8, from_msg_id=root_msg_id)
-            input_format_str = "\n".join(f"    {inp.input_name}{inp.pretty_input_format()}" for inp in [self.when_to_run_input] + self.inputs.inputs)
+        msg_limits = range(1, input_lookback_msg_cnt + 1) if is_msg_increment else [input_lookback_msg_cnt]
+        prompts = [self.get_extract_inputs_prompt(msg_limit) for msg_limit in msg_limits]
+
+        # Windows are applied smallest first, so the result is the same whichever way the responses were fetched
+        with closing(self.get_lookback_responses(prompts, is_speculative)) as responses:
+            for response in responses:
+                is_cancelled = self.fill_extracted_inputs(response)
+                if is_cancelled:
+                    return
+
+                self.inputs.fill_defaults()
+
+                if self.can_run():
+                    break
+
+        decay_at_idle_count = self.agent.config.get('action_inputs.decay_at_idle_count')
+        if self.input_predict_count > decay_at_idle_count:
+            self.cancel()
+            return
 
-            prompt = f"""Assistant wants to perform the action: `{class_name}` for the user.
+    def get_lookback_responses(self, prompts, is_speculative=False):
+        """
+        Yields the response to each lookback prompt in order. When speculative, the next prompt is sent while the
+        current one is awaited, so when the caller stops early at most one extra prompt was sent
+        (its response is ignored).
+        """
+        if not is_speculative or len(prompts) == 1:
+            for prompt in prompts:
+                yield llm.get_scalar(prompt)
+            return
+
+        future = lookback_executor.submit(llm.get_scalar, prompts[0])
+        next_future = None
+        try:
+            for next_prompt in prompts[1:] + [None]:
+                next_future = lookback_executor.submit(llm.get_scalar, next_prompt) if next_prompt else None
+                yield future.result()
+                future = next_future
+        finally:
+            if next_future is not None:
+                next_future.cancel()
+
+    def get_extract_inputs_prompt(self, msg_limit):
+        class_name = self.__class__.__name__
+        root_msg_id = self.agent.active_task.root_msg_id if self.agent.active_task else 0
+        conversation_str = self.agent.context.message_history.get_conversation_str(msg_limit=msg_limit)
+        react_str = self.agent.context.message_history.get_react_str(msg_limit=8, from_msg_id=root_msg_id)
+        input_format_str = "\n".join(f"    {inp.input_name}{inp.pretty_input_format()}" for inp in [self.when_to_run_input] + self.inputs.inputs)
+
+        return f"""Assistant wants to perform the action: `{class_name}` for the user.
 Action Description: "{self.desc}"
 All parameters for `{class_name}`:
 {input_format_str}
@@ -128,49 +176,42 @@ If a parameter has multiple explicit values, separate each value with three ampe
 Based on the conversation, return all action parameters below:
 -- `{class_name}` parameters --
 """
-            # todo - add check for multivals on inputs that don't end with /s
-
-            response = llm.get_scalar(prompt)  # , model='gpt-4')
+        # todo - add check for multivals on inputs that don't end with /s
 
-            if response == 'CANCEL':
-                self.cancel()
-                return
-
-            extracted_lines = [x.strip().strip(',') for x in response.split('\n') if (':' in x)]  # or no_param_names)]
-            for extracted_line in extracted_lines:
-                if extracted_line.strip().strip(':').lower() == class_name.lower():
-                    continue
-
-                line_split = [x.strip() for x in extracted_line.split(':', 1)]
-                if len(line_split) == 1 and len(self.inputs) == 1 and len(extracted_lines) == 1:
-                    input_name = self.inputs.get(0).input_name
-                    input_value = extracted_line
-                    self.inputs.fill(input_name, input_value)
-                    break
+    def fill_extracted_inputs(self, response):
+        """Fills the inputs found in an extraction response, returns True if the response cancelled the action"""
+        class_name = self.__class__.__name__
+        if response == 'CANCEL':
+            self.cancel()
+            return True
 
-                if "CANCEL" in [x.upper() for x in line_split]:
-                    self.cancel()
-                    return
+        extracted_lines = [x.strip().strip(',') for x in response.split('\n') if (':' in x)]  # or no_param_names)]
+        for extracted_line in extracted_lines:
+            if extracted_line.strip().strip(':').lower() == class_name.lower():
+                continue
 
-                input_name, input_value = line_split
+            line_split = [x.strip() for x in extracted_line.split(':', 1)]
+            if len(line_split) == 1 and len(self.inputs) == 1 and len(extracted_lines) == 1:
+                input_name = self.inputs.get(0).input_name
+                input_value = extracted_line
+                self.inputs.fill(input_name, input_value)
+                break
 
-                # patch for class name bug
-                if len(extracted_lines) == 1:
-                    if len(self.inputs) > 0 and input_name.lower() == class_name.lower():
-                        input_name = self.inputs.get(0).input_name  # .inputs.get(0).input_name
+            if "CANCEL" in [x.upper() for x in line_split]:
+                self.cancel()
+                return True
 
-                self.inputs.fill(input_name, input_value)
-                # if rerun: rerun_action = True
+            input_name, input_value = line_split
 
-            self.inputs.fill_defaults()
+            # patch for class name bug
+            if len(extracted_lines) == 1:
+                if len(self.inputs) > 0 and input_name.lower() == class_name.lower():
+                    input_name = self.inputs.get(0).input_name  # .inputs.get(0).input_name
 
-            if self.can_run():
-                break
+            self.inputs.fill(input_name, input_value)
+            # if rerun: rerun_action = True
 
-        decay_at_idle_count = self.agent.config.get('action_inputs.decay_at_idle_count')
-        if self.input_predict_count > decay_at_idle_count:
-            self.cancel()
-            return
+        return False
 
     def can_run(self):
         return self.inputs.all_filled()
@@ -73,7 +73,7 @@ Examine the conversation in detail, applying logic and reasoning to ascertain th
 If no software from the list is even slightly relevant to the conversation and not based on the last user message, simply output "0". 
 
 The detected ID is:
-""").lower()
+""", stop_pattern=llm.INTEGER_ID_PATTERN, max_tokens=16).lower()
             response = re.sub(r'[^0-9,]', '', response)
             found_ids = [int(x) for x in response.split(',') if x != '' and int(x) > 0]
             found_apps = [closest_apps[x - 1] for x in found_ids if x <= len(closest_apps)]
@@ -32,7 +32,7 @@ class Search_Site(BaseAction):
 Input website name: "{website_name}"
 Search query: "{search_query}"
 Return the url when you search for the query on the given website as of your latest knowledge. Consider any phonetic mismatches in the transcription (eg. 'why combinator' = 'ycombinator').
-URL: """)
+URL: """, max_tokens=60)
             ree = re.search("(?P<url>(?:https?://|www\.)[^\s]+)", res)
             if ree is None:
                 yield ActionError("I couldn't find a URL for that website.")
@@ -67,7 +67,7 @@ class Open_Websites(BaseAction):
                     res = llm.get_scalar(f"""
     Input website name: "{input_url_or_name}"
     Return the URL associated with this website as of your latest knowledge. Consider any phonetic mismatches in the transcription (eg. 'why combinator' = 'ycombinator').
-    URL: """)
+    URL: """, max_tokens=60)
                     ree = re.search("(?P<url>(?:https?://|www\.)[^\s]+)", res)
                     if ree is None:
                         search = Search_Site(self.agent)
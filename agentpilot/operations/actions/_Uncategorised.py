@@ -60,7 +60,7 @@ Given the following location: "{location}"
 Return the timezone of this location in the format "UTC+/-<hours>"
 Consider any daylight savings time if applicable, the current date and time is {date} {time_} (UTC).
 Output timezone:
-""")
+""", max_tokens=16)
         extracted_hour_diff_int = re.search(r'UTC([+-]\d+)', timezone).group(1)
         t = time.gmtime(time.time() + int(extracted_hour_diff_int) * 3600)
         spoken_time = helpers.time_to_human_spoken(t)
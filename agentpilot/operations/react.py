@@ -1,8 +1,15 @@
 # from termcolor import colored
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from agentpilot.utils import config, embeddings, semantic, logs
 from agentpilot.utils.apis import llm
 from agentpilot.utils.helpers import remove_brackets
 
+pipeline_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='react-pipeline')
+
+THOUGHT_PREFIXES = ['Now, ', 'First, ', 'Second, ', 'Then, ']
+
 
 class ExplicitReAct:
     def __init__(self, parent_task):
@@ -18,6 +25,18 @@ class ExplicitReAct:
         self.last_thought_embedding = None
         self.last_result_embedding = None
 
+        # With react.pipelined, action matching for a thought starts from its first words while it streams,
+        # embedding it starts as soon as its line has been generated, and saving a result overlaps with
+        # generating the next thought
+        agent_config = self.parent_task.agent.config
+        self.pipelined = agent_config.get('react.pipelined', False)
+        self.prefetch_min_words = agent_config.get('react.prefetch_min_words', 4)
+        self.prefetch_max_missing_words = agent_config.get('react.prefetch_max_missing_words', 1)
+        self.pending_result = None  # Future of the result message still being saved
+        self.prefetched_matches = []  # [(prev_content, thought words, Future of the matched actions)]
+        self.prev_content = None  # the message before the thought being generated, see get_prev_content()
+        self.step_timings = []  # one {step: seconds} dict per thought
+
         self.objective = self.parent_task.objective
         conversation_str = self.parent_task.agent.context.message_history.get_conversation_str(msg_limit=2)
 
@@ -218,14 +237,25 @@ Thought: """
         # self.react_context = {'role': 'Task', 'content': objective}
 
     def run(self):
+        try:
+            return self.run_steps()
+        finally:
+            self.wait_pending_result()
+            if self.step_timings:
+                logs.insert_log('REACT TIMINGS', self.get_timings_str(), print_=False)
+
+    def run_steps(self):
         from agentpilot.operations.task import Task, TaskStatus  # Avoid circular import
 
         max_steps = self.parent_task.agent.config.get('react.max_steps')
         for i in range(max_steps - self.thought_count):
+            step_start = time.perf_counter()
             if self.thought_task is None:
+                self.step_timings.append({})
                 thought = self.get_thought()
                 unique_actions = set(self.action_names)  # temporary until better fingerprint
                 if thought.upper().startswith('OBJECTIVE COMPLETE'):
+                    self.record_timing('total', time.perf_counter() - step_start)
                     if len(unique_actions) == 1:
                         fin_response = self.results[-1]
                         return True, fin_response
@@ -234,6 +264,7 @@ Thought: """
                         return True, fin_response
 
                 elif thought.upper().startswith('OBJECTIVE FAILED'):
+                    self.record_timing('total', time.perf_counter() - step_start)
                     if len(unique_actions) == 1:
                         fin_response = self.results[-1]
                         return True, fin_response
@@ -241,17 +272,22 @@ Thought: """
                         fin_response = f"""[SAY] "I can not complete the task" (Task = `{self.parent_task.objective}`)"""
                         return True, fin_response
 
+                match_start = time.perf_counter()
                 self.thought_task = Task(agent=self.parent_task.agent,
                                          objective=thought,
                                          parent_react=self)
+                self.record_timing('match', time.perf_counter() - match_start)
             try:
+                run_start = time.perf_counter()
                 request_finished, thought_response = self.thought_task.run()
+                self.record_timing('action', time.perf_counter() - run_start)
                 if request_finished:
                     succeeded = self.thought_task.status == TaskStatus.COMPLETED
                     self.save_action(self.thought_task.fingerprint(_type='desc'))
                     self.action_names.append(self.thought_task.fingerprint(_type='name'))
                     self.save_result(('Done, ' if succeeded else 'Failed, ') + thought_response)
                     self.thought_task = None
+                    self.record_timing('total', time.perf_counter() - step_start)
                 else:
                     return False, thought_response
 
@@ -261,15 +297,45 @@ Thought: """
         logs.insert_log('TASK_ERROR', 'Max steps reached')
         return True, f'[SAY] "I failed the task because I hit the max steps limit"'
 
+    def record_timing(self, step, seconds):
+        if self.step_timings:
+            timings = self.step_timings[-1]
+            timings[step] = timings.get(step, 0.0) + seconds
+
+    def get_timings_str(self):
+        lines = []
+        for i, timings in enumerate(self.step_timings):
+            timings_str = ', '.join(f'{step} {seconds * 1000:.0f}ms' for step, seconds in timings.items())
+            lines.append(f'Step {i + 1}: {timings_str}')
+        return '\n'.join(lines)
+
     def get_thought(self):
-        thought = llm.get_scalar(self.prompt, num_lines=1)
-        remove_prefixes = ['Now, ', 'First, ', 'Second, ', 'Then, ']
+        thought_start = time.perf_counter()
+        self.prefetched_matches = []
+        on_text = None
+        if self.pipelined:
+            self.prev_content = self.get_prev_content()
+            on_text = self.prefetch_partial_match
+        thought = llm.get_scalar(self.prompt, num_lines=1, max_tokens=100, on_text=on_text)
+        self.record_timing('thought', time.perf_counter() - thought_start)
 
         thought_wo_prefix = thought
-        for prefix in remove_prefixes:
+        for prefix in THOUGHT_PREFIXES:
             if thought_wo_prefix.startswith(prefix):
                 thought_wo_prefix = thought_wo_prefix[len(prefix):]
-        thought_embedding_id, thought_embedding = embeddings.get_embedding(thought_wo_prefix)
+
+        embedding_start = time.perf_counter()
+        if self.pipelined:
+            # The thought line is complete, match actions for it while the checks below run,
+            # unless a match started while it streamed is close enough
+            if not thought.upper().startswith(('OBJECTIVE COMPLETE', 'OBJECTIVE FAILED')):
+                if self.find_prefetched_match(self.prev_content, thought) is None:
+                    self.prefetch_match(thought.split())
+            embedding_future = pipeline_executor.submit(embeddings.get_embedding, thought_wo_prefix)
+            self.wait_pending_result()
+            thought_embedding_id, thought_embedding = embedding_future.result()
+        else:
+            thought_embedding_id, thought_embedding = embeddings.get_embedding(thought_wo_prefix)
 
         if self.last_thought_embedding is not None:
             last_thought_similarity = semantic.cosine_similarity(self.last_thought_embedding, thought_embedding)
@@ -282,6 +348,7 @@ Thought: """
             if similarity > 0.94:
                 thought = "OBJECTIVE COMPLETE"
                 thought_embedding_id, thought_embedding = embeddings.get_embedding(thought)
+        self.record_timing('embedding', time.perf_counter() - embedding_start)
 
         self.last_thought_embedding = thought_embedding
         self.thoughts.append(thought)
@@ -293,6 +360,70 @@ Thought: """
         self.prompt += f'{thought}\n'
         return thought
 
+    def get_prev_content(self):
+        """The message before the thought, as the thought's Task will pass it to match_request()"""
+        if len(self.results) > 0:
+            return remove_brackets(self.results[-1], "[")  # what save_result() adds to the history
+        prev_msg = self.parent_task.agent.context.message_history.last(incl_roles=('thought', 'result'))
+        return prev_msg['content'] if prev_msg else None
+
+    def prefetch_partial_match(self, text):
+        """
+        Called with the thought so far while it streams, starts matching actions for its complete words.
+        A new match starts for every new word while fewer than 2 are running, see get_action_matches()
+        """
+        line = text.split('\n', 1)[0]
+        words = line.split()
+        if '\n' not in text and not line[-1:].isspace():
+            words = words[:-1]  # the last word may still be streaming
+        if len(words) < self.prefetch_min_words:
+            return
+        if self.prefetched_matches and self.prefetched_matches[-1][1] == words:
+            return
+        if sum(1 for _, _, match_future in self.prefetched_matches if not match_future.done()) >= 2:
+            return
+        self.prefetch_match(words)
+
+    def prefetch_match(self, words):
+        """Starts matching actions for the thought's words, the way its Task would with the full thought"""
+        actions = self.parent_task.agent.actions
+        thought = ' '.join(words)
+        messages = [{'content': thought}] if self.prev_content is None \
+            else [{'content': self.prev_content}, {'content': thought}]
+        match_future = pipeline_executor.submit(actions.match_request, messages)
+        self.prefetched_matches.append((self.prev_content, words, match_future))
+
+    def find_prefetched_match(self, prev_content, thought):
+        """
+        The newest prefetched match for the same previous message whose words start the thought, missing at most
+        react.prefetch_max_missing_words of its last words
+        """
+        thought_words = thought.split()
+        for match_prev_content, words, match_future in reversed(self.prefetched_matches):
+            if match_prev_content != prev_content or words != thought_words[:len(words)]:
+                continue
+            if len(thought_words) - len(words) <= self.prefetch_max_missing_words:
+                return match_future
+        return None
+
+    def get_action_matches(self, messages):
+        """The actions matching the last thought, prefetched while it was generated if one is close enough"""
+        prev_content = messages[-2]['content'] if len(messages) > 1 else None
+        match_future = self.find_prefetched_match(prev_content, messages[-1]['content'])
+        self.prefetched_matches = []
+        if match_future is not None:
+            return match_future.result()
+
+        return self.parent_task.agent.actions.match_request(messages)
+
+    def wait_pending_result(self):
+        """Waits for a result message being saved in the background, then uses its embedding"""
+        if self.pending_result is None:
+            return
+        pending_result, self.pending_result = self.pending_result, None
+        msg = pending_result.result()
+        self.last_result_embedding = msg.embedding_data
+
     def save_action(self, action):
         self.actions.append(action)
         self.parent_task.agent.context.message_history.add('action', action)
@@ -306,8 +437,13 @@ Thought: """
     def save_result(self, result):
         self.results.append(result)
         result = remove_brackets(result, "[")
-        msg = self.parent_task.agent.context.message_history.add('result', result)
-        self.last_result_embedding = msg.embedding
+        message_history = self.parent_task.agent.context.message_history
+        if self.pipelined:
+            # Saving and embedding the result overlaps with generating the next thought
+            self.pending_result = pipeline_executor.submit(message_history.add, 'result', result)
+        else:
+            msg = message_history.add('result', result)
+            self.last_result_embedding = msg.embedding_data
         result = f'Result: {result}'
         if config.get_value('system.verbose'):
             tcolor = config.get_value('system.termcolor-verbose')
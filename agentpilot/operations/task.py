@@ -118,8 +118,11 @@ class Task:
 
     def get_action_guess(self):
         incl_roles = ('user', 'assistant') if self.parent_react is None else ('thought', 'result')
-        last_2_msgs = self.agent.context.message_history.get(only_role_content=False, msg_limit=2, incl_roles=incl_roles)
-        action_data_list = self.agent.actions.match_request(last_2_msgs)
+        last_2_msgs = self.agent.context.message_history.get(msg_limit=2, incl_roles=incl_roles)
+        if self.parent_react is not None:
+            action_data_list = self.parent_react.get_action_matches(last_2_msgs)
+        else:
+            action_data_list = self.agent.actions.match_request(last_2_msgs)
 
         if self.agent.config.get('actions.use_function_calling'):
             collected_actions = retrieval.function_call_decision(self, action_data_list)
@@ -160,7 +163,7 @@ Use the following message to guide your analysis. This user message (denoted wit
         "If there should be action taken, return 'TRUE'."
         "If there should be no action taken, return 'FALSE'."}
         
-Answer: """, single_line=True)  # If FALSE, explain why
+Answer: """, single_line=True, max_tokens=8)  # If FALSE, explain why
         validator_response = validator_response.upper() == 'TRUE'
         if len(actions) == 0: validator_response = not validator_response  # Flip boolean if empty action list, as per the prompt
         # if config.get_value('system.debug'):
@@ -1,6 +1,7 @@
 import asyncio
 import re
 import tempfile
+import threading
 import time
 from agentpilot.utils import sql, api
 import requests
@@ -33,9 +34,47 @@ priv_key = api_config.get('priv_key', '')
 
 cookie = None
 
-# rate limit 1 reqper sec
-last_req = 0
-thread_lock = asyncio.Lock()
+class TokenBucket:
+    """
+    Allows `rate` requests per second, in bursts of up to `capacity`.
+    reserve() books the next free slot and returns how long until it, so callers on any thread
+    are spaced out in the order they asked, without holding a lock while they wait.
+    """
+    def __init__(self, rate, capacity=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = capacity  # negative when slots are booked ahead
+        self.last_time = clock()
+
+    def reserve(self):
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        """Blocks the calling thread until its slot, returns the seconds waited"""
+        delay = self.reserve()
+        if delay > 0:
+            self.sleep(delay)
+        return delay
+
+    async def aacquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+
+# rate limit 1 req per sec, shared by every request to the api
+rate_limiter = TokenBucket(rate=1.0)
 
 
 def sync_fakeyou():
@@ -44,7 +83,6 @@ def sync_fakeyou():
 
 
 def sync_categories_fakeyou():
-    global last_req
     url = "https://api.fakeyou.com/category/list/tts"
     headers = {
         "content-type": "application/json",
@@ -55,11 +93,8 @@ def sync_categories_fakeyou():
         existing_categories = sql.get_results("SELECT uuid FROM categories WHERE api_id = 1")
         existing_uuids = [x[0] for x in existing_categories]
 
-        with thread_lock:
-            while time.time() - last_req < 1:
-                time.sleep(0.1)
-            last_req = time.time()
-            response = requests.get(url, headers=headers)
+        rate_limiter.acquire()
+        response = requests.get(url, headers=headers)
         if response.status_code != 200:
             raise Exception(response.text)
         categories = response.json()['categories']
@@ -161,7 +196,6 @@ def sync_categories_fakeyou():
 
 
 def sync_characters_fakeyou():
-    global last_req
     url = "https://api.fakeyou.com/tts/list"  # dict > models(list of dicts)
     headers = {
         "content-type": "application/json",
@@ -172,11 +206,8 @@ def sync_characters_fakeyou():
         existing_characters = sql.get_results("SELECT uuid FROM voices WHERE api_id = 1")
         existing_uuids = [x[0] for x in existing_characters]
 
-        with thread_lock:
-            while time.time() - last_req < 1:
-                time.sleep(0.1)
-            last_req = time.time()
-            response = requests.get(url, headers=headers)
+        rate_limiter.acquire()
+        response = requests.get(url, headers=headers)
         if response.status_code != 200:
             raise Exception(response.text)
 
@@ -241,7 +272,6 @@ def sync_characters_fakeyou():
 
 
 def try_download_voice(speech_uuid):
-    global last_req
     if not speech_uuid: return None
     url = f"https://api.fakeyou.com/tts/job/{speech_uuid}"
     headers = {
@@ -252,10 +282,7 @@ def try_download_voice(speech_uuid):
     try_count = 0
     while True:
         try:
-            # with thread_lock:
-            #     while time.time() - last_req < 1:
-            #         time.sleep(0.1)
-            #     last_req = time.time()
+            rate_limiter.acquire()
             response = requests.get(url, headers=headers)
             if response.status_code != 200:
                 raise ConnectionError()
@@ -263,7 +290,7 @@ def try_download_voice(speech_uuid):
             path = response.json()['state']['maybe_public_bucket_wav_audio_path']
             if not path: raise Exception("No path")
 
-            audio_request = requests.get(f'https://storage.googleapis.com/vocodes-public{path}')
+            audio_request = requests.get(f'https://storage.googleapis.com/vocodes-public{path}')  # not the api
             with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_file:
                 temp_file.write(audio_request.content)
                 return temp_file.name
@@ -276,8 +303,12 @@ def try_download_voice(speech_uuid):
                 return None
 
 
+def synthesise_voice(voice_uuid, text):
+    """Requests the speech and waits for its audio file, every api call goes through the rate limiter"""
+    return try_download_voice(generate_voice_async(voice_uuid, text))
+
+
 def generate_voice_async(voice_uuid, text):
-    global last_req
     url = 'https://api.fakeyou.com/tts/inference'
     headers = {
         "content-type": "application/json",
@@ -290,10 +321,7 @@ def generate_voice_async(voice_uuid, text):
         'inference_text': text
     }
     try:
-        # with thread_lock:
-        #     while time.time() - last_req < 1:
-        #         time.sleep(0.1)
-        #     last_req = time.time()
+        rate_limiter.acquire()
         response = requests.post(url, headers=headers, json=data)
         if response.status_code != 200:
             raise Exception(response.text)
@@ -1,8 +1,16 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
 import threading
 import time
 
+import httpx
 import litellm
-from agentpilot.utils import logs
+import openai
+from agentpilot.utils import config, logs, sql
 
 
 # def completion_callback(
@@ -47,34 +55,302 @@ from agentpilot.utils import logs
 #         member_id = member_calls.pop(litellm_id)
 
 
-def get_function_call_response(messages, sys_msg=None, functions=None, stream=True, model='gpt-3.5-turbo'):  # 4'):  #
-    if functions is None: functions = []
-    push_messages = [{'role': msg['role'], 'content': msg['content']} for msg in messages]
-    ex = None
-    for i in range(5):
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+RETRYABLE_EXCEPTIONS = tuple(exc for exc in (
+    getattr(litellm, 'RateLimitError', None),
+    getattr(litellm, 'ServiceUnavailableError', None),
+    getattr(litellm, 'APIConnectionError', None),
+    getattr(litellm, 'InternalServerError', None),
+    getattr(litellm, 'Timeout', None),
+    httpx.TransportError,
+    ConnectionError,
+    TimeoutError,
+) if isinstance(exc, type))
+# Checked first, litellm's ContextWindowExceededError is a BadRequestError and can carry a 5xx-looking status
+FATAL_EXCEPTIONS = tuple(exc for exc in (
+    getattr(litellm, 'AuthenticationError', None),
+    getattr(litellm, 'BadRequestError', None),
+    getattr(litellm, 'NotFoundError', None),
+    getattr(litellm, 'ContextWindowExceededError', None),
+    getattr(litellm, 'ContentPolicyViolationError', None),
+) if isinstance(exc, type))
+
+
+def is_retryable(e):
+    """Transient network, rate limit and server errors are worth retrying, anything else is a bug or a bad request"""
+    if isinstance(e, FATAL_EXCEPTIONS):
+        return False
+    if isinstance(e, RETRYABLE_EXCEPTIONS):
+        return True
+    status_code = getattr(e, 'status_code', None)
+    return status_code in RETRYABLE_STATUS_CODES
+
+
+class ModelStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_latency = 0.0
+        self.last_latency = 0.0
+
+    def as_dict(self):
+        succeeded = self.calls - self.errors
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'avg_latency': self.total_latency / succeeded if succeeded else 0.0,
+            'last_latency': self.last_latency,
+        }
+
+
+class LLMClient:
+    """
+    Shared entry point for completion calls.
+    Keeps one pooled http client per provider / base url, so repeated calls reuse open connections,
+    retries only retryable errors with jittered exponential backoff until a total deadline,
+    and counts latency and retries per model.
+    Latency of a streamed call is the time until the stream is opened.
+    """
+    def __init__(self, max_attempts=5, deadline_secs=120, base_delay=0.5, max_delay=8.0,
+                 clock=time.monotonic, sleep=time.sleep, rand=random.random):
+        self.max_attempts = max_attempts
+        self.deadline_secs = deadline_secs
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+        self.rand = rand
+
+        self.lock = threading.Lock()
+        self.http_clients = {}  # {(provider, api_base): httpx.Client}
+        self.openai_clients = {}  # {(provider, api_base, api_key): openai.OpenAI}
+        self.model_stats = {}  # {model: ModelStats}
+
+    def get_http_client(self, provider, api_base=None):
+        key = (provider, api_base)
+        with self.lock:
+            if key not in self.http_clients:
+                self.http_clients[key] = httpx.Client(
+                    limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60),
+                    timeout=None,  # the request timeout is passed with each call
+                )
+            return self.http_clients[key]
+
+    def get_openai_client(self, provider, api_base, api_key):
+        key = (provider, api_base, api_key)
+        with self.lock:
+            client = self.openai_clients.get(key)
+        if client is None:
+            # max_retries=0, retries are handled here so they respect the deadline and are counted
+            client = openai.OpenAI(api_key=api_key,
+                                   base_url=api_base,
+                                   http_client=self.get_http_client(provider, api_base),
+                                   max_retries=0)
+            with self.lock:
+                client = self.openai_clients.setdefault(key, client)
+        return client
+
+    def get_client_kwargs(self, model, kwargs):
+        """Litellm only accepts a prebuilt client for openai compatible providers, others share the pooled session"""
+        if 'client' in kwargs:
+            return {}
         try:
-            if sys_msg is not None: push_messages.insert(0, {"role": "system", "content": sys_msg})
-            cc = litellm.completion(
+            _, provider, api_key, api_base = litellm.get_llm_provider(
                 model=model,
-                messages=push_messages,
-                stream=stream,
-                temperature=0.01,
-                functions=functions,
-                function_call="auto",
-            )  # , presence_penalty=0.4, frequency_penalty=-1.8)
-            initial_prompt = '\n\n'.join([f"{msg['role']}: {msg['content']}" for msg in push_messages])
-            return cc, initial_prompt
-        # except openai.error.APIError as e:
-        #     ex = e
-        #     time.sleep(0.5 * i)
-        except Exception as e:
-            ex = e
-            time.sleep(0.3 * i)
-    raise ex
+                custom_llm_provider=kwargs.get('custom_llm_provider'),
+                api_base=kwargs.get('api_base'),
+            )
+        except Exception:
+            return {}
+        if provider not in ('openai', 'custom_openai'):
+            return {}
+        api_key = kwargs.get('api_key') or api_key or litellm.api_key or os.environ.get('OPENAI_API_KEY')
+        if not api_key:
+            return {}
+        return {'client': self.get_openai_client(provider, api_base, api_key)}
 
+    def get_delay(self, attempt):
+        """Full jitter, a random delay up to the exponential backoff ceiling"""
+        return self.rand() * min(self.max_delay, self.base_delay * (2 ** attempt))
 
-def get_chat_response(messages, sys_msg=None, stream=True, model_obj=None):
+    def completion(self, model, messages, request_timeout=100, deadline_secs=None, **kwargs):
+        deadline = self.clock() + (deadline_secs or self.deadline_secs)
+        kwargs.update(self.get_client_kwargs(model, kwargs))
+
+        for attempt in range(self.max_attempts):
+            start = self.clock()
+            try:
+                response = litellm.completion(
+                    model=model,
+                    messages=messages,
+                    request_timeout=max(1, min(request_timeout, deadline - start)),
+                    **kwargs
+                )
+            except Exception as e:
+                self.sleep(self.handle_error(e, model, attempt, start, deadline))
+                continue
+
+            self.record_success(model, start)
+            return response
+
+    async def acompletion(self, model, messages, request_timeout=100, deadline_secs=None, **kwargs):
+        """
+        Awaitable completion, with stream=True it returns an async iterator of chunks.
+        Litellm builds its own async http client here, a pooled sync client can't be used from the event loop.
+        """
+        deadline = self.clock() + (deadline_secs or self.deadline_secs)
+
+        for attempt in range(self.max_attempts):
+            start = self.clock()
+            try:
+                response = await litellm.acompletion(
+                    model=model,
+                    messages=messages,
+                    request_timeout=max(1, min(request_timeout, deadline - start)),
+                    **kwargs
+                )
+            except Exception as e:
+                await asyncio.sleep(self.handle_error(e, model, attempt, start, deadline))
+                continue
+
+            self.record_success(model, start)
+            return response
+
+    def handle_error(self, e, model, attempt, start, deadline):
+        """Counts a failed attempt and returns the delay before the next one, or re-raises e to give up"""
+        stats = self.get_model_stats(model)
+        latency = self.clock() - start
+        delay = self.get_delay(attempt)
+        give_up = (not is_retryable(e)
+                   or attempt == self.max_attempts - 1
+                   or self.clock() + delay >= deadline)
+        with self.lock:
+            stats.calls += 1
+            stats.errors += 1
+            stats.last_latency = latency
+            if not give_up:
+                stats.retries += 1
+        if give_up:
+            raise e
+        logs.insert_log('LLM RETRY', f'{model}: {type(e).__name__}: {e}, retrying in {delay:.2f}s', print_=False)
+        return delay
+
+    def record_success(self, model, start):
+        stats = self.get_model_stats(model)
+        latency = self.clock() - start
+        with self.lock:
+            stats.calls += 1
+            stats.total_latency += latency
+            stats.last_latency = latency
+
+    def get_model_stats(self, model):
+        with self.lock:
+            return self.model_stats.setdefault(model, ModelStats())
+
+    def stats(self):
+        with self.lock:
+            return {model: model_stats.as_dict() for model, model_stats in self.model_stats.items()}
+
+    def close(self):
+        with self.lock:
+            http_clients = list(self.http_clients.values())
+            self.http_clients.clear()
+            self.openai_clients.clear()
+        for http_client in http_clients:
+            http_client.close()
+
+
+client = LLMClient()
+# Providers that litellm builds its own http client for still pool their connections through this session
+litellm.client_session = client.get_http_client('default')
+
+
+def stats():
+    return client.stats()
+
+
+class ResponseCache:
+    """
+    Persistent LRU of get_scalar responses in the llm_cache table, keyed on a hash of the model, params and prompt.
+    Opt in with the 'system.llm_cache' setting, or per call with get_scalar(use_cache=True)
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, model, params, prompt):
+        key_data = json.dumps([model, params, prompt], sort_keys=True, default=str)
+        return hashlib.sha256(key_data.encode()).hexdigest()
+
+    def get(self, key):
+        rows = sql.get_results("SELECT response FROM llm_cache WHERE key = ?", (key,))
+        with self.lock:
+            if not rows:
+                self.misses += 1
+                return None
+            self.hits += 1
+        sql.execute("UPDATE llm_cache SET last_used = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+        return rows[0][0]
+
+    def put(self, key, model, response):
+        sql.execute_multiple([
+            "INSERT OR REPLACE INTO llm_cache (key, model, response, last_used, hits) VALUES (?, ?, ?, ?, 0)",
+            "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+        ], [
+            (key, model, response, time.time()),
+            (self.max_size,),
+        ])
+
+    def clear(self):
+        sql.execute("DELETE FROM llm_cache")
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        size = sql.get_scalar("SELECT COUNT(*) FROM llm_cache")
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': int(size or 0),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+response_cache = ResponseCache(max_size=config.get_value('system.llm_cache_max_size', 1000))
+
+
+def get_push_messages(messages, sys_msg=None):
+    push_messages = [{'role': msg['role'], 'content': msg['content']} for msg in messages]
+    if sys_msg is not None:
+        push_messages.insert(0, {"role": "system", "content": sys_msg})
+    return push_messages
+
+
+def get_function_call_response(messages, sys_msg=None, functions=None, stream=True, model='gpt-3.5-turbo'):  # 4'):  #
+    if functions is None: functions = []
+    push_messages = get_push_messages(messages, sys_msg)
+    cc = client.completion(
+        model=model,
+        messages=push_messages,
+        stream=stream,
+        temperature=0.01,
+        functions=functions,
+        function_call="auto",
+    )  # , presence_penalty=0.4, frequency_penalty=-1.8)
+    initial_prompt = '\n\n'.join([f"{msg['role']}: {msg['content']}" for msg in push_messages])
+    return cc, initial_prompt
+
+
+def get_model_config(model_obj):
     model, model_config = model_obj or ('gpt-3.5-turbo', {})
+    model_config = dict(model_config or {})
     if 'temperature' in model_config:
         # if is a valid number, convert value to a float, otherwise remove it
         try:
@@ -83,37 +359,112 @@ def get_chat_response(messages, sys_msg=None, stream=True, model_obj=None):
             del model_config['temperature']
     if 'custom_provider' in model_config:  # todo patch, remove next breaking version
         del model_config['custom_provider']
+    return model, model_config
 
-    # try with backoff
-    push_messages = [{'role': msg['role'], 'content': msg['content']} for msg in messages]
-    ex = None
-    for i in range(5):
+
+def get_chat_response(messages, sys_msg=None, stream=True, model_obj=None):
+    model, model_config = get_model_config(model_obj)
+    push_messages = get_push_messages(messages, sys_msg)
+    # include extra args
+    cc = client.completion(
+        model=model,
+        messages=push_messages,
+        stream=stream,
+        request_timeout=100,
+        **model_config
+    )  # , presence_penalty=0.4, frequency_penalty=-1.8)
+    # initial_prompt = '\n\n'.join([f"{msg['role']}: {msg['content']}" for msg in push_messages])
+    return cc  # , cc.logging_obj
+
+
+async def aget_chat_response(messages, sys_msg=None, stream=True, model_obj=None):
+    model, model_config = get_model_config(model_obj)
+    push_messages = get_push_messages(messages, sys_msg)
+    return await client.acompletion(
+        model=model,
+        messages=push_messages,
+        stream=stream,
+        request_timeout=100,
+        **model_config
+    )
+
+
+# An integer followed by anything else, so the integer is complete, eg. the "3" of "3 (it plays music)"
+INTEGER_ID_PATTERN = re.compile(r'^\D*?(\d+)(?=\D)')
+
+
+def iter_stream_text(response_stream):
+    for resp in response_stream:
+        if 'delta' in resp.choices[0]:
+            delta = resp.choices[0].get('delta', {})
+            yield delta.get('content', '') or ''
+        else:
+            yield resp.choices[0].get('text', '') or ''
+
+
+def read_stream(text_chunks, num_lines=0, stop_pattern=None, on_text=None):
+    """
+    Joins streamed text until the first `num_lines` lines are complete or `stop_pattern` matches the text so far.
+    Returns (output, stopped_early), when stopping early the rest of the stream isn't read.
+    `on_text` is called with the text so far after every chunk
+    """
+    output = ''
+    line_count = 0
+    for chunk in text_chunks:
+        output += chunk
+        if on_text is not None:
+            on_text(output)
+        line_count += chunk.count('\n')
+        if 0 < num_lines <= line_count:
+            return '\n'.join(output.split('\n')[:num_lines]), True
+        if stop_pattern is not None and stop_pattern.search(output):
+            return output, True
+    return output, False
+
+
+def close_stream(response_stream):
+    """Closes the http response behind a litellm stream, so the provider stops generating tokens nobody reads"""
+    completion_stream = getattr(response_stream, 'completion_stream', None)
+    for obj in (response_stream, completion_stream, getattr(completion_stream, 'response', None)):
+        close = getattr(obj, 'close', None)
+        if not callable(close):
+            continue
         try:
-            if sys_msg is not None: push_messages.insert(0, {"role": "system", "content": sys_msg})
-            # include extra args
-            cc = litellm.completion(
-                model=model,
-                messages=push_messages,
-                stream=stream,
-                request_timeout=100,
-                **(model_config or {})
-            )  # , presence_penalty=0.4, frequency_penalty=-1.8)
-            # initial_prompt = '\n\n'.join([f"{msg['role']}: {msg['content']}" for msg in push_messages])
-            return cc  # , cc.logging_obj
-        # except openai.error.APIError as e:  # todo change exceptions for litellm
-        #     ex = e
-        #     time.sleep(0.5 * i)
-        except Exception as e:
-            ex = e
-            time.sleep(0.3 * i)
-    raise ex
-
-
-def get_scalar(prompt, single_line=False, num_lines=0, model_obj=None):
+            close()
+            return
+        except Exception:
+            pass
+
+
+def get_scalar(prompt, single_line=False, num_lines=0, model_obj=None, use_cache=None, max_tokens=None,
+               stop_pattern=None, on_text=None):
+    """
+    Returns the response to a single prompt.
+    With `num_lines` or `stop_pattern` the response is streamed, and the stream is closed as soon as the lines are read
+    or the pattern matches, `on_text` is then called with the text so far as it streams in.
+    `max_tokens` caps the response for call sites that know how short their answer is
+    """
     if single_line:
         num_lines = 1
 
-    if num_lines <= 0:
+    model, model_config = get_model_config(model_obj)
+    if max_tokens is not None:
+        model_config['max_tokens'] = max_tokens
+    model_obj = (model, model_config)
+
+    if use_cache is None:
+        use_cache = config.get_value('system.llm_cache', False)
+    cache_key = None
+    if use_cache:
+        params = {**model_config, 'num_lines': num_lines}
+        if stop_pattern is not None:
+            params['stop_pattern'] = stop_pattern.pattern
+        cache_key = response_cache.get_key(model, params, prompt)
+        output = response_cache.get(cache_key)
+        if output is not None:
+            return output
+
+    if num_lines <= 0 and stop_pattern is None:
         # m_name, m_conf = model_obj
         # m_conf.pop('api_base', None)
         # m_conf.pop('custom_llm_provider', None)
@@ -122,28 +473,12 @@ def get_scalar(prompt, single_line=False, num_lines=0, model_obj=None):
         output = response.choices[0]['message']['content']
     else:
         response_stream = get_chat_response([], prompt, stream=True, model_obj=model_obj)
-        output = ''
-        line_count = 0
-        for resp in response_stream:
-            if 'delta' in resp.choices[0]:
-                delta = resp.choices[0].get('delta', {})
-                chunk = delta.get('content', '')
-            else:
-                chunk = resp.choices[0].get('text', '')
-
-            # if is_integer:
-            #     # check if any non-numeric characters in chunk
-
-            if '\n' in chunk:
-                chunk = chunk.split('\n')[0]
-                output += chunk
-                line_count += 1
-                if line_count >= num_lines:
-                    break
-                output += chunk.split('\n')[1]
-            else:
-                output += chunk
+        output, stopped_early = read_stream(iter_stream_text(response_stream), num_lines, stop_pattern, on_text)
+        if stopped_early:
+            close_stream(response_stream)
     # logs.insert_log('PROMPT', f'{initial_prompt}\n\n--- RESPONSE ---\n\n{output}', print_=False)
+    if cache_key is not None and output:
+        response_cache.put(cache_key, model, output)
     return output
 
 
@@ -1,3 +1,10 @@
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+from agentpilot.utils import config, sql
 from agentpilot.utils.apis import awspolly
 
 
@@ -6,3 +13,125 @@ def sync_all():
     # uberduck.sync_uberduck()
     # fakeyou.sync_fakeyou()
     # elevenlabs.sync_elevenlabs()
+
+
+class AudioCache:
+    """
+    Synthesised audio files on disk, named by a hash of (api_id, voice uuid, preprocessed text),
+    so a repeated utterance is replayed without a network call. Least recently used files are removed
+    once the directory is over max_bytes, a max_bytes of 0 disables the cache.
+    """
+    def __init__(self, cache_dir=None, max_bytes=200 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.files = None  # OrderedDict {key: (filepath, size)}, least recently used first, loaded on first use
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(api_id, voice_uuid, text):
+        return hashlib.sha256(f'{api_id}\0{voice_uuid}\0{text}'.encode()).hexdigest()
+
+    def get_cache_dir(self):
+        if self.cache_dir is None:
+            self.cache_dir = os.path.join(os.path.dirname(sql.get_db_path()), 'audio_cache')
+        return self.cache_dir
+
+    def load(self):
+        """Indexes the files already in the cache directory, by modification time"""
+        cache_dir = self.get_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        entries = []
+        for file_name in os.listdir(cache_dir):
+            filepath = os.path.join(cache_dir, file_name)
+            key, _ = os.path.splitext(file_name)
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, key, filepath, stat.st_size))
+
+        self.files = OrderedDict()
+        self.total_bytes = 0
+        for _, key, filepath, size in sorted(entries):
+            self.files[key] = (filepath, size)
+            self.total_bytes += size
+
+    def get(self, key):
+        if self.max_bytes <= 0:
+            return None
+        with self.lock:
+            if self.files is None:
+                self.load()
+            entry = self.files.get(key)
+            if entry is None or not os.path.isfile(entry[0]):
+                self.misses += 1
+                return None
+            self.files.move_to_end(key)
+            self.hits += 1
+        try:
+            os.utime(entry[0])  # keeps the order across restarts
+        except OSError:
+            pass
+        return entry[0]
+
+    def put(self, key, filepath):
+        """Moves a downloaded file into the cache, returns its new path"""
+        if self.max_bytes <= 0:
+            return filepath
+        with self.lock:
+            if self.files is None:
+                self.load()
+            _, ext = os.path.splitext(filepath)
+            cached_path = os.path.join(self.get_cache_dir(), key + ext)
+            try:
+                shutil.move(filepath, cached_path)  # a rename unless the temp dir is on another filesystem
+                size = os.path.getsize(cached_path)
+            except OSError as e:
+                print('AudioCache.put ', e)
+                return filepath
+
+            old_entry = self.files.pop(key, None)
+            if old_entry is not None:
+                self.total_bytes -= old_entry[1]
+            self.files[key] = (cached_path, size)
+            self.total_bytes += size
+            self.evict()
+        return cached_path
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.files) > 1:
+            _, (filepath, size) = self.files.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            if self.files is None:
+                self.load()
+            for filepath, _ in self.files.values():
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    pass
+            self.files.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.files or {}),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+audio_cache = AudioCache(max_bytes=int(config.get_value('voice.audio_cache_max_mb', 200) * 1024 * 1024))
@@ -175,6 +175,11 @@ def generate_voice_async(voice_uuid, text):
         return None
 
 
+def synthesise_voice(voice_uuid, text):
+    """Requests the speech and waits for its audio file, both blocking"""
+    return try_download_voice(generate_voice_async(voice_uuid, text))
+
+
 # def generate_voice(voice_uuid, text):
 #     url = "https://api.uberduck.ai/speak-synchronous"
 #     payload = {
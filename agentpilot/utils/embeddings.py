@@ -1,31 +1,99 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
 from agentpilot.utils import sql
 
 
+EMBEDDING_QUERY = 'SELECT id, embedding FROM embeddings WHERE original_text = ?'
+
+
+class EmbeddingCache:
+    """Bounded LRU of {normalised text: (embedding_id, embedding)} in front of the embeddings table"""
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+embedding_cache = EmbeddingCache()
+
+
+def normalise_text(text):
+    return text.lower().strip()
+
+
 def get_embedding(text):
+    """Returns (embedding_id, float32 numpy array), or (None, None) if it couldn't be generated"""
     from agentpilot.utils.apis import llm
-    clean_text = text.lower().strip()
-    found_embedding = sql.get_results('SELECT id, embedding FROM embeddings WHERE original_text = ?', (clean_text,), return_type='dict')
+    clean_text = normalise_text(text)
+    cached = embedding_cache.get(clean_text)
+    if cached is not None:
+        return cached
+
+    found_embedding = sql.get_results(EMBEDDING_QUERY, (clean_text,), return_type='htuple')
 
     # print('EMBEDDED: ', clean_text)
     if not found_embedding:
         try:
             gen_em = llm.gen_embedding(clean_text)
-            str_embedding = ','.join([str(x) for x in gen_em])
-            sql.execute('INSERT INTO embeddings (original_text, embedding) VALUES (?, ?)', (clean_text, str_embedding))
+            embedding = np.asarray(gen_em, dtype=np.float32)
+            sql.execute('INSERT INTO embeddings (original_text, embedding) VALUES (?, ?)', (clean_text, embedding_to_blob(embedding)))
             # get last inserted for sqlite
-            found_embedding = sql.get_results('SELECT id, embedding FROM embeddings WHERE original_text = ?', (clean_text,), return_type='dict')
+            found_embedding = sql.get_results(EMBEDDING_QUERY, (clean_text,), return_type='htuple')
         except Exception as e:
             print(e)
             return None, None
 
-    # first item in found_embedding dict using efficient method
-    embedding = next(iter(found_embedding.items()))
-    # if not embedding:
-    #     return None, None
-    # else:
+    embedding_id, blob = found_embedding
+    embedding = (embedding_id, blob_to_embedding(blob))
+    embedding_cache.put(clean_text, embedding)
     return embedding
 
 
+def embedding_to_blob(embedding):
+    return np.asarray(embedding, dtype=np.float32).tobytes()
+
+
+def blob_to_embedding(blob):
+    # Zero-copy view over the row's bytes, read only
+    return np.frombuffer(blob, dtype=np.float32)
+
+
 def string_embeddings_to_array(embedding_str):
     return [float(x) for x in embedding_str.split(',')]
 
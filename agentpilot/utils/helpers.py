@@ -1,3 +1,5 @@
+import asyncio
+import contextvars
 import os
 import re
 import sys
@@ -91,6 +93,22 @@ def display_messagebox(icon, text, title, buttons=(QMessageBox.Ok)):
 #     return os.path.abspath(abs_path)  # return absolute path
 
 
+async def iterate_in_thread(iterator):
+    """
+    Async iterator over a blocking iterator, each next() runs in the loop's default executor.
+    The caller's context is carried over, so the iterator's writes join the caller's sql.batch()
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    iterator = iter(iterator)
+    sentinel = object()
+    while True:
+        item = await loop.run_in_executor(None, context.run, next, iterator, sentinel)
+        if item is sentinel:
+            return
+        yield item
+
+
 class SafeDict(dict):
     """A custom dictionary that returns the key wrapped in curly braces
        when the key is missing."""
@@ -115,7 +133,7 @@ categories [
 ]
 What_To_Categorize: `{item}`
 {"Please either" if can_make_new else "You must"} choose one of the above categories{" or return a new one that it can be classified under." if can_make_new else ""}.
-Category: """).lower()
+Category: """, max_tokens=20).lower()
     cat = re.sub(r'\([^)]*\)', '', cat).strip()
 
     if isinstance(item_list, str) and can_make_new:
@@ -127,9 +145,11 @@ Category: """).lower()
 # def answer_questions
 
 
+TIME_PATTERN = re.compile(r"\b\d{1,2}:\d{2}\s?[ap]m\b")
+
+
 def replace_times_with_spoken(text):
-    pattern = r"\b\d{1,2}:\d{2}\s?[ap]m\b"
-    time_matches = re.findall(pattern, text)
+    time_matches = TIME_PATTERN.findall(text)
     for time_match in time_matches:
         has_space = ' ' in time_match
         is_12hr = 'PM' in time_match.upper() and int(time_match.split(':')[0]) < 13
@@ -1,3 +1,7 @@
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 from agentpilot.utils import sql, config
 # from agentpilot.utils.popups import show_popup
 
@@ -23,6 +27,48 @@ class Logger:
             print(f'{_type}: {message}')
 
 
+class LogSink:
+    """
+    Buffers log rows and writes them in bulk, once `max_rows` are waiting or `flush_secs` after the first.
+    Both flushes run in the background, insert_log() is called from the event loop and must never wait on a write
+    """
+    def __init__(self, max_rows=50, flush_secs=2.0):
+        self.max_rows = max_rows
+        self.flush_secs = flush_secs
+        self.rows = []
+        self.lock = threading.Lock()
+        self.timer = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='log-sink')
+
+    def add(self, log_type, message):
+        with self.lock:
+            self.rows.append((log_type, message))
+            flush_now = len(self.rows) >= self.max_rows
+            if not flush_now and self.timer is None:
+                self.timer = threading.Timer(self.flush_secs, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if flush_now:
+            self.executor.submit(self.flush)
+
+    def flush(self):
+        with self.lock:
+            rows, self.rows = self.rows, []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if len(rows) == 0:
+            return
+        try:
+            sql.execute_multiple(["INSERT INTO logs (log_type, message) VALUES (?, ?);"] * len(rows), rows)
+        except Exception as e:
+            print('ERROR INSERTING LOG')
+
+
+log_sink = LogSink()
+atexit.register(log_sink.flush)
+
+
 def insert_log(type, message, print_=True):
     if type == "TASK CREATED":
         pass
@@ -34,7 +80,7 @@ def insert_log(type, message, print_=True):
         # if print_ and config.get_value('system.debug'):
         #     print("\r", end="")
         #     cprint(f'{type}: {message}', 'light_grey')  # print(f'{type}: {message}')
-        sql.execute(f"INSERT INTO logs (log_type, message) VALUES (?, ?);", (type, message))
+        log_sink.add(type, message)
 
     except Exception as e:
         print('ERROR INSERTING LOG')
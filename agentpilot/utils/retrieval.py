@@ -1,39 +1,135 @@
+import functools
+import hashlib
 import importlib
 import inspect
+import json
 import os
 import re
 import sys
+import threading
+import time
+import zipfile
+from collections import OrderedDict
 
-from agentpilot.utils.embeddings import string_embeddings_to_array
-from agentpilot.utils import logs, config, embeddings, semantic
+import numpy as np
+
+from agentpilot.utils import logs, config, embeddings, semantic, sql
+from agentpilot.utils.tokens import count_tokens
 from agentpilot.utils.apis import llm
 
+ACTION_INDEX_FORMAT = 2  # bump when the index layout changes, so stale files are rebuilt
+
+# The stored function schemas are built by these modules, so a change to them invalidates the index too
+OPERATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'operations')
+SCHEMA_SOURCE_FILES = [os.path.join(OPERATIONS_DIR, 'action.py'), os.path.join(OPERATIONS_DIR, 'parameters.py')]
+
+function_schema_cache = {}  # {(action class, input signature): (schema, schema token count)}
+
 
 class ActionData:
-    def __init__(self, clss):
-        self.clss = clss
+    def __init__(self, clss, known_embeddings=None):
+        self._clss = clss
+        self._class_instance = clss(None)
         self.name = clss.__name__
-        self.class_instance = clss(None)
+        self.module_name = clss.__module__
         self.desc = self.class_instance.desc
         self.desc_prefix = self.class_instance.desc_prefix
         self.full_desc = f"The user's request {self.desc_prefix} {self.desc}"
-        _, self.embedding = embeddings.get_embedding(self.desc)
-        self.embedding = string_embeddings_to_array(self.embedding)
+        self.embedding = get_known_embedding(self.desc, known_embeddings)
+        self.schema = None
+        self.schema_tokens = None
+
+    @classmethod
+    def from_index(cls, entry, embedding):
+        """An action from the action index, its class is only imported when something needs it"""
+        action_data = cls.__new__(cls)
+        action_data._clss = None
+        action_data._class_instance = None
+        action_data.name = entry['name']
+        action_data.module_name = entry['module']
+        action_data.desc = entry['desc']
+        action_data.desc_prefix = entry['desc_prefix']
+        action_data.full_desc = f"The user's request {action_data.desc_prefix} {action_data.desc}"
+        action_data.embedding = embedding
+        action_data.schema = entry['schema']
+        action_data.schema_tokens = entry.get('schema_tokens')
+        return action_data
+
+    @property
+    def clss(self):
+        if self._clss is None:
+            self._clss = getattr(importlib.import_module(self.module_name), self.name)
+        return self._clss
+
+    @property
+    def class_instance(self):
+        if self._class_instance is None:
+            self._class_instance = self.clss(None)
+        return self._class_instance
+
+    def function_schema(self):
+        return self.get_function_schema()[0]
+
+    def get_function_schema(self):
+        """Returns (schema, token count of the serialised schema), memoised per action class"""
+        if self._class_instance is None and self.schema is not None:
+            # From the action index, which is rebuilt whenever the action source changes
+            if self.schema_tokens is None:
+                self.schema_tokens = count_schema_tokens(self.schema)
+            return self.schema, self.schema_tokens
+
+        params = self.class_instance.inputs.inputs
+        signature = tuple((p.input_name, p.fvalue.type_str, p.required, p.desc) for p in params)
+        key = (self.clss, signature)
+        cached = function_schema_cache.get(key)
+        if cached is None:
+            required_params = [param.input_name for param in params if param.required]
+            properties = {p.input_name: {'type': p.fvalue.type_str, 'description': p.description()} for p in params}
+            schema = {
+                "name": self.name,
+                "description": self.desc,
+                "parameters": {
+                    "type": "object",
+                    "properties": properties,
+                    "required": required_params
+                }
+            }
+            cached = (schema, count_schema_tokens(schema))
+            function_schema_cache[key] = cached
+
+        self.schema, self.schema_tokens = cached
+        return self.schema, self.schema_tokens
+
+
+def count_schema_tokens(schema):
+    return count_tokens(json.dumps(schema))
 
 
 class ActionCategory:
-    def __init__(self, filename):
+    def __init__(self, filename, known_embeddings=None):
         self.name = filename
         module = self.module()
         self.desc = getattr(module, 'desc', filename.replace('_', ' '))
         self.desc_prefix = getattr(module, 'desc_prefix', 'is something related to')
-        self.on_scoped_class = getattr(module, '_On_Scoped', None)
 
-        _, self.embedding = embeddings.get_embedding(self.desc)
-        self.embedding = string_embeddings_to_array(self.embedding)
+        self.embedding = get_known_embedding(self.desc, known_embeddings)
         self.all_actions_data = {}
 
-        self.add_module_actions(module)
+        self.add_module_actions(module, known_embeddings)
+
+    @classmethod
+    def from_index(cls, entry, embedding):
+        category = cls.__new__(cls)
+        category.name = entry['name']
+        category.desc = entry['desc']
+        category.desc_prefix = entry['desc_prefix']
+        category.embedding = embedding
+        category.all_actions_data = {}
+        return category
+
+    @property
+    def on_scoped_class(self):
+        return getattr(self.module(), '_On_Scoped', None)
 
     def module(self):
         is_external = False
@@ -41,7 +137,7 @@ class ActionCategory:
         module_path = self.name if is_external else f'operations.actions.{self.name}'
         return importlib.import_module(module_path)
 
-    def add_module_actions(self, module):
+    def add_module_actions(self, module, known_embeddings=None):
         members = inspect.getmembers(module)
         for member_name, member_value in members:
             if not inspect.isclass(member_value): continue
@@ -56,11 +152,103 @@ class ActionCategory:
 
             if not originates_in_folder: continue  # prevents fetching members from imported modules
 
-            self.all_actions_data[member_name] = ActionData(member_value)
+            self.all_actions_data[member_name] = ActionData(member_value, known_embeddings)
+
+
+def get_known_embedding(text, known_embeddings=None):
+    """Reuses the embedding of an unchanged description from the previous action index"""
+    if known_embeddings is not None and text in known_embeddings:
+        return known_embeddings[text]
+    _, embedding = embeddings.get_embedding(text)
+    return embedding
+
+
+def hash_action_files(source_dir, action_files):
+    """Any change to an action source file, the set of files, or the code that builds schemas changes the hash"""
+    source_hash = hashlib.sha256(f'format {ACTION_INDEX_FORMAT}\n'.encode())
+    for schema_file in SCHEMA_SOURCE_FILES:
+        with open(schema_file, 'rb') as f:
+            source_hash.update(f.read())
+    for file_name in sorted(action_files):
+        source_hash.update(file_name.encode() + b'\0')
+        with open(os.path.join(source_dir, f'{file_name}.py'), 'rb') as f:
+            source_hash.update(f.read())
+    return source_hash.hexdigest()
+
+
+def get_action_index_path(source_dir):
+    """One index per source directory, kept next to data.db"""
+    dir_hash = hashlib.sha256(os.path.abspath(source_dir).encode()).hexdigest()[:12]
+    return os.path.join(os.path.dirname(sql.get_db_path()), f'action_index_{dir_hash}.npz')
+
+
+def save_action_index(index_path, source_hash, categories):
+    """
+    Writes the categories and their actions to one .npz file. Descriptions and function schemas go in a json
+    metadata string, the embeddings in two float32 matrices with a mask for the ones that are missing.
+    """
+    actions_data = [action_data for category in categories for action_data in category.all_actions_data.values()]
+    metadata = {
+        'source_hash': source_hash,
+        'categories': [{
+            'name': category.name,
+            'desc': category.desc,
+            'desc_prefix': category.desc_prefix,
+            'actions': [{
+                'name': action_data.name,
+                'module': action_data.module_name,
+                'desc': action_data.desc,
+                'desc_prefix': action_data.desc_prefix,
+                'schema': action_data.function_schema(),
+                'schema_tokens': action_data.get_function_schema()[1],
+            } for action_data in category.all_actions_data.values()]
+        } for category in categories],
+    }
+    category_embeddings = [category.embedding for category in categories]
+    action_embeddings = [action_data.embedding for action_data in actions_data]
+    found_embeddings = [e for e in category_embeddings + action_embeddings if e is not None]
+    dims = len(found_embeddings[0]) if found_embeddings else 0
+
+    tmp_path = f'{index_path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f,
+                 metadata=np.array(json.dumps(metadata)),
+                 category_embeddings=ActionCollection.embedding_matrix(category_embeddings, dims),
+                 category_mask=np.array([e is not None for e in category_embeddings], dtype=bool),
+                 action_embeddings=ActionCollection.embedding_matrix(action_embeddings, dims),
+                 action_mask=np.array([e is not None for e in action_embeddings], dtype=bool))
+    os.replace(tmp_path, index_path)  # never leave a half written index behind
+
+
+def read_action_index(index_path):
+    """Returns the categories stored in the index and its source hash, or (None, None)"""
+    try:
+        with np.load(index_path, allow_pickle=False) as index:
+            metadata = json.loads(str(index['metadata']))
+            category_embeddings = index['category_embeddings']
+            category_mask = index['category_mask']
+            action_embeddings = index['action_embeddings']
+            action_mask = index['action_mask']
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None, None
+
+    categories = []
+    action_num = 0
+    for category_num, category_entry in enumerate(metadata['categories']):
+        embedding = category_embeddings[category_num] if category_mask[category_num] else None
+        category = ActionCategory.from_index(category_entry, embedding)
+        for action_entry in category_entry['actions']:
+            embedding = action_embeddings[action_num] if action_mask[action_num] else None
+            category.all_actions_data[action_entry['name']] = ActionData.from_index(action_entry, embedding)
+            action_num += 1
+        categories.append(category)
+    return categories, metadata['source_hash']
 
 
 class ActionCollection:
-    def __init__(self, source_dir):
+    def __init__(self, source_dir, vector_index='brute', top_k=10):
+        self.vector_index = vector_index  # 'brute', or 'hnsw' for large action sets when hnswlib is installed
+        self.top_k = top_k
         if source_dir == '':
             source_dir = '.'
         if source_dir != '.' and not os.path.exists(source_dir):
@@ -83,12 +271,63 @@ class ActionCollection:
 
         self.all_category_files = {}
 
-        # Import all files
-        action_groups = {}
+        # Use the action index if none of the action files changed since it was built
+        source_hash = hash_action_files(source_dir, action_files)
+        index_path = get_action_index_path(source_dir)
+        categories, index_hash = read_action_index(index_path)
+        if categories is not None and index_hash == source_hash:
+            self.all_category_files = {category.name: category for category in categories}
+            self.build_index()
+            return
+
+        # Otherwise import all files, only descriptions that aren't in the old index get embedded
+        known_embeddings = {}
+        for category in categories or []:
+            known_embeddings[category.desc] = category.embedding
+            for action_data in category.all_actions_data.values():
+                known_embeddings[action_data.desc] = action_data.embedding
+
         for file_path in action_files:
             # Get the file name without the extension
             file_name = os.path.basename(file_path)
-            self.all_category_files[file_name] = ActionCategory(file_name)
+            self.all_category_files[file_name] = ActionCategory(file_name, known_embeddings)
+
+        self.build_index()
+        try:
+            save_action_index(index_path, source_hash, self.all_category_files.values())
+        except OSError as e:
+            logs.insert_log('ERROR', f'Could not save the action index: {e}')
+
+    def build_index(self):
+        """Build the vector indexes over the category and action embeddings"""
+        self.category_names = [name for name in self.all_category_files if not name.startswith('_')]
+        self.uncategorised = [name for name in self.all_category_files if name.startswith('_')]
+        self.actions_data = []
+        action_category_names = []
+        for filename, category in self.all_category_files.items():
+            for action_data in category.all_actions_data.values():
+                self.actions_data.append(action_data)
+                action_category_names.append(filename)
+        self.action_category_names = np.array(action_category_names, dtype=object)
+
+        all_embeddings = [category.embedding for category in self.all_category_files.values()]
+        all_embeddings.extend(action_data.embedding for action_data in self.actions_data)
+        found_embeddings = [embedding for embedding in all_embeddings if embedding is not None]
+        dims = len(found_embeddings[0]) if found_embeddings else 0
+        self.dims = dims
+        self.category_index = semantic.VectorIndex(self.embedding_matrix(
+            [self.all_category_files[name].embedding for name in self.category_names], dims))
+        self.action_index = semantic.VectorIndex(self.embedding_matrix(
+            [action_data.embedding for action_data in self.actions_data], dims), method=self.vector_index)
+
+    @staticmethod
+    def embedding_matrix(embedding_list, dims):
+        # Missing embeddings become zero rows, which score 0 against everything
+        matrix = np.zeros((len(embedding_list), dims), dtype=np.float32)
+        for i, embedding in enumerate(embedding_list):
+            if embedding is not None:
+                matrix[i] = embedding
+        return matrix
 
     def match_request(self, messages):
         if len(self.all_category_files) == 0:
@@ -99,39 +338,117 @@ class ActionCollection:
 
         _, req_embedding = embeddings.get_embedding(last_msg)
         _, prev_embedding = embeddings.get_embedding(prev_msg) if prev_msg else (None, None)
-        req_embedding = string_embeddings_to_array(req_embedding)
-        prev_embedding = string_embeddings_to_array(prev_embedding) if prev_embedding else None
-        cat_similarities = {}
-
-        uncategorised = []
+        if req_embedding is None or len(req_embedding) != self.dims:
+            return []
+
+        # The last two messages are scored together, each candidate keeps its best similarity
+        query_embeddings = [req_embedding] if prev_embedding is None else [req_embedding, prev_embedding]
+        query_matrix = np.stack(query_embeddings)
+
+        cat_similarities = self.category_index.scores(query_matrix)
+        cat_order = semantic.top_k(cat_similarities, len(self.category_names) // 2)
+        lookat_cats = [self.category_names[i] for i in cat_order]
+        lookat_cats.extend(self.uncategorised)
+
+        action_mask = np.isin(self.action_category_names, lookat_cats)
+        top_indexes = self.action_index.search(query_matrix, k=self.top_k, mask=action_mask)
+        top_actions_data = [self.actions_data[i] for i in top_indexes]
+        return list(reversed(top_actions_data))
+
+
+class DecisionCache:
+    """
+    Bounded LRU of recent action decisions, so a repeated request with the same candidate actions
+    skips the classifier call. Entries expire ttl_secs after they were decided.
+    """
+    def __init__(self, max_size=256, ttl_secs=600, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl_secs = ttl_secs
+        self.clock = clock
+        self.items = OrderedDict()  # {key: (expires_at, actions)}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None and item[0] <= self.clock():
+                del self.items[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, actions):
+        with self.lock:
+            self.items[key] = (self.clock() + self.ttl_secs, list(actions))
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
 
-        for filename, category in self.all_category_files.items():
-            if filename.startswith('_'):
-                uncategorised.append(filename)
-                continue
-            m1_similarity = semantic.cosine_similarity(category.embedding, req_embedding)
-            m2_similarity = semantic.cosine_similarity(category.embedding, prev_embedding) if prev_embedding else 0
-            cat_similarities[filename] = max(m1_similarity, m2_similarity)
 
-        lookat_cats = sorted(cat_similarities, key=cat_similarities.get, reverse=True)[:len(cat_similarities) // 2]
-        lookat_cats.extend(uncategorised)
-        #
-        # top_3 = []
+decision_cache = DecisionCache()
 
-        action_similarities = {}
-        for filename in lookat_cats:
-            category = self.all_category_files[filename]
-            for action_name, action_data in category.all_actions_data.items():
-                m1_similarity = semantic.cosine_similarity(action_data.embedding, req_embedding)
-                m2_similarity = semantic.cosine_similarity(action_data.embedding, prev_embedding) if prev_embedding else 0
-                similarity = max(m1_similarity, m2_similarity)
-                action_similarities[action_name] = (similarity, action_data)
 
-        top_actions = sorted(action_similarities.values(), key=lambda x: x[0], reverse=True)[:10]
-        top_3_actions_data = [action_data for score, action_data in top_actions]
-        return list(reversed(top_3_actions_data))
+def get_decision_key(decision_name, task, action_data_list):
+    """
+    The normalised lookback messages the decision prompt is built from, plus a fingerprint of the candidate actions
+    in the order they're offered
+    """
+    if task.parent_react:
+        lookback_msgs = task.agent.context.message_history.get(msg_limit=1, incl_roles=('thought', 'result'))
+    else:
+        action_lookback_msg_cnt = task.agent.config.get('actions.lookback_msg_count', 2)
+        lookback_msgs = task.agent.context.message_history.get(msg_limit=action_lookback_msg_cnt)
+    lookback = tuple((msg['role'], embeddings.normalise_text(msg['content'])) for msg in lookback_msgs)
+    actions_fingerprint = tuple(f'{act_data.module_name}.{act_data.name}' for act_data in action_data_list)
+    return decision_name, task.parent_react is not None, lookback, actions_fingerprint
+
+
+def cached_decision(decision_func):
+    """
+    Serves repeated decisions from decision_cache when the agent's 'actions.cache_decisions' setting is on,
+    use_cache overrides the setting. Only decisions that picked an action are cached, so a "no action"
+    answer is asked again next time instead of sticking for the whole ttl.
+    """
+    @functools.wraps(decision_func)
+    def wrapper(task, action_data_list, use_cache=None):
+        if use_cache is None:
+            use_cache = task.agent.config.get('actions.cache_decisions', False)
+        if not use_cache:
+            return decision_func(task, action_data_list)
+
+        key = get_decision_key(decision_func.__name__, task, action_data_list)
+        actions = decision_cache.get(key)
+        if actions is not None:
+            return list(actions)
+
+        actions = decision_func(task, action_data_list)
+        if actions:
+            decision_cache.put(key, actions)
+        return actions
+    return wrapper
 
 
+@cached_decision
 def native_decision(task, action_data_list):
     action_lookback_msg_cnt = task.agent.config.get('actions.lookback_msg_count', 2)
     if task.parent_react:
@@ -171,7 +488,7 @@ If no actions or detections from the list are valid based on the last {last_enti
 (Give an explanation of your decision after on the same line in parenthesis)
 ID: """
 # If it seems like there should be further action(s) to take, but it is not in the list, then add a question mark to the comma separated list (e.g. "1,3,5,?").
-    response = llm.get_scalar(prompt, single_line=True)
+    response = llm.get_scalar(prompt, single_line=True, stop_pattern=llm.INTEGER_ID_PATTERN, max_tokens=60)
     # response = re.sub(r'[^0-9,]', '', response)  # this regex removes all non-numeric characters except commas
 
     response = re.sub(r'([0-9]+).*', r'\1', response)  # this regex only keeps the first integer found in the string
@@ -184,6 +501,7 @@ ID: """
     return actions
 
 
+@cached_decision
 def function_call_decision(task, action_data_list):
     action_lookback_msg_cnt = task.agent.config.get('actions.lookback_msg_count', 2)
     if task.parent_react:
@@ -208,7 +526,8 @@ TASK:
 Examine the {context_type} in detail, applying logic and reasoning to ascertain the most valid function based on the latest {last_entity}.
 If no functions are valid based on the last {last_entity}, simply respond normally as assistant. 
 """
-    functions = get_function_call_list(action_data_list)
+    functions = get_function_call_list(action_data_list,
+                                       token_budget=task.agent.config.get('actions.function_schema_token_budget'))
     response = llm.get_function_call_response(messages=messages, sys_msg=prompt, functions=functions, stream=False)
 
     if 'function_call' in response[0]['choices'][0]['message']:
@@ -230,44 +549,23 @@ If no functions are valid based on the last {last_entity}, simply respond normal
     # NOW INSTEAD OF ABOVE, GET THE CLASS BY THE FUNCTION NAME:
 
 
-def get_function_call_list(action_data_list):
-    # format output
-    # "functions": [
-    #   {
-    #     "name": "get_current_weather",
-    #     "description": "Get the current weather in a given location",
-    #     "parameters": {
-    #       "type": "object",
-    #       "properties": {
-    #         "location": {
-    #           "type": "string",
-    #           "description": "The city and state, e.g. San Francisco, CA"
-    #         },
-    #         "unit": {
-    #           "type": "string",
-    #           "enum": ["celsius", "fahrenheit"]
-    #         }
-    #       },
-    #       "required": ["location"]
-    #     }
-    #   }
-    # ]
+def get_function_call_list(action_data_list, token_budget=None):
+    """
+    The function schemas of the actions, in the same order. With a token_budget, the schemas that don't fit
+    are left out, starting from the front of the list where the least likely actions are.
+    """
+    if token_budget is None:
+        return [action_data.function_schema() for action_data in action_data_list]
+
     functions = []
-    for action_data in action_data_list:
-        params = action_data.class_instance.inputs.inputs
-        required_params = [param.input_name for param in params if param.required]
-        properties = {p.input_name: {'type': p.fvalue.type_str, 'description': p.description()} for p in params}
-        function = {
-            "name": action_data.name,
-            "description": action_data.desc,
-            "parameters": {
-                "type": "object",
-                "properties": properties,
-                "required": required_params
-            }
-        }
-        functions.append(function)
-    return functions
+    used_tokens = 0
+    for action_data in reversed(action_data_list):
+        schema, schema_tokens = action_data.get_function_schema()
+        if used_tokens + schema_tokens > token_budget:
+            break
+        used_tokens += schema_tokens
+        functions.append(schema)
+    return list(reversed(functions))
 
 
 def get_action_tree():
@@ -6,3 +6,96 @@ def cosine_similarity(vec1, vec2):
     norm1 = np.linalg.norm(vec1)
     norm2 = np.linalg.norm(vec2)
     return dot_product / (norm1 * norm2)
+
+
+def normalize(vectors):
+    """Scale vectors (1D, or the rows of a 2D matrix) to unit length, zero vectors stay zero"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def top_k(scores, k):
+    """
+    Indexes of the k highest scores, best first. Same result as a stable argsort of -scores,
+    but argpartition only fully sorts the candidates, ties keep their index order.
+    """
+    scores = np.asarray(scores)
+    if k >= len(scores):
+        return np.argsort(-scores, kind='stable')
+    if k <= 0:
+        return np.array([], dtype=np.intp)
+    partition = np.argpartition(-scores, k - 1)[:k]
+    candidates = np.flatnonzero(scores >= scores[partition].min())  # includes every tie at the boundary
+    return candidates[np.argsort(-scores[candidates], kind='stable')][:k]
+
+
+class VectorIndex:
+    """
+    Top-k cosine search over the rows of a matrix, scoring a batch of query vectors at once.
+    Brute force by default. With method='hnsw' and hnswlib installed, sets of at least
+    hnsw_min_size vectors use an approximate HNSW graph instead.
+    """
+    hnsw_min_size = 1000
+
+    def __init__(self, vectors, method='brute'):
+        self.vectors = np.ascontiguousarray(normalize(vectors))
+        self.method = 'brute'
+        self.hnsw = None
+        if method == 'hnsw' and len(self.vectors) >= self.hnsw_min_size:
+            self.hnsw = self.build_hnsw(self.vectors)
+            if self.hnsw is not None:
+                self.method = 'hnsw'
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @staticmethod
+    def build_hnsw(vectors):
+        try:
+            import hnswlib
+        except ImportError:
+            return None
+        count, dims = vectors.shape
+        hnsw = hnswlib.Index(space='ip', dim=dims)  # vectors are normalised, so inner product = cosine
+        hnsw.init_index(max_elements=count, ef_construction=200, M=16)
+        hnsw.add_items(vectors, np.arange(count))
+        return hnsw
+
+    def scores(self, queries, indexes=None):
+        """Best similarity over all the queries, for every vector (or just the given row indexes)"""
+        queries = normalize(np.atleast_2d(queries))
+        vectors = self.vectors if indexes is None else self.vectors[indexes]
+        return (vectors @ queries.T).max(axis=1)
+
+    def search(self, queries, k, mask=None):
+        """Row indexes of the k best matches (best first), optionally only rows where mask is True"""
+        if self.hnsw is not None:
+            try:
+                return self.search_hnsw(queries, k, mask)
+            except RuntimeError:
+                pass  # hnswlib can't always find k neighbours that pass the filter, fall back to exact
+
+        indexes = np.arange(len(self.vectors)) if mask is None else np.flatnonzero(mask)
+        if len(indexes) == 0:
+            return indexes
+        return indexes[top_k(self.scores(queries, indexes), k)]
+
+    def search_hnsw(self, queries, k, mask=None):
+        queries = normalize(np.atleast_2d(queries))
+        allowed = len(self.vectors) if mask is None else int(np.count_nonzero(mask))
+        k = min(k, allowed)
+        if k == 0:
+            return np.array([], dtype=np.intp)
+        self.hnsw.set_ef(max(k * 4, 50))
+        row_filter = None if mask is None else (lambda label: bool(mask[label]))
+        labels, distances = self.hnsw.knn_query(queries, k=k, filter=row_filter)
+
+        # Merge the neighbours of each query, keeping the best similarity for each row
+        best = {}
+        for label, distance in zip(labels.ravel(), distances.ravel()):
+            best[int(label)] = max(best.get(int(label), -np.inf), 1 - distance)
+        found = np.array(sorted(best), dtype=np.intp)
+        found_scores = np.array([best[label] for label in found], dtype=np.float32)
+        return found[top_k(found_scores, k)]
@@ -1,16 +1,229 @@
 import asyncio
+import collections
+import contextvars
+import functools
 import os.path
+import queue
 import sqlite3
 import sys
 import threading
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 
 from packaging import version
 
+from agentpilot.utils import config
 
-sql_thread_lock = threading.Lock()
+
+sql_thread_lock = threading.Lock()  # only used by the 'rollback' storage mode
+
+db_path = None  # resolved once by get_db_path()
+statement_cache_size = 256  # per connection, see sqlite3.connect(cached_statements=..)
+
+# Storage modes:
+#  wal       WAL journal, every write goes through the single writer thread, reads never block on it
+#  rollback  default sqlite journal, writes serialised by sql_thread_lock (previous behaviour)
+storage_mode = config.get_value('system.db_storage_mode', 'wal')
+
+# WAL is persistent in the database file, so 'rollback' mode has to switch it back
+rollback_pragmas = {
+    'journal_mode': 'DELETE',
+}
+
+wal_pragmas = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',  # WAL is still durable on app crash, only an OS crash can lose the last commits
+    'cache_size': -16000,  # negative = KiB, so 16MB
+    'mmap_size': 268435456,  # 256MB
+    'busy_timeout': 5000,
+}
+
+
+def close_quietly(conn):
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+
+class ThreadConnection:
+    """Holds a thread's connection in its thread local, the connection is closed once the thread has exited"""
+    def __init__(self, conn, generation):
+        self.conn = conn
+        self.generation = generation
+        self.finalizer = weakref.finalize(self, close_quietly, conn)
+
+
+class ConnectionManager:
+    """Keeps one long-lived sqlite connection per thread instead of connecting per query"""
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.holders = weakref.WeakSet()  # the ThreadConnection of every live thread, so close_all() can close them
+        self.generation = 0  # bumped by close_all() so threads reopen lazily
+        self.connect_count = 0
+
+    def get(self):
+        holder = getattr(self.local, 'holder', None)
+        if holder is not None and holder.generation == self.generation:
+            return holder.conn
+
+        conn = sqlite3.connect(get_db_path(),
+                               check_same_thread=False,
+                               cached_statements=statement_cache_size)
+        pragmas = wal_pragmas if storage_mode == 'wal' else rollback_pragmas
+        for pragma, value in pragmas.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        holder = ThreadConnection(conn, self.generation)
+        with self.lock:
+            self.holders.add(holder)
+            self.connect_count += 1
+        self.local.holder = holder
+        return conn
+
+    def open_count(self):
+        with self.lock:
+            return sum(1 for holder in self.holders if holder.finalizer.alive)
+
+    def close_all(self):
+        writer.flush()
+        with self.lock:
+            self.generation += 1
+            for holder in list(self.holders):
+                holder.finalizer()
+            self.holders = weakref.WeakSet()
+
+
+class SQLWriter:
+    """
+    The single thread that performs every write in 'wal' mode, fed by a queue.
+    While a batch() transaction is open on its connection, jobs from anyone else are held until it ends
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.held = collections.deque()  # jobs waiting for the open batch to end
+        self.owner = None  # the Batch whose transaction is open, only changed on the writer thread
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.run, name='sql-writer', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            if self.owner is None and self.held:
+                func, future, owner = self.held.popleft()
+            else:
+                func, future, owner = self.queue.get()
+            if self.owner is not None and owner is not self.owner:
+                self.held.append((func, future, owner))
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(connections.get()) if func is not None else None)
+            except BaseException as e:
+                future.set_exception(e)
+
+    def submit(self, func, owner=None):
+        """Queue func(conn) to run on the writer thread, returns a concurrent.futures.Future"""
+        future = Future()
+        if threading.current_thread() is self.thread:
+            # Nested write from inside a queued job, run it inline to avoid deadlocking
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(func(connections.get()))
+            except BaseException as e:
+                future.set_exception(e)
+            return future
+
+        self.start()
+        self.queue.put((func, future, owner))
+        return future
+
+    def flush(self):
+        """Wait until every write queued so far has finished"""
+        if self.thread is None or threading.current_thread() is self.thread:
+            return
+        # A marker rather than a job, so flushing never opens a connection, eg. to a db_path being switched away from
+        future = Future()
+        self.queue.put((None, future, get_batch()))
+        future.result()
+
+
+class Batch:
+    """
+    The transaction of a sql.batch() block, opened on the writer thread's connection by the block's first write.
+    From then on the block's reads and writes all run on that connection, so they see each other
+    and are committed or rolled back together
+    """
+    def __init__(self):
+        self.begun = False
+        self.lock = threading.Lock()
+
+    def submit(self, func):
+        """Queue func(conn) inside the transaction, opening it first if needed. Returns a concurrent.futures.Future"""
+        with self.lock:
+            if not self.begun:
+                check_loop_can_wait(self)
+                writer.submit(self._begin, owner=self).result()
+                self.begun = True
+        return writer.submit(func, owner=self)
+
+    def run(self, func):
+        return self.submit(func).result()
+
+    def end(self, commit):
+        with self.lock:
+            if not self.begun:
+                return
+            self.begun = False
+        writer.submit(functools.partial(self._end, commit=commit), owner=self).result()
+
+    def _begin(self, conn):
+        if storage_mode != 'wal':
+            sql_thread_lock.acquire()  # released by _end(), on this same thread
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            if storage_mode != 'wal':
+                sql_thread_lock.release()
+            raise
+        writer.owner = self
+
+    def _end(self, conn, commit):
+        try:
+            if commit:
+                try:
+                    conn.commit()
+                except BaseException:
+                    conn.rollback()
+                    raise
+            else:
+                conn.rollback()
+        finally:
+            writer.owner = None
+            if storage_mode != 'wal':
+                sql_thread_lock.release()
+
+
+connections = ConnectionManager()
+writer = SQLWriter()
+# A context variable rather than a thread local, so asyncio tasks sharing a thread each get their own batch
+current_batch_var = contextvars.ContextVar('sql_batch', default=None)
+read_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='sql-reader')  # used by the awaitable API
 
 
 def get_db_path():
+    global db_path
+    if db_path is not None:
+        return db_path
+
     from agentpilot.utils.filesystem import get_application_path
     # Check if we're running as a script or a frozen exe
     if getattr(sys, 'frozen', False):
@@ -18,52 +231,146 @@ def get_db_path():
     else:
         application_path = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir))
 
-    ret = os.path.join(application_path, 'data.db')
-    return ret
+    db_path = os.path.join(application_path, 'data.db')
+    return db_path
 
 
-def execute(query, params=None):
+def set_db_path(path):
+    """Point the module at a different database file, closing any open connections"""
+    global db_path
+    close_connections()
+    db_path = path
+
+
+def get_connection():
+    return connections.get()
+
+
+def close_connections():
+    connections.close_all()
+
+
+def checkpoint():
+    """Fold the WAL file back into the main database file, eg. before copying data.db"""
+    if storage_mode != 'wal':
+        return
+    run_write(lambda conn: conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall())
+
+
+@contextmanager
+def batch():
+    """
+    Unit of work for the calling thread or asyncio task, committed in one transaction when the block exits,
+    or rolled back if it raises. Reads and inserts inside the block see its uncommitted writes.
+    The transaction is opened by the first write and holds the database's write lock until the block exits,
+    writes from other threads wait for it, so keep slow calls (eg. to an LLM) out of the block.
+    Nested batches join the outermost one.
+    """
+    current_batch = current_batch_var.get()
+    if current_batch is not None:
+        yield current_batch
+        return
+
+    current_batch = Batch()
+    token = current_batch_var.set(current_batch)
+    try:
+        yield current_batch
+    except BaseException:
+        current_batch.end(commit=False)
+        raise
+    else:
+        current_batch.end(commit=True)
+    finally:
+        current_batch_var.reset(token)
+
+
+def get_batch():
+    return current_batch_var.get()
+
+
+def check_loop_can_wait(current_batch=None):
+    """
+    Raises rather than letting a blocking write on an event loop's thread wait for another batch's transaction.
+    That batch may belong to a task on the same loop, which could then never resume to end it
+    """
+    owner = writer.owner
+    if owner is None or owner is current_batch:
+        return
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return  # not on an event loop's thread, waiting is fine
+    raise RuntimeError('Blocking sql write on the event loop while another batch is open, use the awaitable API')
+
+
+def run_write(func):
+    """
+    Run func(conn) as a write: inside the current batch's transaction, on the writer thread in 'wal' mode,
+    or under sql_thread_lock otherwise
+    """
+    current_batch = get_batch()
+    if current_batch is not None:
+        return current_batch.run(func)
+
+    check_loop_can_wait()
+
+    if storage_mode == 'wal':
+        return writer.submit(func).result()
+
     with sql_thread_lock:
-        # Connect to the database
-        db_path = get_db_path()
-        with sqlite3.connect(db_path) as conn:
-            # Create a cursor object
-            cursor = conn.cursor()
-
-            # Execute the query
-            if params:
-                cursor.execute(query, params)
-            else:
-                cursor.execute(query)
+        return func(get_connection())
 
-            # Commit the changes
-            # conn.commit()
 
-            # Close the cursor and connection
-            cursor.close()
-            # conn.close()
-            return cursor.lastrowid
+def run_read(func):
+    """Run func(conn) as a read, inside the current batch's transaction once a write has opened it"""
+    current_batch = get_batch()
+    if current_batch is not None and current_batch.begun:
+        return current_batch.run(func)
+    return func(get_connection())
 
 
-def get_results(query, params=None, return_type='rows', incl_column_names=False):
-    # Connect to the database
-    db_path = get_db_path()
-    with sqlite3.connect(db_path) as conn:
-        # Create a cursor object
-        cursor = conn.cursor()
+def _execute_in_batch(conn, query, params):
+    # Left uncommitted, Batch.end() commits or rolls back
+    cursor = conn.execute(query, params or ())
+    lastrowid = cursor.lastrowid
+    cursor.close()
+    return lastrowid
+
 
-        # Execute the query
-        if params:
+def _execute_multiple_in_batch(conn, queries, params_list):
+    cursor = conn.cursor()
+    try:
+        for query, params in zip(queries, params_list):
             cursor.execute(query, params)
-        else:
-            cursor.execute(query)
+        return cursor.lastrowid
+    finally:
+        cursor.close()
 
-        # Fetch all the rows as a list of tuples
-        rows = cursor.fetchall()
 
-        # Close the cursor and connection
+def _execute(conn, query, params):
+    # Commits on success, rolls back on exception
+    with conn:
+        cursor = conn.execute(query, params or ())
+        lastrowid = cursor.lastrowid
         cursor.close()
-        # conn.close()
+        return lastrowid
+
+
+def execute(query, params=None):
+    """Returns the lastrowid"""
+    current_batch = get_batch()
+    if current_batch is not None:
+        return current_batch.run(lambda conn: _execute_in_batch(conn, query, params))
+
+    return run_write(lambda conn: _execute(conn, query, params))
+
+
+def _get_results(conn, query, params, return_type, incl_column_names):
+    cursor = conn.execute(query, params or ())
+
+    # Fetch all the rows as a list of tuples
+    rows = cursor.fetchall()
+    cursor.close()
 
     col_names = [description[0] for description in cursor.description]
 
@@ -90,29 +397,24 @@ def get_results(query, params=None, return_type='rows', incl_column_names=False)
         return ret_val
 
 
-def get_scalar(query, params=None):
-    # Connect to the database
-    db_path = get_db_path()
-    with sqlite3.connect(db_path) as conn:
-        # Create a cursor object
-        cursor = conn.cursor()
+def get_results(query, params=None, return_type='rows', incl_column_names=False):
+    return run_read(lambda conn: _get_results(conn, query, params, return_type, incl_column_names))
 
-        # Execute the query
-        if params:
-            cursor.execute(query, params)
-        else:
-            cursor.execute(query)
 
-        # Fetch the first row
-        row = cursor.fetchone()
+def _get_scalar(conn, query, params):
+    cursor = conn.execute(query, params or ())
 
-        # Close the cursor and connection
-        cursor.close()
-        # conn.close()
+    # Fetch the first row
+    row = cursor.fetchone()
+    cursor.close()
 
-        if row is None:
-            return None
-        return row[0]
+    if row is None:
+        return None
+    return row[0]
+
+
+def get_scalar(query, params=None):
+    return run_read(lambda conn: _get_scalar(conn, query, params))
 
 
 def check_database_upgrade():
@@ -123,7 +425,7 @@ def check_database_upgrade():
 
     db_version_str = get_scalar("SELECT value as app_version FROM settings WHERE field = 'app_version'")
     db_version = version.parse(db_version_str)
-    app_version = version.parse('0.1.0')
+    app_version = version.parse('0.1.4')
     if db_version > app_version:
         raise Exception('OUTDATED_APP')
     elif db_version < app_version:
@@ -132,21 +434,86 @@ def check_database_upgrade():
         return None
 
 
+def _execute_multiple(conn, queries, params_list):
+    # Returns the lastrowid of the last statement
+    cursor = conn.cursor()
+    try:
+        for query, params in zip(queries, params_list):
+            cursor.execute(query, params)
+        conn.commit()
+        return cursor.lastrowid
+    except Exception as e:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
 def execute_multiple(queries, params_list):
-    with sql_thread_lock:
-        # Connect to the database
-        db_path = get_db_path()
-        with sqlite3.connect(db_path) as conn:
-            # try:
-                # Create a cursor object
-            cursor = conn.cursor()
+    current_batch = get_batch()
+    if current_batch is not None:
+        return current_batch.run(lambda conn: _execute_multiple_in_batch(conn, queries, params_list))
 
-            try:
-                for query, params in zip(queries, params_list):
-                    cursor.execute(query, params)
-                conn.commit()
-            except Exception as e:
-                conn.rollback()
-                raise
-            finally:
-                cursor.close()
+    return run_write(lambda conn: _execute_multiple(conn, queries, params_list))
+
+
+def insert(query, params=None):
+    """Like execute(), always returns the new row id"""
+    return execute(query, params)
+
+
+# Awaitable versions of the functions above, for coroutines running on Context.loop.
+# Reads run on read_executor, writes are awaited on the writer thread (or read_executor in 'rollback' mode).
+# Inside a batch() they are awaited on its transaction, like the blocking versions.
+
+async def arun_write(func):
+    current_batch = get_batch()
+    if current_batch is not None:
+        loop = asyncio.get_running_loop()
+        if not current_batch.begun:
+            # Opening the transaction can wait on another batch, so not on the loop
+            return await loop.run_in_executor(read_executor, current_batch.run, func)
+        return await asyncio.wrap_future(current_batch.submit(func))
+
+    if storage_mode == 'wal':
+        return await asyncio.wrap_future(writer.submit(func))
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(read_executor, run_write, func)
+
+
+async def arun_read(func):
+    current_batch = get_batch()
+    if current_batch is not None and current_batch.begun:
+        return await asyncio.wrap_future(current_batch.submit(func))
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(read_executor, lambda: func(get_connection()))
+
+
+async def aexecute(query, params=None):
+    current_batch = get_batch()
+    if current_batch is not None:
+        return await arun_write(lambda conn: _execute_in_batch(conn, query, params))
+
+    return await arun_write(lambda conn: _execute(conn, query, params))
+
+
+async def aexecute_multiple(queries, params_list):
+    current_batch = get_batch()
+    if current_batch is not None:
+        return await arun_write(lambda conn: _execute_multiple_in_batch(conn, queries, params_list))
+
+    return await arun_write(lambda conn: _execute_multiple(conn, queries, params_list))
+
+
+async def ainsert(query, params=None):
+    return await aexecute(query, params)
+
+
+async def aget_results(query, params=None, return_type='rows', incl_column_names=False):
+    return await arun_read(lambda conn: _get_results(conn, query, params, return_type, incl_column_names))
+
+
+async def aget_scalar(query, params=None):
+    return await arun_read(lambda conn: _get_scalar(conn, query, params))
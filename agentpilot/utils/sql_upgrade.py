@@ -1,7 +1,7 @@
 import os
 import shutil
 
-from agentpilot.utils import sql
+from agentpilot.utils import sql, embeddings
 from packaging import version
 
 
@@ -322,30 +322,137 @@ class SQLUpgrade:
 
         return '0.1.0'
 
-    def upgrade(self, current_version):
-        # make a backup of the current data.db
+    def v0_1_1(self):
+        # Indexes for the context tree and message history lookups
+        sql.execute("""
+            CREATE INDEX IF NOT EXISTS "ctx_parent_indx" ON "contexts" (
+                "parent_id",
+                "active",
+                "branch_msg_id"
+            )""")
+        sql.execute("""
+            CREATE INDEX IF NOT EXISTS "msg_ctx_indx" ON "contexts_messages" (
+                "context_id"
+            )""")
+        sql.execute("""
+            CREATE INDEX IF NOT EXISTS "mem_ctx_indx" ON "contexts_members" (
+                "context_id",
+                "agent_id"
+            )""")
+        sql.execute("""
+            UPDATE settings SET value = '0.1.1' WHERE field = 'app_version'""")
+
+        return '0.1.1'
+
+    def v0_1_2(self):
+        # Store embeddings as float32 blobs instead of comma separated text
+        sql.execute("""
+            CREATE TABLE "embeddings_new" (
+                "id"	INTEGER,
+                "original_text"	TEXT NOT NULL UNIQUE,
+                "embedding"	BLOB NOT NULL,
+                PRIMARY KEY("id" AUTOINCREMENT)
+            )""")
+        text_embeddings = sql.get_results("""
+            SELECT id, original_text, embedding FROM embeddings""")
+        sql.execute_multiple(
+            ["INSERT INTO embeddings_new (id, original_text, embedding) VALUES (?, ?, ?)"] * len(text_embeddings),
+            [(em_id, original_text, embeddings.embedding_to_blob(embeddings.string_embeddings_to_array(embedding)))
+             for em_id, original_text, embedding in text_embeddings])
+        sql.execute("""
+            DROP TABLE embeddings""")
+        sql.execute("""
+            ALTER TABLE embeddings_new RENAME TO embeddings""")
+
+        sql.execute("""
+            UPDATE settings SET value = '0.1.2' WHERE field = 'app_version'""")
+
+        sql.execute("""
+            VACUUM""")
+
+        return '0.1.2'
+
+    def v0_1_3(self):
+        # Token counts are saved with each new message, older rows stay NULL and are counted when read
+        sql.execute("""
+            ALTER TABLE contexts_messages ADD COLUMN "token_count" INTEGER DEFAULT NULL""")
+        sql.execute("""
+            UPDATE settings SET value = '0.1.3' WHERE field = 'app_version'""")
+
+        return '0.1.3'
+
+    def v0_1_4(self):
+        # Opt-in cache of llm.get_scalar responses, evicted least recently used first
+        sql.execute("""
+            CREATE TABLE IF NOT EXISTS "llm_cache" (
+                "key"	TEXT NOT NULL,
+                "model"	TEXT NOT NULL,
+                "response"	TEXT NOT NULL,
+                "last_used"	REAL NOT NULL,
+                "hits"	INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY("key")
+            )""")
+        sql.execute("""
+            CREATE INDEX IF NOT EXISTS "llm_cache_last_used_indx" ON "llm_cache" (
+                "last_used"
+            )""")
+        sql.execute("""
+            UPDATE settings SET value = '0.1.4' WHERE field = 'app_version'""")
+
+        return '0.1.4'
+
+    def upgrade_to_latest(self, current_version):
+        """Runs each upgrade in turn from `current_version`, returns the latest version"""
+        if str(current_version) == versions[-1]:
+            return str(current_version)
+
+        # one backup of the current data.db, restored if any step fails
+        backup_path = self.backup(current_version)
+        try:
+            while str(current_version) != versions[-1]:
+                current_version = self.upgrade(current_version)
+        except Exception as e:
+            self.restore(backup_path)
+            raise e
+        return current_version
+
+    def backup(self, current_version):
         db_path = sql.get_db_path()
-        backup_path = db_path + '.backup_v0.0.8'
+        backup_path = db_path + f'.backup_v{current_version}'
 
         # check if the backup file already exists
         num = 1
         while os.path.isfile(backup_path):
-            backup_path = db_path + f'({str(num)}).backup_v0.0.8'
+            backup_path = db_path + f'({str(num)}).backup_v{current_version}'
             num += 1
+        sql.checkpoint()
         shutil.copyfile(db_path, backup_path)
+        return backup_path
 
-        try:
-            if current_version < version.parse("0.1.0"):
-                return self.v0_1_0()
-            else:
-                return str(current_version)
+    def restore(self, backup_path):
+        db_path = sql.get_db_path()
+        sql.close_connections()
+        os.remove(db_path)
+        for wal_file in (db_path + '-wal', db_path + '-shm'):
+            if os.path.isfile(wal_file):
+                os.remove(wal_file)
+        shutil.copyfile(backup_path, db_path)
 
-        except Exception as e:
-            # restore the backup
-            os.remove(db_path)
-            shutil.copyfile(backup_path, db_path)
-            raise e
+    def upgrade(self, current_version):
+        current_version = version.parse(str(current_version))
+        if current_version < version.parse("0.1.0"):
+            return self.v0_1_0()
+        elif current_version < version.parse("0.1.1"):
+            return self.v0_1_1()
+        elif current_version < version.parse("0.1.2"):
+            return self.v0_1_2()
+        elif current_version < version.parse("0.1.3"):
+            return self.v0_1_3()
+        elif current_version < version.parse("0.1.4"):
+            return self.v0_1_4()
+        else:
+            return str(current_version)
 
 
 upgrade_script = SQLUpgrade()
-versions = ['0.0.8', '0.1.0']
+versions = ['0.0.8', '0.1.0', '0.1.1', '0.1.2', '0.1.3', '0.1.4']
@@ -0,0 +1,19 @@
+import tiktoken
+
+token_count_model = 'gpt-3.5-turbo'  # the persisted token_count column is counted with this model's encoder
+encoders = {}  # {model: tiktoken.Encoding}, building an encoder is far slower than using one
+
+
+def get_encoder(model=token_count_model):
+    encoder = encoders.get(model)
+    if encoder is None:
+        try:
+            encoder = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoder = tiktoken.get_encoding('cl100k_base')
+        encoders[model] = encoder
+    return encoder
+
+
+def count_tokens(text, model=token_count_model):
+    return len(get_encoder(model).encode(text))
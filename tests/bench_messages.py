@@ -0,0 +1,82 @@
+"""Benchmark of MessageHistory.add latency as a conversation grows, against a copy of data.db.
+
+Compares appending in place with the previous behaviour of reloading every message after each insert.
+Embedding lookups and token counts are stubbed out because they need the network,
+so the reload numbers are a lower bound.
+Run with: python tests/bench_messages.py [max_messages]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+
+from agentpilot.utils import sql
+from agentpilot.utils.sql_upgrade import upgrade_script
+from agentpilot.context import messages
+from agentpilot.context.messages import MessageHistory, MESSAGES_QUERY
+
+SAMPLES = 20
+
+
+def new_history():
+    context_id = sql.insert("INSERT INTO contexts (id) VALUES (NULL)")
+    history = MessageHistory(SimpleNamespace(id=context_id, leaf_id=context_id, members={}, member_configs={}))
+    history.load()
+    return history
+
+
+def fill(history, count):
+    queries = ["INSERT INTO contexts_messages (context_id, role, msg) VALUES (?, ?, ?)"] * count
+    params_list = [(history.context.leaf_id, 'user' if i % 2 == 0 else 'assistant', f'Filler message {i}')
+                   for i in range(count)]
+    sql.execute_multiple(queries, params_list)
+    load_all(history)
+
+
+def load_all(history):
+    """The unwindowed full reload that add() used to do"""
+    msg_log = sql.get_results(MESSAGES_QUERY, (history.context.leaf_id, 0))
+    history.set_messages(history.build_messages(msg_log))
+
+
+def bench_add(history, reload):
+    start = time.perf_counter()
+    for i in range(SAMPLES):
+        history.add('user', f'Benchmark message {i}')
+        if reload:
+            load_all(history)
+    return (time.perf_counter() - start) / SAMPLES
+
+
+def main(max_messages=5000):
+    sizes = [size for size in (10, 100, 1000, 2500, 5000, 10000) if size <= max_messages]
+    src_path = sql.get_db_path()
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            patch.object(messages.embeddings, 'get_embedding', return_value=(None, None)), \
+            patch.object(messages, 'count_tokens', side_effect=lambda text: len(text.split())):
+        db_path = os.path.join(tmp_dir, 'data.db')
+        shutil.copyfile(src_path, db_path)
+        sql.set_db_path(db_path)
+        db_version = sql.check_database_upgrade()
+        if db_version:
+            upgrade_script.upgrade_to_latest(db_version)
+
+        print(f'{"messages":>10} {"append (ms)":>14} {"reload (ms)":>14}')
+        for size in sizes:
+            results = []
+            for reload in (False, True):
+                history = new_history()
+                fill(history, size)
+                results.append(bench_add(history, reload))
+            print(f'{size:>10,} {results[0] * 1e3:>14.3f} {results[1] * 1e3:>14.3f}')
+
+        sql.close_connections()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
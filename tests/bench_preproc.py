@@ -0,0 +1,44 @@
+"""Benchmark of Stream_Speak.preproc_text over a corpus of assistant message segments.
+
+Compares the compiled, trigger-scanned pipeline with the previous one, which ran every pattern on every segment
+and rebuilt the emoji pattern each call. Outputs are checked to match before timing.
+Run with: python tests/bench_preproc.py [repeats]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+
+from agentpilot.agent import speech
+from test_tts_preproc import CORPUS, EDGE_CASES, legacy_preproc_text
+
+PLAIN = [text for text in CORPUS if speech.TRIGGER_PATTERN.search(text) is None]
+CORPORA = {
+    'all': CORPUS + EDGE_CASES,
+    'plain': PLAIN,
+    'rewritten': [text for text in CORPUS + EDGE_CASES if text not in PLAIN],
+}
+
+
+def bench(func, corpus, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for text in corpus:
+            func(text)
+    return (time.perf_counter() - start) / (repeats * len(corpus))
+
+
+def main(repeats=2000):
+    for text in CORPUS + EDGE_CASES:
+        assert speech.preproc_text(text) == legacy_preproc_text(text), text
+
+    print(f'{"corpus":>10} {"segments":>9} {"legacy (us)":>12} {"compiled (us)":>14} {"speedup":>8}')
+    for name, corpus in CORPORA.items():
+        legacy = bench(legacy_preproc_text, corpus, repeats)
+        compiled = bench(speech.preproc_text, corpus, repeats)
+        print(f'{name:>10} {len(corpus):>9} {legacy * 1e6:>12.2f} {compiled * 1e6:>14.2f} {legacy / compiled:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,68 @@
+"""Benchmark of sql.py connection handling against a copy of data.db.
+
+Compares the old connect-per-query approach with the pooled, thread-affine connections.
+Run with: python tests/bench_sql.py [iterations]
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+
+from agentpilot.utils import sql
+
+QUERY = "SELECT value FROM settings WHERE field = ?"
+PARAMS = ('app_version',)
+
+
+def bench_connects(db_path, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        conn = sqlite3.connect(db_path)
+        conn.close()
+    return iterations / (time.perf_counter() - start)
+
+
+def bench_connect_per_query(db_path, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        with sqlite3.connect(db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute(QUERY, PARAMS)
+            cursor.fetchone()
+            cursor.close()
+    return (time.perf_counter() - start) / iterations
+
+
+def bench_pooled(iterations):
+    sql.get_scalar(QUERY, PARAMS)  # warm the connection
+    start = time.perf_counter()
+    for _ in range(iterations):
+        sql.get_scalar(QUERY, PARAMS)
+    return (time.perf_counter() - start) / iterations
+
+
+def main(iterations=5000):
+    src_path = sql.get_db_path()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'data.db')
+        shutil.copyfile(src_path, db_path)
+        sql.set_db_path(db_path)
+
+        connects_per_sec = bench_connects(db_path, iterations)
+        before = bench_connect_per_query(db_path, iterations)
+        after = bench_pooled(iterations)
+        sql.close_connections()
+
+    print(f'connects/sec:                 {connects_per_sec:,.0f}')
+    print(f'per-query latency (before):   {before * 1e6:,.1f} us')
+    print(f'per-query latency (after):    {after * 1e6:,.1f} us')
+    print(f'connections opened (after):   {sql.connections.connect_count}')
+    print(f'speedup:                      {before / after:,.1f}x')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,32 @@
+"""Runs tests against an upgraded copy of the shipped data.db, so the real one is never written to"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from agentpilot.utils import sql
+from agentpilot.utils.sql_upgrade import upgrade_script
+
+
+def use_db_copy():
+    """Points sql.py at a copy of data.db with the latest upgrade applied, returns a function that undoes it"""
+    src_db_path = sql.get_db_path()
+    tmp_dir = tempfile.mkdtemp()
+    db_path = os.path.join(tmp_dir, 'data.db')
+    shutil.copyfile(src_db_path, db_path)
+    sql.set_db_path(db_path)
+
+    db_version = sql.check_database_upgrade()
+    if db_version:
+        upgrade_script.upgrade_to_latest(db_version)
+
+    def restore():
+        sql.set_db_path(src_db_path)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return restore
+
+
+class ShippedDBTestCase(unittest.TestCase):
+    """Each test gets its own copy of data.db"""
+    def setUp(self):
+        self.addCleanup(use_db_copy())
@@ -0,0 +1,178 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+
+from agentpilot.operations.action import BaseAction
+from agentpilot.utils import retrieval
+
+
+class Add_Item_To_List(BaseAction):
+    def __init__(self, agent):
+        super().__init__(agent, example='add milk to my shopping list')
+        self.desc_prefix = 'requires me to'
+        self.desc = 'Add something to a list'
+        self.inputs.add('which-list/s')
+        self.inputs.add('what_to_add', required=False)
+
+
+class Create_A_New_List(BaseAction):
+    def __init__(self, agent):
+        super().__init__(agent, example='create a new list')
+        self.desc_prefix = 'requires me to'
+        self.desc = 'Create a new list'
+        self.inputs.add('list-name')
+
+
+def fake_embedding(text):
+    return 1, np.array([len(text), 1.0, 0.5], dtype=np.float32)
+
+
+class TestActionIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.tmp_dir, 'action_index.npz')
+
+        # Counting schema tokens needs tiktoken's encoder files, count words instead
+        patcher = patch.object(retrieval, 'count_tokens', side_effect=lambda text: len(text.split()))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for file_name in os.listdir(self.tmp_dir):
+            os.remove(os.path.join(self.tmp_dir, file_name))
+        os.rmdir(self.tmp_dir)
+
+    def make_categories(self):
+        with patch.object(retrieval.embeddings, 'get_embedding', side_effect=fake_embedding):
+            lists = retrieval.ActionCategory.from_index({'name': 'Lists', 'desc': 'Lists', 'desc_prefix': ''},
+                                                        embedding=None)
+            for clss in (Add_Item_To_List, Create_A_New_List):
+                lists.all_actions_data[clss.__name__] = retrieval.ActionData(clss)
+        return [lists]
+
+    def test_round_trip(self):
+        categories = self.make_categories()
+        retrieval.save_action_index(self.index_path, 'abc', categories)
+        loaded, source_hash = retrieval.read_action_index(self.index_path)
+
+        self.assertEqual(source_hash, 'abc')
+        self.assertEqual([c.name for c in loaded], ['Lists'])
+        self.assertIsNone(loaded[0].embedding)
+        for name, action_data in categories[0].all_actions_data.items():
+            loaded_data = loaded[0].all_actions_data[name]
+            self.assertEqual(loaded_data.desc, action_data.desc)
+            self.assertEqual(loaded_data.full_desc, action_data.full_desc)
+            self.assertEqual(loaded_data.get_function_schema(), action_data.get_function_schema())
+            np.testing.assert_array_equal(loaded_data.embedding, action_data.embedding)
+            self.assertIs(loaded_data.clss, action_data.clss)  # imported lazily from the stored module name
+
+    def test_missing_or_corrupt_index(self):
+        self.assertEqual(retrieval.read_action_index(self.index_path), (None, None))
+        with open(self.index_path, 'wb') as f:
+            f.write(b'not an index')
+        self.assertEqual(retrieval.read_action_index(self.index_path), (None, None))
+
+    def test_truncated_index(self):
+        retrieval.save_action_index(self.index_path, 'abc', self.make_categories())
+        with open(self.index_path, 'rb') as f:
+            data = f.read()
+        with open(self.index_path, 'wb') as f:
+            f.write(data[:len(data) // 2])
+        self.assertEqual(retrieval.read_action_index(self.index_path), (None, None))
+
+    def test_source_hash(self):
+        for name in ('Lists', 'Alarms'):
+            with open(os.path.join(self.tmp_dir, f'{name}.py'), 'w') as f:
+                f.write(f'desc = "{name}"\n')
+        first = retrieval.hash_action_files(self.tmp_dir, ['Lists', 'Alarms'])
+        self.assertEqual(first, retrieval.hash_action_files(self.tmp_dir, ['Alarms', 'Lists']))
+
+        with open(os.path.join(self.tmp_dir, 'Lists.py'), 'a') as f:
+            f.write('# changed\n')
+        self.assertNotEqual(first, retrieval.hash_action_files(self.tmp_dir, ['Lists', 'Alarms']))
+
+    def test_schema_code_changes_the_hash(self):
+        with open(os.path.join(self.tmp_dir, 'Lists.py'), 'w') as f:
+            f.write('desc = "Lists"\n')
+        schema_file = os.path.join(self.tmp_dir, 'parameters.py')
+        with open(schema_file, 'w') as f:
+            f.write('TYPES = {}\n')
+        with patch.object(retrieval, 'SCHEMA_SOURCE_FILES', [schema_file]):
+            first = retrieval.hash_action_files(self.tmp_dir, ['Lists'])
+            with open(schema_file, 'a') as f:
+                f.write('# changed\n')
+            self.assertNotEqual(first, retrieval.hash_action_files(self.tmp_dir, ['Lists']))
+
+    def test_only_changed_descriptions_are_embedded(self):
+        known_embeddings = {'Add something to a list': np.ones(3, dtype=np.float32)}
+        with patch.object(retrieval.embeddings, 'get_embedding', side_effect=fake_embedding) as get_embedding:
+            unchanged = retrieval.ActionData(Add_Item_To_List, known_embeddings)
+            changed = retrieval.ActionData(Create_A_New_List, known_embeddings)
+
+        get_embedding.assert_called_once_with('Create a new list')
+        np.testing.assert_array_equal(unchanged.embedding, np.ones(3))
+        np.testing.assert_array_equal(changed.embedding, fake_embedding('Create a new list')[1])
+
+
+class TestFunctionSchemas(unittest.TestCase):
+    def setUp(self):
+        patchers = [
+            patch.object(retrieval, 'count_tokens', side_effect=lambda text: len(text.split())),
+            patch.object(retrieval, 'function_schema_cache', {}),
+            patch.object(retrieval.embeddings, 'get_embedding', side_effect=fake_embedding),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_schema_memoised_per_class(self):
+        schema, schema_tokens = retrieval.ActionData(Add_Item_To_List).get_function_schema()
+        self.assertEqual(schema['parameters']['required'], ['which-list/s'])
+        self.assertEqual(schema_tokens, len(retrieval.json.dumps(schema).split()))
+
+        # Another collection's ActionData for the same class reuses the schema
+        self.assertIs(retrieval.ActionData(Add_Item_To_List).function_schema(), schema)
+        self.assertEqual(retrieval.count_tokens.call_count, 1)
+
+    def test_memo_hit_skips_the_inputs(self):
+        retrieval.ActionData(Add_Item_To_List).get_function_schema()
+        with patch('agentpilot.operations.action.ActionInput.description', side_effect=AssertionError('walked')):
+            retrieval.ActionData(Add_Item_To_List).get_function_schema()
+
+    def test_schema_rebuilt_when_inputs_change(self):
+        action_data = retrieval.ActionData(Create_A_New_List)
+        schema = action_data.function_schema()
+        action_data.class_instance.inputs.add('list-items', required=False)
+
+        new_schema = action_data.function_schema()
+        self.assertIsNot(new_schema, schema)
+        self.assertIn('list-items', new_schema['parameters']['properties'])
+
+    def test_same_number_of_changes_different_inputs(self):
+        first = retrieval.ActionData(Create_A_New_List)
+        first.class_instance.inputs.add('list-items', required=False)
+        second = retrieval.ActionData(Create_A_New_List)
+        second.class_instance.inputs.add('list-owner')
+
+        self.assertIn('list-items', first.function_schema()['parameters']['properties'])
+        second_schema = second.function_schema()
+        self.assertIn('list-owner', second_schema['parameters']['properties'])
+        self.assertNotIn('list-items', second_schema['parameters']['properties'])
+
+    def test_token_budget_keeps_the_most_likely_actions(self):
+        action_data_list = [retrieval.ActionData(Create_A_New_List), retrieval.ActionData(Add_Item_To_List)]
+        tokens = [action_data.get_function_schema()[1] for action_data in action_data_list]
+
+        functions = retrieval.get_function_call_list(action_data_list)
+        self.assertEqual([f['name'] for f in functions], ['Create_A_New_List', 'Add_Item_To_List'])
+        functions = retrieval.get_function_call_list(action_data_list, token_budget=tokens[1])
+        self.assertEqual([f['name'] for f in functions], ['Add_Item_To_List'])
+        functions = retrieval.get_function_call_list(action_data_list, token_budget=sum(tokens))
+        self.assertEqual(len(functions), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import asyncio
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from agentpilot.agent import speech
+from agentpilot.agent.base import Agent
+from agentpilot.context.base import Context
+from agentpilot.utils import sql
+from agentpilot.utils.apis import llm
+
+DELAY = 0.05  # between streamed chunks
+CHUNKS = ['Hello there', ', how are you', ' doing today?']
+
+
+def make_chunk(text):
+    return SimpleNamespace(choices=[{'delta': {'content': text}}])
+
+
+async def fake_stream():
+    for text in CHUNKS:
+        await asyncio.sleep(DELAY)
+        yield make_chunk(text)
+
+
+async def fake_aget_chat_response(messages, sys_msg=None, stream=True, model_obj=None):
+    return fake_stream()
+
+
+class FakeMessageHistory:
+    def get(self, **kwargs):
+        return [{'role': 'user', 'content': 'hi'}]
+
+    def last_role(self):
+        return 'user'
+
+
+class FakeSignal:
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, member_id, chunk):
+        self.emitted.append((member_id, chunk))
+
+
+def make_context():
+    main = SimpleNamespace(new_sentence_signal=FakeSignal(),
+                           system=SimpleNamespace(models=SimpleNamespace(to_dict=lambda: {'test-model': {}})))
+    context = SimpleNamespace(main=main, stop_requested=False, message_history=FakeMessageHistory(), saved=[],
+                              save_threads=[])
+
+    def save_message(role, content, member_id=None, log_obj=None):
+        time.sleep(DELAY)  # embedding and inserting
+        context.saved.append((member_id, role, content, sql.get_batch()))
+        context.save_threads.append(threading.current_thread())
+
+    context.save_message = save_message
+    return context
+
+
+class FakeAgent(Agent):
+    def __init__(self, context, member_id):
+        super().__init__(member_id=member_id, context=context)
+        self.config = {'context.model': 'test-model'}
+        self.speaker = speech.Stream_Speak(self)
+
+    def system_message(self, **kwargs):
+        return 'SYSTEM'
+
+
+class BlockingStreamAgent(FakeAgent):
+    """Like the plugin agents, only overrides the blocking stream()"""
+    def stream(self, messages, msgs_in_system=False, system_msg='', model=None):
+        for text in CHUNKS:
+            time.sleep(DELAY)
+            yield 'assistant', text
+
+
+class TestAsyncStream(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        patchers = [
+            patch.object(llm, 'aget_chat_response', side_effect=fake_aget_chat_response),
+            patch.object(llm, 'get_chat_response', side_effect=AssertionError('blocking completion used')),
+            patch('agentpilot.agent.base.logs.insert_log'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_members(self, agent_class, member_count=3):
+        context = make_context()
+        members = {member_id: SimpleNamespace(agent=agent_class(context, member_id), inputs=[])
+                   for member_id in range(1, member_count + 1)}
+        group_context = Context.__new__(Context)
+        group_context.members = members
+
+        async def run_all():
+            for member in members.values():
+                member.task = asyncio.ensure_future(group_context.run_member(member))
+            await asyncio.gather(*[member.task for member in members.values()])
+
+        start = time.perf_counter()
+        self.loop.run_until_complete(run_all())
+        return context, time.perf_counter() - start
+
+    def test_members_stream_concurrently(self):
+        context, elapsed = self.run_members(FakeAgent)
+
+        # 3 members each streaming for 3 * DELAY and saving for DELAY, concurrently takes about as long as one of them
+        self.assertLess(elapsed, DELAY * (len(CHUNKS) + 1) * 2)
+        for member_id in (1, 2, 3):
+            emitted = [chunk for m_id, chunk in context.main.new_sentence_signal.emitted if m_id == member_id]
+            self.assertEqual(''.join(emitted), ''.join(CHUNKS))
+
+    def test_each_member_gets_its_own_batch(self):
+        context, _ = self.run_members(FakeAgent)
+        self.assertEqual([(member_id, content) for member_id, _, content, _ in sorted(context.saved)],
+                         [(member_id, ''.join(CHUNKS)) for member_id in (1, 2, 3)])
+
+        batches = [batch for _, _, _, batch in context.saved]
+        self.assertTrue(all(batch is not None for batch in batches))
+        self.assertEqual(len(set(map(id, batches))), 3)
+
+        # Never on the loop, which is the main thread here
+        self.assertNotIn(threading.main_thread(), context.save_threads)
+
+    def test_blocking_stream_override_runs_in_thread(self):
+        context, elapsed = self.run_members(BlockingStreamAgent)
+        self.assertLess(elapsed, DELAY * (len(CHUNKS) + 1) * 2)
+        self.assertEqual(len(context.saved), 3)
+
+
+class TestAsyncCompletion(unittest.TestCase):
+    def test_acompletion_retries(self):
+        calls = []
+
+        async def fake_acompletion(**kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                raise ConnectionError()
+            return 'response'
+
+        client = llm.LLMClient(base_delay=0.001)
+        with patch.object(llm.litellm, 'acompletion', side_effect=fake_acompletion), \
+                patch.object(llm.logs, 'insert_log'):
+            response = asyncio.run(client.acompletion(model='test-model', messages=[], stream=True))
+
+        self.assertEqual(response, 'response')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(client.stats()['test-model']['retries'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
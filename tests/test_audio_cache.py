@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from agentpilot.utils.apis import tts
+
+
+class TestAudioCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def make_file(self, name, size=100):
+        filepath = os.path.join(self.tmp_dir, name)
+        with open(filepath, 'wb') as f:
+            f.write(b'x' * size)
+        return filepath
+
+    def test_key(self):
+        key = tts.AudioCache.get_key(3, 'voice', 'Done')
+        self.assertEqual(key, tts.AudioCache.get_key(3, 'voice', 'Done'))
+        self.assertNotEqual(key, tts.AudioCache.get_key(5, 'voice', 'Done'))
+        self.assertNotEqual(key, tts.AudioCache.get_key(3, 'other-voice', 'Done'))
+        self.assertNotEqual(key, tts.AudioCache.get_key(3, 'voice', 'Done.'))
+
+    def test_put_and_get(self):
+        cache = tts.AudioCache(cache_dir=self.cache_dir)
+        key = cache.get_key(3, 'voice', 'Done')
+        self.assertIsNone(cache.get(key))
+
+        downloaded = self.make_file('download.mp3')
+        cached_path = cache.put(key, downloaded)
+        self.assertFalse(os.path.exists(downloaded))
+        self.assertEqual(cached_path, os.path.join(self.cache_dir, key + '.mp3'))
+        self.assertEqual(cache.get(key), cached_path)
+        self.assertEqual(cache.stats(), {'size': 1, 'bytes': 100, 'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+
+    def test_evicts_least_recently_used_over_max_bytes(self):
+        cache = tts.AudioCache(cache_dir=self.cache_dir, max_bytes=250)
+        for name in ('a', 'b'):
+            cache.put(name, self.make_file(f'{name}.wav'))
+        cache.get('a')  # 'b' is now the least recently used
+        cache.put('c', self.make_file('c.wav'))
+
+        self.assertIsNone(cache.get('b'))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'b.wav')))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(cache.stats()['bytes'], 200)
+
+    def test_persists_across_instances_in_lru_order(self):
+        cache = tts.AudioCache(cache_dir=self.cache_dir, max_bytes=250)
+        for name in ('a', 'b'):
+            cache.put(name, self.make_file(f'{name}.wav'))
+        old = time.time() - 60
+        os.utime(os.path.join(self.cache_dir, 'b.wav'), (old, old))
+
+        reloaded = tts.AudioCache(cache_dir=self.cache_dir, max_bytes=250)
+        self.assertIsNotNone(reloaded.get('a'))
+        reloaded.put('c', self.make_file('c.wav'))
+        self.assertIsNone(reloaded.get('b'))
+        self.assertIsNotNone(reloaded.get('a'))
+
+    def test_disabled(self):
+        cache = tts.AudioCache(cache_dir=self.cache_dir, max_bytes=0)
+        downloaded = self.make_file('download.mp3')
+        self.assertEqual(cache.put('a', downloaded), downloaded)
+        self.assertIsNone(cache.get('a'))
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from agentpilot.utils import retrieval
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeMessageHistory:
+    def __init__(self, request, earlier=()):
+        self.messages = [{'role': 'assistant', 'content': msg} for msg in earlier]
+        self.messages.append({'role': 'user', 'content': request})
+
+    def get(self, msg_limit=8, **kwargs):
+        return [dict(msg) for msg in self.messages[-msg_limit:]]
+
+    def get_conversation_str(self, **kwargs):
+        return f'CONVERSATION:\n>> user: `{self.messages[-1]["content"]}` <<'
+
+
+def make_task(request, config=None, earlier=()):
+    config = {'actions.cache_decisions': True, **(config or {})}
+    context = SimpleNamespace(message_history=FakeMessageHistory(request, earlier))
+    return SimpleNamespace(parent_react=None, agent=SimpleNamespace(config=config, context=context))
+
+
+def make_action_data_list(*names):
+    return [retrieval.ActionData.from_index(
+        {'name': name, 'module': 'operations.actions.Audio_Playback', 'desc': name, 'desc_prefix': '', 'schema': None},
+        embedding=None) for name in names]
+
+
+class TestDecisionCache(unittest.TestCase):
+    def test_ttl(self):
+        clock = FakeClock()
+        cache = retrieval.DecisionCache(ttl_secs=60, clock=clock)
+        cache.put('a', ['Play'])
+        clock.now += 59
+        self.assertEqual(cache.get('a'), ['Play'])
+        clock.now += 1
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_lru_eviction(self):
+        cache = retrieval.DecisionCache(max_size=2)
+        cache.put('a', [])
+        cache.put('b', [])
+        cache.get('a')  # 'b' is now the least recently used
+        cache.put('c', [])
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), [])
+        self.assertEqual(cache.get('c'), [])
+
+
+class TestCachedDecisions(unittest.TestCase):
+    def setUp(self):
+        # Every native decision picks the first action, the class import is patched out
+        patchers = [
+            patch.object(retrieval, 'decision_cache', retrieval.DecisionCache()),
+            patch.object(retrieval.ActionData, 'clss', property(lambda action_data: action_data.name)),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        get_scalar_patcher = patch.object(retrieval.llm, 'get_scalar', return_value='1 (it is music)')
+        self.get_scalar = get_scalar_patcher.start()
+        self.addCleanup(get_scalar_patcher.stop)
+
+    def test_repeated_request_skips_the_llm(self):
+        action_data_list = make_action_data_list('Play_Music', 'Stop_Music')
+        first = retrieval.native_decision(make_task('Play some music'), action_data_list)
+        second = retrieval.native_decision(make_task('  play some MUSIC'), action_data_list)
+
+        self.assertEqual(first, ['Play_Music'])
+        self.assertEqual(second, first)
+        self.assertEqual(self.get_scalar.call_count, 1)
+
+    def test_different_candidates_miss(self):
+        retrieval.native_decision(make_task('Play some music'), make_action_data_list('Play_Music', 'Stop_Music'))
+        retrieval.native_decision(make_task('Play some music'), make_action_data_list('Stop_Music', 'Play_Music'))
+        self.assertEqual(self.get_scalar.call_count, 2)
+
+    def test_different_lookback_misses(self):
+        action_data_list = make_action_data_list('Play_Music', 'Stop_Music')
+        retrieval.native_decision(make_task('Yes please', earlier=['Shall I play music?']), action_data_list)
+        retrieval.native_decision(make_task('Yes please', earlier=['Shall I stop the music?']), action_data_list)
+        retrieval.native_decision(make_task('Yes please', earlier=['Shall I stop the music?']), action_data_list)
+        self.assertEqual(self.get_scalar.call_count, 2)
+
+    def test_no_action_is_not_cached(self):
+        self.get_scalar.return_value = '0 (nothing to do)'
+        action_data_list = make_action_data_list('Play_Music')
+        self.assertEqual(retrieval.native_decision(make_task('Hello'), action_data_list), [])
+        self.assertEqual(retrieval.native_decision(make_task('Hello'), action_data_list), [])
+        self.assertEqual(self.get_scalar.call_count, 2)
+
+    def test_off_by_default(self):
+        action_data_list = make_action_data_list('Play_Music')
+        task = make_task('Play some music')
+        del task.agent.config['actions.cache_decisions']
+        retrieval.native_decision(task, action_data_list)
+        retrieval.native_decision(task, action_data_list)
+        self.assertEqual(self.get_scalar.call_count, 2)
+
+    def test_bypass(self):
+        action_data_list = make_action_data_list('Play_Music')
+        retrieval.native_decision(make_task('Play some music'), action_data_list)
+        retrieval.native_decision(make_task('Play some music'), action_data_list, use_cache=False)
+        retrieval.native_decision(make_task('Play some music', {'actions.cache_decisions': False}), action_data_list)
+        self.assertEqual(self.get_scalar.call_count, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
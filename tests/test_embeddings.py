@@ -0,0 +1,45 @@
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+
+from agentpilot.utils import embeddings
+
+
+class TestEmbeddingCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = embeddings.EmbeddingCache(max_size=2)
+        cache.put('a', (1, None))
+        cache.put('b', (2, None))
+        cache.get('a')  # 'b' is now the least recently used
+        cache.put('c', (3, None))
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), (1, None))
+        self.assertEqual(cache.get('c'), (3, None))
+
+    def test_hit_miss_counters(self):
+        cache = embeddings.EmbeddingCache()
+        cache.put('a', (1, None))
+        cache.get('a')
+        cache.get('b')
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_get_embedding_queries_once_per_text(self):
+        blob = embeddings.embedding_to_blob([0.5, 1.5])
+        with patch.object(embeddings, 'embedding_cache', embeddings.EmbeddingCache()), \
+                patch.object(embeddings.sql, 'get_results', return_value=(7, blob)) as get_results:
+            first = embeddings.get_embedding('Play some music')
+            second = embeddings.get_embedding('  play some MUSIC ')
+
+        self.assertEqual(get_results.call_count, 1)
+        self.assertEqual(first[0], 7)
+        self.assertIs(first, second)
+        np.testing.assert_array_equal(first[1], np.array([0.5, 1.5], dtype=np.float32))
+
+
+if __name__ == '__main__':
+    unittest.main()
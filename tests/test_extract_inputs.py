@@ -0,0 +1,130 @@
+import re
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from agentpilot.operations import action
+from agentpilot.operations.action import BaseAction
+
+
+class Send_An_Email(BaseAction):
+    def __init__(self, agent):
+        super().__init__(agent, example='email bob the report')
+        self.desc_prefix = 'requires me to'
+        self.desc = 'Send an email'
+        self.inputs.add('recipient')
+        self.inputs.add('subject')
+
+
+class FakeMessageHistory:
+    def get_conversation_str(self, msg_limit=4, **kwargs):
+        return f'CONVERSATION (window {msg_limit})'
+
+    def get_react_str(self, **kwargs):
+        return ''
+
+
+def make_agent(speculative, lookback=3):
+    config = {
+        'action_inputs.lookback_msg_count': lookback,
+        'action_inputs.lookback_msg_count_increment': True,
+        'action_inputs.speculative_lookback': speculative,
+        'action_inputs.decay_at_idle_count': 5,
+    }
+    context = SimpleNamespace(message_history=FakeMessageHistory())
+    return SimpleNamespace(config=config, context=context, active_task=None)
+
+
+class FakeLLM:
+    """Each lookback window finds more inputs, window 3 would be the first to find the subject"""
+    responses = {
+        1: 'recipient: bob\nsubject: NA',
+        2: 'recipient: alice\nsubject: NA',
+        3: 'recipient: carol\nsubject: quarterly report',
+    }
+
+    def __init__(self, delay=0.0, responses=None, delays=None):
+        self.delay = delay
+        self.delays = delays or {}  # {window: delay}, overrides delay
+        self.responses = responses or self.responses
+        self.windows = []
+        self.max_concurrent = 0
+        self.running = 0
+        self.lock = threading.Lock()
+
+    def get_scalar(self, prompt):
+        window = int(re.search(r'window (\d+)', prompt).group(1))
+        with self.lock:
+            self.windows.append(window)
+            self.running += 1
+            self.max_concurrent = max(self.max_concurrent, self.running)
+        time.sleep(self.delays.get(window, self.delay))
+        with self.lock:
+            self.running -= 1
+        return self.responses[window]
+
+
+class TestExtractInputs(unittest.TestCase):
+    def extract(self, speculative, fake_llm, lookback=3):
+        with patch.object(action.llm, 'get_scalar', side_effect=fake_llm.get_scalar), \
+                patch.object(action.logs, 'insert_log'):
+            act = Send_An_Email(make_agent(speculative, lookback))
+            act.extract_inputs()
+        return act
+
+    def test_speculative_matches_sequential(self):
+        sequential = self.extract(False, FakeLLM())
+        speculative = self.extract(True, FakeLLM())
+
+        # The smallest window's values win, later windows only fill what is still missing
+        for act in (sequential, speculative):
+            self.assertEqual(act.inputs.get('recipient').value, 'bob')
+            self.assertEqual(act.inputs.get('subject').value, 'quarterly report')
+            self.assertTrue(act.can_run())
+
+    def test_speculative_runs_concurrently(self):
+        fake_llm = FakeLLM(delay=0.3)
+        start = time.perf_counter()
+        self.extract(True, fake_llm)
+        self.assertLess(time.perf_counter() - start, 0.8)  # 0.9 sequentially
+        self.assertEqual(fake_llm.max_concurrent, 2)
+
+    def test_speculative_stop_cancels_unsent_prompts(self):
+        responses = {1: 'recipient: bob\nsubject: lunch', 2: 'recipient: alice\nsubject: NA',
+                     3: 'recipient: carol\nsubject: NA', 4: 'recipient: dave\nsubject: NA'}
+        fake_llm = FakeLLM(responses=responses, delays={2: 0.2})
+        act = self.extract(True, fake_llm, lookback=4)
+        time.sleep(0.4)  # window 2 was already sent, let it finish
+
+        self.assertEqual(act.inputs.get('subject').value, 'lunch')
+        self.assertEqual(sorted(fake_llm.windows), [1, 2])
+
+    def test_speculative_threads_are_shared(self):
+        self.extract(True, FakeLLM())
+        self.extract(True, FakeLLM())
+        worker_names = [t.name for t in threading.enumerate() if t.name.startswith('extract-inputs')]
+        self.assertLessEqual(len(worker_names), 2)
+
+    def test_stops_at_smallest_complete_window(self):
+        responses = {**FakeLLM.responses, 1: 'recipient: bob\nsubject: lunch'}
+        sequential_llm = FakeLLM(responses=responses)
+        act = self.extract(False, sequential_llm)
+        self.assertEqual(sequential_llm.windows, [1])
+        self.assertEqual(act.inputs.get('subject').value, 'lunch')
+
+        act = self.extract(True, FakeLLM(responses=responses))
+        self.assertEqual(act.inputs.get('subject').value, 'lunch')
+
+    def test_cancel(self):
+        responses = {**FakeLLM.responses, 2: 'CANCEL'}
+        for speculative in (False, True):
+            act = self.extract(speculative, FakeLLM(responses=responses))
+            self.assertTrue(act.cancelled)
+            self.assertEqual(act.inputs.get('recipient').value, 'bob')
+            self.assertEqual(act.inputs.get('subject').value, '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from agentpilot.utils.apis import llm
+
+from shipped_db import ShippedDBTestCase
+
+
+def fake_response(content):
+    return SimpleNamespace(choices=[{'message': {'content': content}}])
+
+
+class TestResponseCache(ShippedDBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.cache = llm.ResponseCache(max_size=3)
+        patcher = patch.object(llm, 'response_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        completion_patcher = patch.object(llm, 'get_chat_response',
+                                          side_effect=lambda messages, prompt, **kwargs: fake_response(f're: {prompt}'))
+        self.get_chat_response = completion_patcher.start()
+        self.addCleanup(completion_patcher.stop)
+
+    def test_repeated_prompt_is_cached(self):
+        model_obj = ('gpt-3.5-turbo', {'temperature': '0'})
+        first = llm.get_scalar('Title for: hello', model_obj=model_obj, use_cache=True)
+        second = llm.get_scalar('Title for: hello', model_obj=model_obj, use_cache=True)
+
+        self.assertEqual(first, 're: Title for: hello')
+        self.assertEqual(second, first)
+        self.assertEqual(self.get_chat_response.call_count, 1)
+        self.assertEqual(self.cache.stats(), {'size': 1, 'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+
+    def test_key_includes_model_and_params(self):
+        llm.get_scalar('prompt', model_obj=('gpt-3.5-turbo', {}), use_cache=True)
+        llm.get_scalar('prompt', model_obj=('gpt-4', {}), use_cache=True)
+        llm.get_scalar('prompt', model_obj=('gpt-4', {'temperature': 0.5}), use_cache=True)
+        self.assertEqual(self.get_chat_response.call_count, 3)
+
+    def test_opt_in(self):
+        with patch.object(llm.config, 'get_value', return_value=False):
+            llm.get_scalar('prompt')
+            llm.get_scalar('prompt')
+        self.assertEqual(self.get_chat_response.call_count, 2)
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+        with patch.object(llm.config, 'get_value', return_value=True):
+            llm.get_scalar('prompt')
+            llm.get_scalar('prompt')
+        self.assertEqual(self.get_chat_response.call_count, 3)
+
+    def test_lru_eviction(self):
+        for prompt in ('a', 'b', 'c'):
+            llm.get_scalar(prompt, use_cache=True)
+        llm.get_scalar('a', use_cache=True)  # 'b' is now the least recently used
+        llm.get_scalar('d', use_cache=True)
+
+        self.assertEqual(self.cache.stats()['size'], 3)
+        calls = self.get_chat_response.call_count
+        llm.get_scalar('a', use_cache=True)
+        llm.get_scalar('c', use_cache=True)
+        self.assertEqual(self.get_chat_response.call_count, calls)
+        llm.get_scalar('b', use_cache=True)
+        self.assertEqual(self.get_chat_response.call_count, calls + 1)
+
+    def test_persists_across_instances(self):
+        llm.get_scalar('prompt', use_cache=True)
+        with patch.object(llm, 'response_cache', llm.ResponseCache(max_size=3)):
+            self.assertEqual(llm.get_scalar('prompt', use_cache=True), 're: prompt')
+        self.assertEqual(self.get_chat_response.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
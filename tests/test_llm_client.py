@@ -0,0 +1,178 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from agentpilot.utils.apis import llm
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.now += secs
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f'status {status_code}')
+        self.status_code = status_code
+
+
+class FakeCompletion:
+    """Raises the given errors in order, then returns a response"""
+    def __init__(self, clock, errors=(), latency=0.5):
+        self.clock = clock
+        self.errors = list(errors)
+        self.latency = latency
+        self.calls = []
+
+    def __call__(self, **kwargs):
+        self.calls.append(kwargs)
+        self.clock.now += self.latency
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'response'
+
+
+class TestLLMClient(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.client = llm.LLMClient(max_attempts=5, deadline_secs=30, base_delay=1, max_delay=8,
+                                    clock=self.clock, sleep=self.clock.sleep, rand=lambda: 1.0)
+        self.addCleanup(self.client.close)
+        patcher = patch.object(llm.logs, 'insert_log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def complete(self, fake_completion, **kwargs):
+        with patch.object(llm.litellm, 'completion', side_effect=fake_completion):
+            return self.client.completion(model='test-model', messages=[], **kwargs)
+
+    def test_error_classification(self):
+        for e in (StatusError(429), StatusError(503), ConnectionError(), TimeoutError()):
+            self.assertTrue(llm.is_retryable(e), e)
+        for e in (StatusError(401), StatusError(400), ValueError('bad'), KeyError('x')):
+            self.assertFalse(llm.is_retryable(e), e)
+
+    def test_retries_retryable_errors(self):
+        fake_completion = FakeCompletion(self.clock, errors=[StatusError(429), ConnectionError()])
+        self.assertEqual(self.complete(fake_completion), 'response')
+        self.assertEqual(len(fake_completion.calls), 3)
+
+        stats = self.client.stats()['test-model']
+        self.assertEqual((stats['calls'], stats['errors'], stats['retries']), (3, 2, 2))
+        self.assertEqual(stats['avg_latency'], 0.5)
+
+    def test_fatal_error_is_not_retried(self):
+        fake_completion = FakeCompletion(self.clock, errors=[StatusError(401)])
+        with self.assertRaises(StatusError):
+            self.complete(fake_completion)
+        self.assertEqual(len(fake_completion.calls), 1)
+        self.assertEqual(self.client.stats()['test-model']['retries'], 0)
+
+    def test_backoff_is_exponential_and_capped(self):
+        self.assertEqual([self.client.get_delay(attempt) for attempt in range(6)], [1, 2, 4, 8, 8, 8])
+        self.client.rand = lambda: 0.25
+        self.assertEqual(self.client.get_delay(2), 1)
+
+    def test_deadline(self):
+        # Delays of 1, 2, 4 and 8 secs plus the call latency would pass the 10 sec deadline on the 4th retry
+        fake_completion = FakeCompletion(self.clock, errors=[StatusError(503)] * 5)
+        start = self.clock.now
+        with self.assertRaises(StatusError):
+            self.complete(fake_completion, deadline_secs=10)
+        self.assertEqual(len(fake_completion.calls), 4)
+        self.assertLess(self.clock.now - start, 10)
+
+        # Each attempt's request timeout never runs past the deadline
+        timeouts = [call['request_timeout'] for call in fake_completion.calls]
+        self.assertEqual(timeouts[0], 10)
+        self.assertTrue(all(a > b for a, b in zip(timeouts, timeouts[1:])))
+
+    def test_connections_shared_per_base_url(self):
+        first = self.client.get_http_client('openai', 'https://api.openai.com/v1')
+        self.assertIs(self.client.get_http_client('openai', 'https://api.openai.com/v1'), first)
+        self.assertIsNot(self.client.get_http_client('openai', 'http://localhost:8000'), first)
+
+        openai_client = self.client.get_openai_client('openai', 'http://localhost:8000', 'key')
+        self.assertIs(self.client.get_openai_client('openai', 'http://localhost:8000', 'key'), openai_client)
+        self.assertEqual(openai_client.max_retries, 0)
+
+    def test_system_message_added_once(self):
+        fake_completion = FakeCompletion(self.clock, errors=[StatusError(500)])
+        with patch.object(llm, 'client', self.client), \
+                patch.object(self.client, 'get_client_kwargs', return_value={}), \
+                patch.object(llm.litellm, 'completion', side_effect=fake_completion):
+            llm.get_chat_response([{'role': 'user', 'content': 'hi'}], sys_msg='SYSTEM', stream=False)
+
+        for call in fake_completion.calls:
+            self.assertEqual([m['role'] for m in call['messages']], ['system', 'user'])
+
+
+class FakeStream:
+    """A streamed response, counts how many chunks were read and whether it was closed"""
+    def __init__(self, text_chunks):
+        self.text_chunks = text_chunks
+        self.read_count = 0
+        self.closed = False
+
+    def __iter__(self):
+        for text in self.text_chunks:
+            self.read_count += 1
+            yield SimpleNamespace(choices=[{'delta': {'content': text}}])
+
+    def close(self):
+        self.closed = True
+
+
+class TestGetScalar(unittest.TestCase):
+    def get_scalar(self, text_chunks, **kwargs):
+        stream = FakeStream(text_chunks)
+        with patch.object(llm, 'get_chat_response', return_value=stream) as get_chat_response:
+            output = llm.get_scalar('prompt', use_cache=False, **kwargs)
+        return output, stream, get_chat_response
+
+    def test_single_line(self):
+        output, stream, _ = self.get_scalar(['The ans', 'wer\nMore', ' text\n', 'and more'], single_line=True)
+        self.assertEqual(output, 'The answer')
+        self.assertEqual(stream.read_count, 2)
+        self.assertTrue(stream.closed)
+
+    def test_num_lines(self):
+        # Text after the newline that completes a line used to be dropped, and only counted newlines per chunk
+        output, stream, _ = self.get_scalar(['one\ntw', 'o\nthree\nfour\n'], num_lines=2)
+        self.assertEqual(output, 'one\ntwo')
+        self.assertTrue(stream.closed)
+
+        output, stream, _ = self.get_scalar(['one\ntwo\nthree'], num_lines=3)
+        self.assertEqual(output, 'one\ntwo\nthree')
+        self.assertFalse(stream.closed)
+
+    def test_stops_at_integer_id(self):
+        output, stream, _ = self.get_scalar(['1', '2', ' (it ', 'plays music)', '\n'],
+                                            single_line=True, stop_pattern=llm.INTEGER_ID_PATTERN)
+        self.assertEqual(output, '12 (it ')
+        self.assertEqual(stream.read_count, 3)
+        self.assertTrue(stream.closed)
+
+        output, _, _ = self.get_scalar(['0'], stop_pattern=llm.INTEGER_ID_PATTERN)
+        self.assertEqual(output, '0')
+
+    def test_on_text(self):
+        texts = []
+        output, _, _ = self.get_scalar(['The ans', 'wer\nMore'], single_line=True, on_text=texts.append)
+        self.assertEqual(output, 'The answer')
+        self.assertEqual(texts, ['The ans', 'The answer\nMore'])
+
+    def test_max_tokens(self):
+        _, _, get_chat_response = self.get_scalar(['TRUE'], single_line=True, max_tokens=8)
+        model, model_config = get_chat_response.call_args.kwargs['model_obj']
+        self.assertEqual(model_config['max_tokens'], 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+import asyncio
+import time
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from agentpilot.utils import sql, tokens
+from agentpilot.context import messages
+from agentpilot.context.messages import MessageHistory
+
+from shipped_db import ShippedDBTestCase
+
+
+class FakeEncoding:
+    def encode(self, text):
+        return text.split()
+
+
+class TestMessageHistory(ShippedDBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # Tokenising and embedding both need the network, neither matters here
+        patchers = [
+            patch.object(tokens.tiktoken, 'encoding_for_model', return_value=FakeEncoding()),
+            patch.object(tokens, 'encoders', {}),
+            patch.object(messages.embeddings, 'get_embedding', return_value=(None, None)),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        context_id = sql.insert("INSERT INTO contexts (id) VALUES (NULL)")
+        self.context = SimpleNamespace(id=context_id, leaf_id=context_id, members={}, member_configs={})
+        self.history = MessageHistory(self.context)
+        self.history.load()
+
+    def assert_matches_fresh_load(self):
+        fresh = MessageHistory(SimpleNamespace(id=self.context.id, leaf_id=None, members={}, member_configs={}))
+        fresh.load()
+        self.assertEqual(fresh.context.leaf_id, self.context.leaf_id)
+        self.assertEqual([(m.id, m.role, m.content, m.member_id) for m in self.history.messages],
+                         [(m.id, m.role, m.content, m.member_id) for m in fresh.messages])
+
+    def branch_from(self, msg):
+        """Same steps as editing and resending a message in the chat page"""
+        index = self.history.messages.index(msg)
+        self.history.messages[:] = self.history.messages[:index]
+        self.context.leaf_id = sql.insert(
+            "INSERT INTO contexts (parent_id, branch_msg_id) SELECT context_id, id FROM contexts_messages WHERE id = ?",
+            (msg.id,))
+
+    def test_add_returns_inserted_id(self):
+        msg = self.history.add('user', 'hello there')
+        self.assertEqual(msg.id, sql.get_scalar("SELECT MAX(id) FROM contexts_messages"))
+        self.assertIs(self.history.messages[-1], msg)
+
+    def test_add_matches_fresh_load(self):
+        for i in range(6):
+            self.history.add('user' if i % 2 == 0 else 'assistant', f'message {i}', member_id=1)
+        self.assert_matches_fresh_load()
+
+    def test_add_after_branching_matches_fresh_load(self):
+        added = [self.history.add('user' if i % 2 == 0 else 'assistant', f'message {i}') for i in range(6)]
+
+        self.branch_from(added[2])
+        self.history.add('user', 'edited message 2')
+        self.history.add('assistant', 'reply on the new branch')
+        self.assert_matches_fresh_load()
+
+        self.branch_from(self.history.messages[1])
+        self.history.add('assistant', 'edited message 1')
+        self.assert_matches_fresh_load()
+
+    def test_add_inside_batch(self):
+        with sql.batch():
+            sql.execute("UPDATE contexts SET summary = 'batched' WHERE id = ?", (self.context.id,))
+            msg = self.history.add('user', 'inside a batch')
+
+        self.assertIsNotNone(msg.id)
+        self.assert_matches_fresh_load()
+
+    def test_aadd_matches_fresh_load(self):
+        async def add_messages():
+            for i in range(4):
+                await self.history.aadd('user' if i % 2 == 0 else 'assistant', f'async message {i}')
+
+        asyncio.run(add_messages())
+        self.assert_matches_fresh_load()
+
+    def test_out_of_order_add_keeps_id_order(self):
+        # Concurrent member saves can finish in a different order to their inserts
+        first, second, third = (messages.Message(msg_id, 'user', str(msg_id)) for msg_id in (10, 20, 30))
+        self.history.messages = []
+        for msg in (first, third, second):
+            self.history.append_message(msg)
+        self.assertEqual([m.id for m in self.history.messages], [10, 20, 30])
+
+    def test_concurrent_aadd_overlaps_embedding_waits(self):
+        def slow_embedding(text):
+            time.sleep(0.1)
+            return None, None
+
+        async def add_messages():
+            await asyncio.gather(*[self.history.aadd('assistant', f'member {i} message', member_id=i)
+                                   for i in range(3)])
+
+        with patch.object(messages.embeddings, 'get_embedding', side_effect=slow_embedding):
+            start = time.perf_counter()
+            asyncio.run(add_messages())
+            elapsed = time.perf_counter() - start
+
+        self.assertLess(elapsed, 0.25)
+        self.assertEqual(len(self.history.messages), 3)
+        self.assert_matches_fresh_load()
+
+    def fill(self, count):
+        roles = ['user' if i % 2 == 0 else 'assistant' for i in range(count)]
+        sql.execute_multiple(["INSERT INTO contexts_messages (context_id, role, msg) VALUES (?, ?, ?)"] * count,
+                             [(self.context.leaf_id, role, f'filler {i}') for i, role in enumerate(roles)])
+
+    def test_load_is_windowed(self):
+        self.fill(25)
+        self.history.window_size = 10
+        self.history.load()
+
+        all_ids = sql.get_results("SELECT id FROM contexts_messages WHERE context_id = ? ORDER BY id",
+                                  (self.context.id,), return_type='list')
+        self.assertEqual([m.id for m in self.history.messages], all_ids[-10:])
+        self.assertTrue(self.history.has_older)
+
+        self.assertEqual(len(self.history.load_older()), 10)
+        self.assertEqual(len(self.history.load_older()), 5)
+        self.assertFalse(self.history.has_older)
+        self.assertEqual(self.history.load_older(), [])
+        self.assertEqual([m.id for m in self.history.messages], all_ids)
+
+    def test_get_reads_older_messages_without_changing_the_window(self):
+        self.fill(20)
+        sql.execute("INSERT INTO contexts_messages (context_id, role, msg) VALUES (?, 'thought', 'hmm')",
+                    (self.context.leaf_id,))
+        self.history.window_size = 4
+        self.history.load()
+        window_ids = [m.id for m in self.history.messages]
+
+        msgs = self.history.get(msg_limit=6)
+        self.assertEqual([m['content'] for m in msgs], [f'filler {i}' for i in range(14, 20)])
+        self.assertEqual(self.history.get_react_str(msg_limit=6), 'THOUGHTS:\nthought: `hmm`')
+        self.assertEqual(self.history.count(), 20)
+        self.assertEqual(self.history.count(incl_roles=('user',)), 10)
+
+        # The chat page only has bubbles for the window, older pages still come from load_older()
+        self.assertEqual([m.id for m in self.history.messages], window_ids)
+        self.assertTrue(self.history.has_older)
+        self.assertEqual([m.content for m in self.history.load_older()], [f'filler {i}' for i in range(13, 17)])
+
+    def test_get_older_messages_respect_from_msg_id(self):
+        self.fill(12)
+        self.history.window_size = 2
+        self.history.load()
+
+        from_msg_id = self.history.messages[0].id - 3
+        msgs = self.history.get(msg_limit=8, from_msg_id=from_msg_id)
+        self.assertEqual([m['content'] for m in msgs], [f'filler {i}' for i in range(7, 12)])
+        self.assertEqual(len(self.history.messages), 2)
+
+    def test_token_count_saved_on_add(self):
+        msg = self.history.add('user', 'four tokens right here')
+        self.assertEqual(msg.token_count, 4)
+        self.assertEqual(sql.get_scalar("SELECT token_count FROM contexts_messages WHERE id = ?", (msg.id,)), 4)
+
+        # A cold load reads the saved count instead of tokenising
+        with patch.object(messages, 'count_tokens', side_effect=AssertionError('tokenised')):
+            self.history.load()
+            self.assertEqual(self.history.messages[-1].token_count, 4)
+
+    def test_token_count_of_old_rows_has_no_side_effects(self):
+        msg_id = sql.insert("INSERT INTO contexts_messages (context_id, role, msg) VALUES (?, 'user', 'old row here')",
+                            (self.context.leaf_id,))
+        self.history.load()
+        with patch.object(sql, 'execute', side_effect=AssertionError('written')):
+            self.assertEqual(self.history.messages[-1].token_count, 3)
+        self.assertIsNone(sql.get_scalar("SELECT token_count FROM contexts_messages WHERE id = ?", (msg_id,)))
+
+    def test_one_encoder_per_model(self):
+        for i in range(3):
+            self.history.add('user', f'message {i}').token_count
+        self.assertEqual(tokens.tiktoken.encoding_for_model.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
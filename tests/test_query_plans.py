@@ -0,0 +1,118 @@
+import unittest
+
+from agentpilot.utils import sql
+from agentpilot.utils.embeddings import EMBEDDING_QUERY
+from agentpilot.context.base import MEMBERS_QUERY
+from agentpilot.context.messages import LEAF_ID_QUERY, BRANCHES_QUERY, MESSAGES_QUERY, MESSAGES_WINDOW_QUERY, \
+    MESSAGES_COUNT_QUERY, MESSAGES_ROLES_WINDOW_QUERY, MAX_MSG_ID
+from agentpilot.gui.pages.contexts import CONTEXTS_QUERY
+
+from shipped_db import use_db_copy
+
+ROOT_CONTEXTS = 2000
+MSGS_PER_CONTEXT = 25  # every root context has one branch, so 2000 * 2 * 25 = 100k messages
+
+restore_db = None
+
+
+def setUpModule():
+    """Build a synthetic 100k message database from the shipped schema, with the latest upgrade applied"""
+    global restore_db
+    restore_db = use_db_copy()
+
+    queries, params_list = [], []
+    first_context_id = (sql.get_scalar("SELECT MAX(id) FROM contexts") or 0) + 1
+    msg_id = (sql.get_scalar("SELECT MAX(id) FROM contexts_messages") or 0) + 1
+    for i in range(ROOT_CONTEXTS):
+        root_id = first_context_id + (i * 2)
+        branch_id = root_id + 1
+        branch_msg_id = msg_id + MSGS_PER_CONTEXT - 1
+
+        queries.append("INSERT INTO contexts (id, parent_id, branch_msg_id) VALUES (?, NULL, NULL)")
+        params_list.append((root_id,))
+        queries.append("INSERT INTO contexts (id, parent_id, branch_msg_id) VALUES (?, ?, ?)")
+        params_list.append((branch_id, root_id, branch_msg_id))
+        queries.append("INSERT INTO contexts_members (context_id, agent_id, agent_config) VALUES (?, 1, '{}')")
+        params_list.append((root_id,))
+
+        for context_id in (root_id, branch_id):
+            for n in range(MSGS_PER_CONTEXT):
+                role = 'user' if n % 2 == 0 else 'assistant'
+                queries.append("INSERT INTO contexts_messages (id, context_id, role, msg) VALUES (?, ?, ?, ?)")
+                params_list.append((msg_id, context_id, role, f'Synthetic message {msg_id}'))
+                msg_id += 1
+
+    sql.execute_multiple(queries, params_list)
+
+
+def tearDownModule():
+    restore_db()
+
+
+class TestQueryPlans(unittest.TestCase):
+    """Every hot query must reach the context tables through an index, never a full table scan"""
+
+    def assert_uses_indexes(self, query, params, derived_tables):
+        """derived_tables are the CTE/subquery names in the query, which are allowed to be scanned"""
+        plan = sql.get_results(f"EXPLAIN QUERY PLAN {query}", params)
+        for _, _, _, detail in plan:
+            words = detail.split()
+            if words[0] not in ('SCAN', 'SEARCH'):
+                continue
+            if words[1] in derived_tables:
+                continue
+            with self.subTest(detail=detail):
+                self.assertIn(' USING ', f' {detail} ', f'Full table scan: {detail}')
+                self.assertNotIn('AUTOMATIC', detail, f'Index built on the fly: {detail}')
+
+    def get_context_id(self):
+        return sql.get_scalar("SELECT MAX(id) FROM contexts WHERE parent_id IS NULL")
+
+    def test_leaf_id_query(self):
+        self.assert_uses_indexes(LEAF_ID_QUERY, (self.get_context_id(),),
+                                 derived_tables={'leaf_contexts', 'lc'})
+
+    def test_branches_query(self):
+        self.assert_uses_indexes(BRANCHES_QUERY, (self.get_context_id(),),
+                                 derived_tables={'context_chain', 'cc'})
+
+    def test_messages_query(self):
+        leaf_id = self.get_context_id() + 1
+        self.assert_uses_indexes(MESSAGES_QUERY, (leaf_id, 0),
+                                 derived_tables={'context_path', 'cp'})
+
+    def test_messages_window_query(self):
+        leaf_id = self.get_context_id() + 1
+        self.assert_uses_indexes(MESSAGES_WINDOW_QUERY, (leaf_id, MAX_MSG_ID, 201),
+                                 derived_tables={'context_path', 'cp'})
+
+    def test_messages_count_query(self):
+        leaf_id = self.get_context_id() + 1
+        self.assert_uses_indexes(MESSAGES_COUNT_QUERY.format(roles='?, ?'), (leaf_id, MAX_MSG_ID, 'user', 'assistant'),
+                                 derived_tables={'context_path', 'cp'})
+
+    def test_messages_roles_window_query(self):
+        leaf_id = self.get_context_id() + 1
+        self.assert_uses_indexes(MESSAGES_ROLES_WINDOW_QUERY.format(roles='?, ?'),
+                                 (leaf_id, MAX_MSG_ID, 0, 'user', 'assistant', 8),
+                                 derived_tables={'context_path', 'cp'})
+
+    def test_members_query(self):
+        self.assert_uses_indexes(MEMBERS_QUERY, (self.get_context_id(),),
+                                 derived_tables=set())
+
+    def test_contexts_page_query(self):
+        self.assert_uses_indexes(CONTEXTS_QUERY, (),
+                                 derived_tables={'cm'})
+
+    def test_embedding_query(self):
+        self.assert_uses_indexes(EMBEDDING_QUERY, ('lists',),
+                                 derived_tables=set())
+
+    def test_synthetic_db_size(self):
+        msg_count = sql.get_scalar("SELECT COUNT(*) FROM contexts_messages")
+        self.assertGreaterEqual(msg_count, ROOT_CONTEXTS * 2 * MSGS_PER_CONTEXT)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from agentpilot.utils.apis import fakeyou
+
+
+class FakeClock:
+    """Time only moves when something sleeps"""
+    def __init__(self):
+        self.now = 1000.0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, secs):
+        with self.lock:
+            self.now += secs
+
+
+class TestTokenBucket(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def make_bucket(self, rate=1.0, capacity=1):
+        return fakeyou.TokenBucket(rate=rate, capacity=capacity, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_spaces_requests(self):
+        bucket = self.make_bucket(rate=2.0)
+        self.assertEqual([bucket.reserve() for _ in range(4)], [0.0, 0.5, 1.0, 1.5])
+
+    def test_burst_up_to_capacity(self):
+        bucket = self.make_bucket(rate=1.0, capacity=3)
+        self.assertEqual([bucket.reserve() for _ in range(4)], [0.0, 0.0, 0.0, 1.0])
+
+    def test_refills_while_idle(self):
+        bucket = self.make_bucket(rate=1.0, capacity=2)
+        bucket.reserve()
+        bucket.reserve()
+        self.clock.now += 1.5
+        self.assertEqual(bucket.reserve(), 0.0)
+        self.assertAlmostEqual(bucket.reserve(), 0.5)
+
+        self.clock.now += 100  # never more than capacity
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0.0, 0.0, 1.0])
+
+    def test_acquire_sleeps_until_its_slot(self):
+        bucket = self.make_bucket(rate=1.0)
+        start = self.clock.now
+        for _ in range(3):
+            bucket.acquire()
+        self.assertEqual(self.clock.now - start, 2.0)
+
+    def test_threads_get_distinct_slots(self):
+        bucket = self.make_bucket(rate=4.0)
+        delays = []
+        lock = threading.Lock()
+
+        def reserve():
+            delay = bucket.reserve()
+            with lock:
+                delays.append(delay)
+
+        threads = [threading.Thread(target=reserve) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(delays), [i * 0.25 for i in range(8)])
+
+
+class TestFakeYouRequests(unittest.TestCase):
+    def test_every_api_call_is_rate_limited(self):
+        clock = FakeClock()
+        request_times = []
+
+        def fake_request(url, **kwargs):
+            request_times.append(clock.now)
+            if 'inference' in url:
+                return SimpleNamespace(status_code=200, json=lambda: {'inference_job_token': 'job'})
+            if 'tts/job' in url:
+                # The job finishes on the third poll
+                path = '/audio.wav' if len(request_times) >= 4 else None
+                return SimpleNamespace(status_code=200, json=lambda: {'state': {'maybe_public_bucket_wav_audio_path': path}})
+            return SimpleNamespace(status_code=200, content=b'audio')
+
+        rate_limiter = fakeyou.TokenBucket(rate=1.0, clock=clock, sleep=clock.sleep)
+        with patch.object(fakeyou, 'rate_limiter', rate_limiter), \
+                patch.object(fakeyou.requests, 'get', side_effect=fake_request), \
+                patch.object(fakeyou.requests, 'post', side_effect=fake_request), \
+                patch.object(fakeyou.time, 'sleep'), \
+                patch.object(fakeyou.tempfile, 'NamedTemporaryFile'):
+            fakeyou.synthesise_voice('voice', 'Hello')
+
+        # inference + 3 polls are api calls a second apart, the audio file itself isn't
+        api_times = request_times[:4]
+        self.assertEqual([b - a for a, b in zip(api_times, api_times[1:])], [1.0, 1.0, 1.0])
+        self.assertEqual(request_times[4], request_times[3])
+
+
+if __name__ == '__main__':
+    unittest.main()
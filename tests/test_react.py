@@ -0,0 +1,154 @@
+import threading
+import time
+import unittest
+import zlib
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import numpy as np
+
+from agentpilot.agent import base as agent_base
+from agentpilot.operations import react, task
+from agentpilot.operations.react import ExplicitReAct
+
+DELAY = 0.1  # every llm call, embedding and action match takes this long
+
+
+def fake_embedding(text):
+    time.sleep(DELAY)
+    rng = np.random.default_rng(zlib.crc32(text.encode()))
+    return 1, rng.normal(size=64).astype(np.float32)
+
+
+class FakeMessageHistory:
+    def __init__(self):
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def add(self, role, content, embedding_id=None):
+        embedding = fake_embedding(content)[1] if role in ('result',) else None
+        with self.lock:
+            self.messages.append({'role': role, 'content': content})
+        return SimpleNamespace(embedding_data=embedding)
+
+    def get(self, msg_limit=8, incl_roles=('user', 'assistant')):
+        with self.lock:
+            return [dict(m) for m in self.messages if m['role'] in incl_roles][-msg_limit:]
+
+    def last(self, incl_roles=('user', 'assistant')):
+        msgs = self.get(msg_limit=1, incl_roles=incl_roles)
+        return msgs[-1] if msgs else None
+
+    def get_conversation_str(self, **kwargs):
+        return ''
+
+
+class FakeActions:
+    def __init__(self):
+        self.calls = []
+
+    def match_request(self, messages):
+        self.calls.append([m['content'] for m in messages])
+        time.sleep(DELAY)
+        return [messages[-1]['content']]
+
+
+class FakeTask:
+    def __init__(self, agent, objective, parent_react):
+        msgs = agent.context.message_history.get(msg_limit=2, incl_roles=('thought', 'result'))
+        self.matched = parent_react.get_action_matches(msgs)
+        self.objective = objective
+        self.status = task.TaskStatus.COMPLETED
+
+    def run(self):
+        return True, f'matched {self.matched[0]}'
+
+    def fingerprint(self, _type='name'):
+        return 'Fake_Action'
+
+
+THOUGHTS = ['First, I need to do x', 'Now, I need to do y', 'Now, I need to do z', 'OBJECTIVE COMPLETE']
+
+
+def run_react(pipelined, **config):
+    thoughts = iter(THOUGHTS)
+
+    def get_scalar(prompt, on_text=None, **kwargs):
+        # Streams a word at a time, then the newline that ends the thought
+        thought = next(thoughts)
+        chunks = [f' {word}' if i else word for i, word in enumerate(thought.split())] + ['\n']
+        for i in range(len(chunks)):
+            time.sleep(DELAY / len(chunks))
+            if on_text is not None:
+                on_text(''.join(chunks[:i + 1]))
+        return thought
+
+    message_history = FakeMessageHistory()
+    agent = SimpleNamespace(config={'react.max_steps': 10, 'react.pipelined': pipelined, **config},
+                            context=SimpleNamespace(message_history=message_history),
+                            actions=FakeActions())
+    parent_task = SimpleNamespace(agent=agent, objective='do x, y and z')
+
+    with patch.object(react.llm, 'get_scalar', side_effect=get_scalar), \
+            patch.object(react.embeddings, 'get_embedding', side_effect=fake_embedding), \
+            patch.object(react.logs, 'insert_log'), \
+            patch.object(task, 'Task', FakeTask):
+        explicit_react = ExplicitReAct(parent_task)
+        start = time.perf_counter()
+        result = explicit_react.run()
+        elapsed = time.perf_counter() - start
+    return explicit_react, message_history, agent.actions, result, elapsed
+
+
+class TestPipelinedReAct(unittest.TestCase):
+    def test_same_steps_as_sequential(self):
+        # Only matches for the whole thought are used, the ones started while it streamed never are
+        seq_react, seq_history, seq_actions, seq_result, _ = run_react(pipelined=False)
+        pipe_react, pipe_history, pipe_actions, pipe_result, _ = run_react(pipelined=True,
+                                                                            **{'react.prefetch_max_missing_words': 0})
+
+        self.assertEqual(pipe_result, seq_result)
+        self.assertEqual(pipe_history.messages, seq_history.messages)
+        self.assertEqual(seq_react.results, ['Done, matched First, I need to do x',
+                                             'Done, matched Now, I need to do y',
+                                             'Done, matched Now, I need to do z'])
+        self.assertEqual(pipe_react.results, seq_react.results)
+
+    def test_match_starts_while_the_thought_streams(self):
+        explicit_react, history, actions, _, _ = run_react(pipelined=True)
+
+        # Each thought's task used the match of its words before the last one, started before the line ended
+        self.assertEqual(explicit_react.results, ['Done, matched First, I need to do',
+                                                  'Done, matched Now, I need to do',
+                                                  'Done, matched Now, I need to do'])
+        thoughts = [m['content'] for m in history.messages if m['role'] == 'thought']
+        for thought in thoughts[:-1]:
+            self.assertIn([thought.rsplit(' ', 1)[0]], [call[-1:] for call in actions.calls])
+
+    def test_pipelined_is_faster(self):
+        _, _, _, _, sequential = run_react(pipelined=False)
+        _, _, _, _, pipelined = run_react(pipelined=True)
+        self.assertLess(pipelined, sequential * 0.75)
+
+    def test_step_timings(self):
+        explicit_react = run_react(pipelined=True)[0]
+        self.assertEqual(len(explicit_react.step_timings), len(THOUGHTS))
+        for timings in explicit_react.step_timings[:-1]:
+            self.assertEqual(set(timings), {'thought', 'embedding', 'match', 'action', 'total'})
+        self.assertIn('Step 1: thought', explicit_react.get_timings_str())
+
+
+class TestAgentActions(unittest.TestCase):
+    def test_built_once_per_source_directory(self):
+        agent = agent_base.Agent()
+        agent.config = {'actions.source_directory': ''}
+        with patch.object(agent_base.retrieval, 'ActionCollection', side_effect=lambda source_dir: object()) as clss:
+            actions = agent.actions
+            self.assertIs(agent.actions, actions)
+            agent.config = {'actions.source_directory': '/elsewhere'}
+            self.assertIsNot(agent.actions, actions)
+        self.assertEqual([c.args for c in clss.call_args_list], [('',), ('/elsewhere',)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,257 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from agentpilot.agent import speech
+
+PLAY_SECS = 0.1
+
+
+class TestStreamSpeak(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.agent = SimpleNamespace(voice_data=(1, 3, 'voice-uuid'), context=SimpleNamespace(loop=self.loop))
+        self.speaker = speech.Stream_Speak(self.agent)
+        self.played = []
+
+        async def fake_play_file(voice_file):
+            self.played.append(voice_file)
+            await asyncio.sleep(PLAY_SECS)
+
+        patchers = [
+            patch.object(speech.elevenlabs, 'try_download_voice', side_effect=lambda voice_uuid, text: f'{text}.mp3'),
+            patch.object(self.speaker, 'play_file', side_effect=fake_play_file),
+            patch.object(speech.logs, 'insert_log'),
+            patch.object(speech.tts, 'audio_cache', speech.tts.AudioCache(max_bytes=0)),  # disabled
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_speaker(self, main):
+        async def run():
+            bg_tasks = [asyncio.ensure_future(self.speaker.download_voices()),
+                        asyncio.ensure_future(self.speaker.speak_voices())]
+            try:
+                return await main()
+            finally:
+                for task in bg_tasks:
+                    task.cancel()
+                await asyncio.gather(*bg_tasks, return_exceptions=True)
+        return self.loop.run_until_complete(run())
+
+    async def wait_until_quiet(self, timeout=2):
+        start = time.perf_counter()
+        await asyncio.sleep(0.05)
+        speaker = self.speaker
+        while speaker.speaking or speaker.download_tasks or not speaker.voice_files.empty() \
+                or not speaker.voice_uuids.empty():
+            if time.perf_counter() - start > timeout:
+                raise TimeoutError()
+            await asyncio.sleep(0.01)
+
+    def test_segments_play_in_order(self):
+        async def main():
+            stream = [('assistant', 'Hello there, how are you. '), ('assistant', 'I am fine, thank you.')]
+            async for _ in self.speaker.apush_stream(self.async_iter(stream)):
+                pass
+            await self.wait_until_quiet()
+
+        self.run_speaker(main)
+        self.assertEqual(self.played, ['Hello there, how are you..mp3', 'I am fine, thank you..mp3'])
+
+    def test_stream_from_worker_thread(self):
+        async def main():
+            def stream_response():
+                for _ in self.speaker.push_stream([('assistant', 'Streamed from a worker thread.')]):
+                    pass
+            thread = threading.Thread(target=stream_response)
+            thread.start()
+            await asyncio.to_thread(thread.join)
+            await self.wait_until_quiet()
+
+        self.run_speaker(main)
+        self.assertEqual(self.played, ['Streamed from a worker thread..mp3'])
+
+    def test_killed_response_is_dropped(self):
+        async def main():
+            self.speaker.start_stream()
+            self.speaker.generate_voices(self.speaker.msg_uuid, 'Old response.')
+            self.speaker.start_stream()
+            self.speaker.generate_voices(self.speaker.msg_uuid, 'New response.')
+            await self.wait_until_quiet()
+
+        self.run_speaker(main)
+        self.assertEqual(self.played, ['New response..mp3'])
+
+    def test_playback_does_not_block_the_loop(self):
+        ticks = []
+
+        async def main():
+            async def ticker():
+                while True:
+                    ticks.append(time.perf_counter())
+                    await asyncio.sleep(0.01)
+
+            ticker_task = asyncio.ensure_future(ticker())
+            self.speaker.start_stream()
+            for text in ('One segment.', 'Two segment.', 'Three segment.'):
+                self.speaker.generate_voices(self.speaker.msg_uuid, text)
+            await self.wait_until_quiet()
+            ticker_task.cancel()
+
+        self.run_speaker(main)
+        self.assertEqual(len(self.played), 3)
+        self.assertLess(max(b - a for a, b in zip(ticks, ticks[1:])), PLAY_SECS / 2)
+
+    def test_time_to_first_audio_recorded_per_utterance(self):
+        async def main():
+            for response in ('First response.', 'Second response.'):
+                self.speaker.start_stream()
+                self.speaker.generate_voices(self.speaker.msg_uuid, response)
+                self.speaker.generate_voices(self.speaker.msg_uuid, 'And more.')
+                await self.wait_until_quiet()
+
+        self.run_speaker(main)
+        self.assertEqual(len(self.speaker.first_audio_times), 2)
+        for _, secs in self.speaker.first_audio_times:
+            self.assertLess(secs, 1)
+        self.assertEqual(speech.logs.insert_log.call_count, 2)
+
+    def test_segments_download_concurrently_and_play_in_order(self):
+        running = []
+        max_running = []
+        lock = threading.Lock()
+
+        def slow_download(voice_uuid, text):
+            with lock:
+                running.append(text)
+                max_running.append(len(running))
+            time.sleep(0.3 - 0.05 * int(text[0]))  # later segments finish first
+            with lock:
+                running.remove(text)
+            return f'{text}.mp3'
+
+        texts = [f'{i} segment of the answer.' for i in range(5)]
+
+        async def main():
+            self.speaker.start_stream()
+            for text in texts:
+                self.speaker.generate_voices(self.speaker.msg_uuid, text)
+            await self.wait_until_quiet(timeout=5)
+
+        with patch.object(speech.elevenlabs, 'try_download_voice', side_effect=slow_download):
+            start = time.perf_counter()
+            self.run_speaker(main)
+            elapsed = time.perf_counter() - start
+
+        self.assertEqual(self.played, [f'{text}.mp3' for text in texts])
+        self.assertEqual(max(max_running), speech.synthesis_concurrency[3])
+        serial_secs = sum(0.3 - 0.05 * i for i in range(5)) + PLAY_SECS * 5
+        self.assertLess(elapsed, serial_secs * 0.8)
+
+    def test_failed_segment_does_not_hold_back_the_rest(self):
+        def flaky_download(voice_uuid, text):
+            if text.startswith('Bad'):
+                raise ConnectionError()
+            return f'{text}.mp3'
+
+        async def main():
+            self.speaker.start_stream()
+            for text in ('Good one.', 'Bad one.', 'Good two.'):
+                self.speaker.generate_voices(self.speaker.msg_uuid, text)
+            await self.wait_until_quiet()
+
+        with patch.object(speech.elevenlabs, 'try_download_voice', side_effect=flaky_download):
+            self.run_speaker(main)
+        self.assertEqual(self.played, ['Good one..mp3', 'Good two..mp3'])
+
+    def test_repeated_utterance_is_played_from_the_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir, ignore_errors=True)
+        downloads = []
+
+        def download(voice_uuid, text):
+            downloads.append(text)
+            filepath = os.path.join(tmp_dir, f'download_{len(downloads)}.mp3')
+            with open(filepath, 'wb') as f:
+                f.write(b'audio')
+            return filepath
+
+        async def main():
+            for _ in range(2):
+                self.speaker.start_stream()
+                self.speaker.generate_voices(self.speaker.msg_uuid, 'Opened the directory.')
+                await self.wait_until_quiet()
+
+        cache = speech.tts.AudioCache(cache_dir=os.path.join(tmp_dir, 'cache'))
+        with patch.object(speech.tts, 'audio_cache', cache), \
+                patch.object(speech.elevenlabs, 'try_download_voice', side_effect=download):
+            self.run_speaker(main)
+
+        self.assertEqual(downloads, ['Opened the directory.'])
+        self.assertEqual(len(self.played), 2)
+        self.assertEqual(self.played[0], self.played[1])
+        self.assertTrue(self.played[0].startswith(cache.cache_dir))
+
+    def test_uberduck_and_cache_stay_off_the_loop(self):
+        self.agent.voice_data = (1, 2, 'voice-uuid')
+        loop_threads = []
+        blocking_calls = []
+
+        def record(name, result):
+            def call(*args):
+                blocking_calls.append((name, threading.current_thread()))
+                return result(*args)
+            return call
+
+        async def main():
+            loop_threads.append(threading.current_thread())
+            async for _ in self.speaker.apush_stream(self.async_iter([('assistant', 'Hello from uberduck.')])):
+                pass
+            await self.wait_until_quiet()
+
+        cache = speech.tts.AudioCache(cache_dir=tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, cache.cache_dir, ignore_errors=True)
+        with patch.object(speech.tts, 'audio_cache', cache), \
+                patch.object(cache, 'get', side_effect=record('cache.get', lambda key: None)), \
+                patch.object(cache, 'put', side_effect=record('cache.put', lambda key, filepath: filepath)), \
+                patch.object(speech.uberduck, 'generate_voice_async', side_effect=record('speak', lambda *args: 'job')), \
+                patch.object(speech.uberduck, 'try_download_voice', side_effect=record('status', lambda job: f'{job}.wav')):
+            self.run_speaker(main)
+
+        self.assertEqual(self.played, ['job.wav'])
+        self.assertEqual([name for name, _ in blocking_calls], ['cache.get', 'speak', 'status', 'cache.put'])
+        for name, thread in blocking_calls:
+            self.assertIsNot(thread, loop_threads[0], name)
+
+    @staticmethod
+    async def async_iter(items):
+        for item in items:
+            yield item
+
+
+class TestReorderBuffer(unittest.TestCase):
+    def test_releases_in_order(self):
+        buffer = speech.ReorderBuffer()
+        self.assertEqual(buffer.put('a', 1, 'second'), [])
+        self.assertEqual(buffer.put('a', 2, 'third'), [])
+        self.assertEqual(buffer.put('a', 0, 'first'), ['first', 'second', 'third'])
+        self.assertEqual(buffer.put('a', 3, 'fourth'), ['fourth'])
+
+    def test_new_key_starts_again(self):
+        buffer = speech.ReorderBuffer()
+        buffer.put('a', 1, 'held back')
+        self.assertEqual(buffer.put('b', 0, 'first'), ['first'])
+        self.assertEqual(buffer.items, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
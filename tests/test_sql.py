@@ -0,0 +1,258 @@
+import asyncio
+import gc
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from agentpilot.utils import logs, sql
+from agentpilot.utils.sql_upgrade import upgrade_script, versions
+
+
+class SQLTestCase(unittest.TestCase):
+    """Points sql.py at an empty database with a single `notes` table"""
+    def setUp(self):
+        self.src_db_path = sql.get_db_path()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'data.db')
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE notes (id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT NOT NULL)")
+        conn.close()
+        sql.set_db_path(self.db_path)
+
+    def tearDown(self):
+        sql.set_db_path(self.src_db_path)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def journal_mode(self):
+        sql.close_connections()
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute("PRAGMA journal_mode").fetchone()[0]
+        finally:
+            conn.close()
+
+
+class TestStorageModes(SQLTestCase):
+    def test_wal_mode(self):
+        with patch.object(sql, 'storage_mode', 'wal'):
+            sql.execute("INSERT INTO notes (text) VALUES ('a')")
+            self.assertEqual(self.journal_mode(), 'wal')
+
+    def test_rollback_mode_resets_wal(self):
+        with patch.object(sql, 'storage_mode', 'wal'):
+            sql.execute("INSERT INTO notes (text) VALUES ('a')")
+        self.assertEqual(self.journal_mode(), 'wal')
+
+        with patch.object(sql, 'storage_mode', 'rollback'):
+            self.assertEqual(sql.get_scalar("SELECT text FROM notes"), 'a')
+            self.assertEqual(self.journal_mode(), 'delete')
+
+
+class TestConnections(SQLTestCase):
+    def test_closed_when_their_thread_exits(self):
+        sql.get_scalar("SELECT COUNT(*) FROM notes")
+        open_before = sql.connections.open_count()
+
+        threads = [threading.Thread(target=sql.get_scalar, args=("SELECT COUNT(*) FROM notes",)) for _ in range(50)]
+        for thread in threads:
+            thread.start()
+            thread.join()
+        gc.collect()
+        self.assertEqual(sql.connections.open_count(), open_before)
+
+    def test_close_all_closes_live_threads_connections(self):
+        opened, keep = threading.Event(), threading.Event()
+        thread = threading.Thread(target=lambda: (sql.get_scalar("SELECT 1"), opened.set(), keep.wait()))
+        thread.start()
+        opened.wait()
+        sql.get_scalar("SELECT 1")
+        self.assertGreaterEqual(sql.connections.open_count(), 2)
+        sql.close_connections()
+        self.assertEqual(sql.connections.open_count(), 0)
+        keep.set()
+        thread.join()
+
+
+class TestBatch(SQLTestCase):
+    def notes(self):
+        return sql.get_results("SELECT text FROM notes ORDER BY id", return_type='list')
+
+    def for_each_mode(self, test):
+        for mode in ('wal', 'rollback'):
+            with self.subTest(mode=mode), patch.object(sql, 'storage_mode', mode):
+                sql.execute("DELETE FROM notes")
+                test()
+                sql.close_connections()
+
+    def test_rolled_back_when_the_block_raises(self):
+        def test():
+            with self.assertRaises(ValueError):
+                with sql.batch():
+                    sql.execute("INSERT INTO notes (text) VALUES ('first')")
+                    self.assertEqual(sql.get_scalar("SELECT COUNT(*) FROM notes"), 1)
+                    sql.insert("INSERT INTO notes (text) VALUES ('second')")
+                    raise ValueError()
+            self.assertEqual(self.notes(), [])
+
+        self.for_each_mode(test)
+
+    def test_committed_together(self):
+        def test():
+            with sql.batch():
+                first_id = sql.insert("INSERT INTO notes (text) VALUES ('first')")
+                second_id = sql.insert("INSERT INTO notes (text) VALUES ('second')")
+                self.assertEqual(second_id, first_id + 1)
+                self.assertEqual(sql.get_results("SELECT text FROM notes", return_type='list'), ['first', 'second'])
+
+                # Not visible outside the transaction until it commits
+                outside = sqlite3.connect(self.db_path, timeout=0)
+                self.assertEqual(outside.execute("SELECT COUNT(*) FROM notes").fetchone()[0], 0)
+                outside.close()
+            self.assertEqual(self.notes(), ['first', 'second'])
+
+        self.for_each_mode(test)
+
+    def test_other_threads_wait_for_the_batch(self):
+        def test():
+            inserted = threading.Event()
+
+            def insert_outside():
+                sql.execute("INSERT INTO notes (text) VALUES ('outside')")
+                inserted.set()
+
+            with self.assertRaises(ValueError):
+                with sql.batch():
+                    sql.execute("INSERT INTO notes (text) VALUES ('inside')")
+                    thread = threading.Thread(target=insert_outside)
+                    thread.start()
+                    self.assertFalse(inserted.wait(0.2))
+                    raise ValueError()
+            thread.join()
+            # Only the batch was rolled back
+            self.assertEqual(self.notes(), ['outside'])
+
+        self.for_each_mode(test)
+
+    def test_blocking_write_on_the_loop_raises_while_another_batch_is_open(self):
+        def test():
+            opened, release = threading.Event(), threading.Event()
+
+            def hold_batch():
+                with sql.batch():
+                    sql.execute("INSERT INTO notes (text) VALUES ('batch')")
+                    opened.set()
+                    release.wait()
+
+            async def write_on_loop():
+                with self.assertRaises(RuntimeError):
+                    sql.execute("INSERT INTO notes (text) VALUES ('loop')")
+                with self.assertRaises(RuntimeError):
+                    with sql.batch():
+                        sql.execute("INSERT INTO notes (text) VALUES ('loop batch')")
+                # Awaiting the write doesn't block the loop, so the batch can end meanwhile
+                asyncio.get_running_loop().call_later(0.2, release.set)
+                await sql.aexecute("INSERT INTO notes (text) VALUES ('awaited')")
+
+            thread = threading.Thread(target=hold_batch)
+            thread.start()
+            opened.wait()
+            try:
+                asyncio.run(asyncio.wait_for(write_on_loop(), timeout=5))
+            finally:
+                release.set()
+                thread.join()
+            self.assertEqual(self.notes(), ['batch', 'awaited'])
+
+        self.for_each_mode(test)
+
+    def test_nested_batch_joins_the_outer_one(self):
+        with self.assertRaises(ValueError):
+            with sql.batch() as outer:
+                with sql.batch() as inner:
+                    self.assertIs(inner, outer)
+                    sql.execute("INSERT INTO notes (text) VALUES ('nested')")
+                raise ValueError()
+        self.assertEqual(self.notes(), [])
+
+    def test_awaitable_functions_join_the_batch(self):
+        async def run():
+            with sql.batch():
+                note_id = await sql.ainsert("INSERT INTO notes (text) VALUES ('async')")
+                text = await sql.aget_scalar("SELECT text FROM notes WHERE id = ?", (note_id,))
+                self.assertEqual(text, 'async')
+                raise ValueError()
+
+        with self.assertRaises(ValueError):
+            asyncio.run(run())
+        self.assertEqual(self.notes(), [])
+
+
+class TestLogSink(SQLTestCase):
+    def setUp(self):
+        super().setUp()
+        sql.execute("CREATE TABLE logs (id INTEGER PRIMARY KEY AUTOINCREMENT, log_type TEXT, message TEXT)")
+        self.sink = logs.LogSink(max_rows=50)
+
+    def test_full_buffer_flushes_without_blocking_the_loop(self):
+        async def batched_save():
+            with sql.batch():
+                await sql.aexecute("INSERT INTO notes (text) VALUES ('first')")
+                await asyncio.sleep(0.1)
+                await sql.aexecute("INSERT INTO notes (text) VALUES ('second')")
+
+        async def log_a_lot():
+            await asyncio.sleep(0.05)  # while the batch is open
+            for i in range(50):
+                self.sink.add('TEST', f'message {i}')
+
+        async def run():
+            await asyncio.gather(batched_save(), log_a_lot())
+
+        asyncio.run(asyncio.wait_for(run(), timeout=5))
+        self.sink.executor.submit(lambda: None).result()  # the background flush has finished
+        self.assertEqual(sql.get_scalar("SELECT COUNT(*) FROM logs"), 50)
+        self.assertEqual(sql.get_scalar("SELECT COUNT(*) FROM notes"), 2)
+
+
+class TestUpgrade(SQLTestCase):
+    def backups(self):
+        return [f for f in os.listdir(self.tmp_dir) if '.backup_v' in f]
+
+    def fake_steps(self, fail_at=None):
+        """Each step from 0.1.1 on only adds a note, or raises at `fail_at`"""
+        patchers = []
+        for step_version in versions[2:]:
+            def step(step_version=step_version):
+                if step_version == fail_at:
+                    raise sqlite3.OperationalError('step failed')
+                sql.execute("INSERT INTO notes (text) VALUES (?)", (step_version,))
+                return step_version
+            patchers.append(patch.object(upgrade_script, 'v' + step_version.replace('.', '_'), side_effect=step))
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_one_backup_for_all_steps(self):
+        self.fake_steps()
+        self.assertEqual(upgrade_script.upgrade_to_latest('0.1.0'), versions[-1])
+        self.assertEqual(self.backups(), ['data.db.backup_v0.1.0'])
+        self.assertEqual(sql.get_scalar("SELECT COUNT(*) FROM notes"), len(versions) - 2)
+
+    def test_no_backup_when_up_to_date(self):
+        upgrade_script.upgrade_to_latest(versions[-1])
+        self.assertEqual(self.backups(), [])
+
+    def test_failed_step_restores_the_backup(self):
+        self.fake_steps(fail_at=versions[-1])
+        with self.assertRaises(sqlite3.OperationalError):
+            upgrade_script.upgrade_to_latest('0.1.0')
+        self.assertEqual(sql.get_scalar("SELECT COUNT(*) FROM notes"), 0)
+        self.assertEqual(len(self.backups()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
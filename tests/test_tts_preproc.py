@@ -0,0 +1,137 @@
+import random
+import re
+import unittest
+
+from agentpilot.agent import speech
+from agentpilot.utils.helpers import remove_brackets, replace_times_with_spoken
+
+# Segments of assistant messages as they reach preproc_text
+CORPUS = [
+    'Sure, I can help with that.',
+    '  Let me open the directory for you.\n',
+    'Of course!',
+    'Here is a short summary of the article.',
+    'The weather today is mostly sunny with a light breeze.',
+    "I'm not sure, but I can look it up if you'd like.",
+    'First, preheat the oven to 200 degrees.',
+    'Then mix the flour, sugar and eggs together.',
+    'Is there anything else you need?',
+    'I have set a reminder for 3:30pm tomorrow.',
+    'The meeting moved to 11:45 am (it was at 10).',
+    'Your train leaves at 9:05am and arrives at 12:40pm.',
+    'That costs $20 today, or $4.99 each.',
+    'The total comes to $1,250 including tax.',
+    'Here you go *waves* [opens browser] (quietly).',
+    '*clears throat* Right then.',
+    'See the docs [1] for details (section 2).',
+    'Run this:\n```python\nprint("hi")\n```\nand you are done.',
+    '```bash\nls -la\n``` That lists every file.',
+    'Great job! 🎉🎉 Keep going 💪',
+    'Done ✅',
+    'Time: 10:00',
+    'Note: this only works on Linux.',
+    '[note] $5 at 7:05pm ✅',
+    '',
+    '   ',
+]
+
+EDGE_CASES = [
+    '(a[b)c]',  # crossed brackets, each kind is removed in its own pass
+    '(a[)]b)',
+    '$5$6 x',  # the pounds pass matches what the dollars pass leaves behind
+    '1:30pm and 11:30pm',
+    '$5```x```dollars',
+    '*a [b* c]',
+    '**bold** text',
+    '( unclosed',
+    'line one (\nline two)',
+]
+
+GOLDEN = {
+    'Sure, I can help with that.': 'Sure, I can help with that.',
+    '  Let me open the directory for you.\n': 'Let me open the directory for you.',
+    'I have set a reminder for 3:30pm tomorrow.': 'I have set a reminder for  three thirty  in the afternoon  tomorrow.',
+    'The meeting moved to 11:45 am (it was at 10).': 'The meeting moved to  eleven forty five in the morning  .',
+    'That costs $20 today, or $4.99 each.': 'That costs 20 today dollars, or 4.99 each dollars.',
+    'Here you go *waves* [opens browser] (quietly).': 'Here you go   .',
+    'Run this:\n```python\nprint("hi")\n```\nand you are done.': 'Run this:\n\nand you are done.',
+    'Great job! 🎉🎉 Keep going 💪': 'Great job!  🎉🎉  Keep going  💪',
+    '[note] $5 at 7:05pm ✅': '5 at dollars  seven oh five in the evening   ✅',
+    '(a[b)c]': '(a',
+}
+
+
+def legacy_preproc_text(text):
+    """Stream_Speak.preproc_text before the patterns were compiled, the reference for identical output"""
+    text = remove_brackets(text, '[(*')
+
+    text = replace_times_with_spoken(text)
+
+    # REMOVE CODE BLOCKS FROM TEXT AND THEIR CONTENTS (```...```)
+    text = re.sub(r'```.*?```', '', text, flags=re.DOTALL)
+
+    pattern = r'\$([\d.]+)\s?(\w+)'
+    text = re.sub(pattern, r'\1 \2 dollars', text)
+    pattern = r'\$([\d.]+)\s?(\w+)'
+    text = re.sub(pattern, r'\1 \2 pounds', text)
+    pattern = r'\$([\d.]+)\s?(\w+)'
+    text = re.sub(pattern, r'\1 \2 euro', text)
+
+    # remove emojies (some still get through)
+    EMOJI_PATTERN = re.compile(
+        "(["
+        "\U0001F1E0-\U0001F1FF"  # flags (iOS)
+        "\U0001F300-\U0001F5FF"  # symbols & pictographs
+        "\U0001F600-\U0001F64F"  # emoticons
+        "\U0001F680-\U0001F6FF"  # transport & map symbols
+        "\U0001F700-\U0001F77F"  # alchemical symbols
+        "\U0001F780-\U0001F7FF"  # Geometric Shapes Extended
+        "\U0001F800-\U0001F8FF"  # Supplemental Arrows-C
+        "\U0001F900-\U0001F9FF"  # Supplemental Symbols and Pictographs
+        "\U0001FA00-\U0001FA6F"  # Chess Symbols
+        "\U0001FA70-\U0001FAFF"  # Symbols and Pictographs Extended-A
+        "\U00002702-\U000027B0"  # Dingbats
+        "\U000024C2-\U0001F251"
+        "]+)"
+    )
+
+    text = re.sub(EMOJI_PATTERN, r' \1 ', text)
+
+    return text.strip()
+
+
+def run(func, text):
+    """The output, or the type of error raised"""
+    try:
+        return func(text)
+    except Exception as e:
+        return type(e)
+
+
+class TestPreprocText(unittest.TestCase):
+    def test_golden_outputs(self):
+        for text, expected in GOLDEN.items():
+            with self.subTest(text=text):
+                self.assertEqual(speech.preproc_text(text), expected)
+                self.assertEqual(legacy_preproc_text(text), expected)
+
+    def test_identical_to_legacy(self):
+        for text in CORPUS + EDGE_CASES:
+            with self.subTest(text=text):
+                self.assertEqual(speech.preproc_text(text), legacy_preproc_text(text))
+
+    def test_identical_to_legacy_on_random_text(self):
+        tokens = ['a', 'pm', 'am', ' ', '\n', '1', '12', ':', '.', '[', ']', '(', ')', '*', '`', '```', '$',
+                  '🎉', '✅', 'é']
+        rand = random.Random(25)
+        for _ in range(3000):
+            text = ''.join(rand.choice(tokens) for _ in range(rand.randint(0, 16)))
+            with self.subTest(text=text):
+                self.assertEqual(run(speech.preproc_text, text), run(legacy_preproc_text, text))
+
+    def test_method_uses_module_function(self):
+        self.assertEqual(speech.Stream_Speak.preproc_text(None, ' *sighs* Fine. '), 'Fine.')
+
+
+if __name__ == '__main__':
+    unittest.main()
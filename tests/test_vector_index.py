@@ -0,0 +1,97 @@
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+
+from agentpilot.utils import retrieval, semantic
+
+
+class TestTopK(unittest.TestCase):
+    def test_matches_stable_argsort(self):
+        rng = np.random.default_rng(0)
+        for _ in range(50):
+            scores = rng.integers(0, 5, size=40).astype(np.float32)  # plenty of ties
+            k = int(rng.integers(0, 45))
+            expected = np.argsort(-scores, kind='stable')[:k]
+            np.testing.assert_array_equal(semantic.top_k(scores, k), expected)
+
+
+class TestVectorIndex(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.vectors = rng.normal(size=(300, 16)).astype(np.float32)
+        self.queries = rng.normal(size=(2, 16)).astype(np.float32)
+
+    def reference(self, k, mask=None):
+        similarities = (semantic.normalize(self.vectors) @ semantic.normalize(self.queries).T).max(axis=1)
+        indexes = np.arange(len(self.vectors)) if mask is None else np.flatnonzero(mask)
+        return indexes[np.argsort(-similarities[indexes], kind='stable')[:k]]
+
+    def test_search(self):
+        index = semantic.VectorIndex(self.vectors)
+        np.testing.assert_array_equal(index.search(self.queries, 10), self.reference(10))
+
+    def test_search_with_mask(self):
+        index = semantic.VectorIndex(self.vectors)
+        mask = np.arange(len(self.vectors)) % 3 == 0
+        np.testing.assert_array_equal(index.search(self.queries, 10, mask=mask), self.reference(10, mask))
+        self.assertEqual(len(index.search(self.queries, 10, mask=np.zeros(len(self.vectors), dtype=bool))), 0)
+
+    def test_hnsw_without_hnswlib_falls_back_to_brute(self):
+        with patch.object(semantic.VectorIndex, 'hnsw_min_size', 10), \
+                patch.dict('sys.modules', {'hnswlib': None}):
+            index = semantic.VectorIndex(self.vectors, method='hnsw')
+        self.assertEqual(index.method, 'brute')
+        np.testing.assert_array_equal(index.search(self.queries, 10), self.reference(10))
+
+
+class TestMatchRequest(unittest.TestCase):
+    def make_collection(self, rng):
+        collection = retrieval.ActionCollection.__new__(retrieval.ActionCollection)
+        collection.vector_index = 'brute'
+        collection.top_k = 10
+        collection.all_category_files = {}
+        for category_num, name in enumerate(['Lists', 'Alarms', 'Weather', 'Files', '_Uncategorised']):
+            category = retrieval.ActionCategory.from_index(
+                {'name': name, 'desc': name, 'desc_prefix': ''}, rng.normal(size=8).astype(np.float32))
+            for action_num in range(12):
+                action_name = f'{name}_{action_num}'
+                entry = {'name': action_name, 'module': '', 'desc': action_name, 'desc_prefix': '', 'schema': None}
+                category.all_actions_data[action_name] = retrieval.ActionData.from_index(
+                    entry, rng.normal(size=8).astype(np.float32))
+            collection.all_category_files[name] = category
+        collection.build_index()
+        return collection
+
+    def reference(self, collection, query_embeddings):
+        # Score every category and every action in the best half of them, then sort
+        def best(embedding):
+            embedding = embedding / np.linalg.norm(embedding)
+            return max(float(embedding @ (q / np.linalg.norm(q))) for q in query_embeddings)
+
+        cat_scores = {name: best(collection.all_category_files[name].embedding) for name in collection.category_names}
+        lookat_cats = sorted(cat_scores, key=lambda name: -cat_scores[name])[:len(cat_scores) // 2]
+        lookat_cats += collection.uncategorised
+        action_scores = [(best(action_data.embedding), action_data.name)
+                         for name in lookat_cats
+                         for action_data in collection.all_category_files[name].all_actions_data.values()]
+        top = sorted(action_scores, key=lambda score_name: -score_name[0])[:10]
+        return list(reversed([name for _, name in top]))
+
+    def test_matches_reference(self):
+        rng = np.random.default_rng(2)
+        collection = self.make_collection(rng)
+        for _ in range(20):
+            query_embeddings = {'last': rng.normal(size=8).astype(np.float32),
+                                'prev': rng.normal(size=8).astype(np.float32)}
+            messages = [{'content': 'prev'}, {'content': 'last'}]
+            with patch.object(retrieval.embeddings, 'get_embedding',
+                              side_effect=lambda text: (1, query_embeddings[text])):
+                matched = collection.match_request(messages)
+
+            expected = self.reference(collection, list(query_embeddings.values()))
+            self.assertEqual([action_data.name for action_data in matched], expected)
+
+
+if __name__ == '__main__':
+    unittest.main()